@@ -0,0 +1,61 @@
+"""Compare a fresh httpx client per call against the shared pooled client.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_connection_pool --requests 500 --latency-ms 2
+
+The stub speaks plain HTTP on localhost, so the numbers show the TCP setup
+and client construction cost only; against a real instance the TLS
+handshake that pooling avoids is considerably larger.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from benchmarks.servicenow_stub import StubServer, create_stub_app
+
+def summarize(label: str, samples: list) -> str:
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    return f"{label:<24} mean={statistics.mean(samples) * 1000:7.3f}ms  p50={statistics.median(samples) * 1000:7.3f}ms  p95={p95 * 1000:7.3f}ms"
+
+async def per_call_client(url: str, count: int) -> list:
+    import httpx
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"{url}/api/now/table/incident", auth=("bench", "bench"), params={"sysparm_limit": 1})
+            response.json()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+async def pooled_client(count: int) -> list:
+    import mcp_server
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        await mcp_server.servicenow_get("/api/now/table/incident", params={"sysparm_limit": 1})
+        samples.append(time.perf_counter() - start)
+    await mcp_server.close_http_clients()
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with StubServer(create_stub_app(latency=args.latency_ms / 1000)) as stub:
+        os.environ.update({"SERVICENOW_INSTANCE": stub.url, "SERVICENOW_USERNAME": "bench", "SERVICENOW_PASSWORD": "bench"})
+        fresh = asyncio.run(per_call_client(stub.url, args.requests))
+        pooled = asyncio.run(pooled_client(args.requests))
+
+    print(summarize("new client per call", fresh))
+    print(summarize("shared pooled client", pooled))
+    print(f"speedup (mean): {statistics.mean(fresh) / statistics.mean(pooled):.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark local encoded-query evaluation over a large synthetic table.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_encoded_query --rows 100000
+
+For each query, reports parse time, the column-at-a-time evaluator against a
+row-at-a-time interpreter of the same AST, and the same query translated to
+SQL against an in-memory replica. Also counts how many cache keys a set of
+reordered but equivalent queries produces.
+"""
+import argparse
+import itertools
+import os
+import time
+
+os.environ.setdefault("SERVICENOW_INSTANCE", "http://bench.invalid")
+os.environ.setdefault("SERVICENOW_USERNAME", "bench")
+os.environ.setdefault("SERVICENOW_PASSWORD", "bench")
+
+import mcp_server
+from benchmarks.servicenow_stub import make_record
+from encoded_query import EncodedQuery, cell_text, sort_key
+from replica import ReplicaStore, query_sql
+
+QUERIES = [
+    "state=1^priority=2",
+    "priorityIN1,2^active=true^ORDERBYDESCnumber",
+    "short_descriptionLIKErecord 99",
+    "state!=3^priority>=4^NQnameSTARTSWITHincident_1",
+    "stateIN1,2^ORpriority=5^ORDERBYsys_updated_on",
+    "assigned_to=user00042^state<3",
+]
+
+def make_rows(count: int):
+    rows = []
+    for index in range(count):
+        row = make_record("incident", index)
+        row["active"] = "true" if index % 3 else "false"
+        row["assigned_to"] = {"link": "https://example.invalid/sys_user", "value": f"user{index % 500:05d}"}
+        rows.append(row)
+    return rows
+
+def row_at_a_time(query: EncodedQuery, rows, limit=None):
+    """Baseline: test every condition against every row, as a naive interpreter would."""
+    compiled = [[[(c.field, kind, test) for c in clause for kind, test in (c.compile(),)] for clause in group] for group in query.groups]
+
+    def cell(row, field, kind):
+        text = cell_text(row.get(field))
+        return text.lower() if kind == "folded" else (float(text) if kind == "number" else text)
+
+    def matches(row):
+        return any(all(any(test(cell(row, f, kind)) for f, kind, test in clause) for clause in group) for group in compiled) if compiled else True
+
+    result = [row for row in rows if matches(row)]
+    for field, descending in reversed(query.order_by):
+        result.sort(key=lambda row: sort_key(cell_text(row.get(field)).lower()), reverse=descending)
+    return result[:limit] if limit else result
+
+def timed(function, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    store = ReplicaStore(":memory:")
+    store.upsert("incident", rows, rows[-1]["sys_updated_on"])
+    print(f"{args.rows} rows, limit {args.limit}")
+    print(f"{'query':<48} {'parse':>8} {'columnar':>10} {'row-wise':>10} {'sqlite':>10} {'matches':>8}")
+    for text in QUERIES:
+        parse = timed(lambda: EncodedQuery.parse(text), repeat=1000)
+        query = EncodedQuery.parse(text)
+        expected = row_at_a_time(query, rows, args.limit)
+        assert query.apply(rows, args.limit) == expected, text
+        where, values, order_by = query_sql(query)
+        local = store.select("incident", where, values, order_by=order_by, limit=args.limit)
+        if query.order_by:
+            # Rows tied on every sort field may come back in either order
+            order_values = lambda result: [tuple(cell_text(r.get(field)) for field, _ in query.order_by) for r in result]
+            assert order_values(local) == order_values(expected), text
+        columnar = timed(lambda: query.apply(rows, args.limit))
+        row_wise = timed(lambda: row_at_a_time(query, rows, args.limit))
+        sqlite = timed(lambda: store.select("incident", where, values, order_by=order_by, limit=args.limit))
+        print(f"{text:<48} {parse * 1e6:>6.1f}us {columnar * 1e3:>8.1f}ms {row_wise * 1e3:>8.1f}ms {sqlite * 1e3:>8.1f}ms {len(query.select(rows)):>8}")
+
+    terms = ["active=true", "priority=1^ORpriority=2", "stateIN3,1,2", "short_descriptionLIKEdisk"]
+    variants = ["^".join(order) for order in itertools.permutations(terms)]
+    raw_keys = {f"/api/now/table/incident?sysparm_query={variant}" for variant in variants}
+    keys = {mcp_server.cache_key("/api/now/table/incident", {"sysparm_query": variant}) for variant in variants}
+    print(f"cache keys for {len(variants)} reordered equivalent queries: {len(raw_keys)} raw, {len(keys)} canonical")
+
+if __name__ == "__main__":
+    main()
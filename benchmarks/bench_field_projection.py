@@ -0,0 +1,54 @@
+"""Measure payload size and latency of full records versus sysparm_fields projection.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_field_projection --rows 100 --width 300
+
+Requests go through the MCP server's ASGI app to a local stub serving wide
+records, with the response cache disabled so every call reaches the stub.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from benchmarks.servicenow_stub import StubServer, create_stub_app
+
+PROJECTED_FIELDS = "number,short_description,state,priority,sys_id"
+
+async def measure(path: str, params: dict, iterations: int):
+    import httpx
+    import mcp_server
+    samples, size = [], 0
+    transport = httpx.ASGITransport(app=mcp_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            response = await client.get(path, params=params)
+            samples.append(time.perf_counter() - start)
+            size = len(response.content)
+    await mcp_server.close_http_clients()
+    return statistics.median(samples), size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--width", type=int, default=300, help="extra columns per record")
+    parser.add_argument("--iterations", type=int, default=30)
+    args = parser.parse_args()
+
+    with StubServer(create_stub_app(dataset_size=args.rows, width=args.width)) as stub:
+        os.environ.update({
+            "SERVICENOW_INSTANCE": stub.url, "SERVICENOW_USERNAME": "bench", "SERVICENOW_PASSWORD": "bench",
+            "SERVICENOW_CACHE_ENABLED": "false",
+        })
+        full = asyncio.run(measure("/incidents", {"limit": args.rows}, args.iterations))
+        projected = asyncio.run(measure("/incidents", {"limit": args.rows, "fields": PROJECTED_FIELDS}, args.iterations))
+
+    print(f"{'full records':<22} bytes={full[1]:>10,}  p50={full[0] * 1000:8.2f}ms")
+    print(f"{'fields=' + str(len(PROJECTED_FIELDS.split(','))) + ' columns':<22} bytes={projected[1]:>10,}  p50={projected[0] * 1000:8.2f}ms")
+    print(f"payload reduction: {full[1] / projected[1]:.1f}x, latency reduction: {full[0] / projected[0]:.1f}x")
+
+if __name__ == "__main__":
+    main()
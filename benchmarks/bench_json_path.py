@@ -0,0 +1,92 @@
+"""Benchmark CPU cost per MB of the JSON paths for list responses.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_json_path --rows 5000 --width 20
+
+Compares, for one synthetic Table API body:
+
+* ``stdlib``: ``json.loads``, ``jsonable_encoder`` and ``JSONResponse``
+  (the path every list call used to take)
+* ``orjson``: ``orjson.loads`` and ``FastJSONResponse`` without the encoder
+* ``raw``: slicing the ``result`` array out of the body bytes
+
+first on the decode/encode step alone and then end to end through the app
+(ASGI in process, upstream served by an ``httpx.MockTransport``). End to end,
+``stdlib`` is the current app with orjson switched off, so it already skips
+``jsonable_encoder``.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("SERVICENOW_INSTANCE", "http://bench.invalid")
+os.environ.setdefault("SERVICENOW_USERNAME", "bench")
+os.environ.setdefault("SERVICENOW_PASSWORD", "bench")
+os.environ.setdefault("SERVICENOW_RATE_LIMIT_ENABLED", "false")
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import mcp_server
+from benchmarks.servicenow_stub import make_record
+
+def make_body(rows: int, width: int) -> bytes:
+    return json.dumps({"result": [make_record("syslog", i, width) for i in range(rows)]}).encode()
+
+def stdlib_path(body: bytes) -> bytes:
+    return JSONResponse(jsonable_encoder(json.loads(body)["result"])).body
+
+def orjson_path(body: bytes) -> bytes:
+    return mcp_server.FastJSONResponse(mcp_server.json_loads(body)["result"]).body
+
+def raw_path(body: bytes) -> bytes:
+    return mcp_server.slice_result(body)
+
+def cpu_per_mb(function, megabytes: float, repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        function()
+    return (time.process_time() - start) / repeat / megabytes
+
+async def end_to_end(body: bytes, mode: str, repeat: int) -> float:
+    """CPU seconds per MB for GET /system-logs with the given JSON mode."""
+    mcp_server.SERVICENOW_RAW_PASSTHROUGH = mode == "raw"
+    mcp_server.USE_ORJSON = mode != "stdlib"
+    mcp_server.get_instance().client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=body)))
+    try:
+        async with httpx.AsyncClient(app=mcp_server.app, base_url="http://bench") as client:
+            start = time.process_time()
+            for _ in range(repeat):
+                response = await client.get("/system-logs", params={"limit": 100000})
+                assert response.status_code == 200
+            elapsed = time.process_time() - start
+    finally:
+        await mcp_server.close_http_clients()
+    return elapsed / repeat / (len(body) / 1e6)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--width", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    body = make_body(args.rows, args.width)
+    megabytes = len(body) / 1e6
+    print(f"body: {args.rows} rows, {megabytes:.2f} MB (orjson installed: {mcp_server.USE_ORJSON})")
+    assert json.loads(stdlib_path(body)) == json.loads(orjson_path(body)) == json.loads(raw_path(body))
+    paths = {"stdlib": stdlib_path, "orjson": orjson_path, "raw": raw_path}
+    if not mcp_server.USE_ORJSON:
+        del paths["orjson"]
+    print(f"{'path':<8} {'decode/encode':>16} {'end to end':>14}")
+    for name, function in paths.items():
+        step = cpu_per_mb(lambda: function(body), megabytes, args.repeat)
+        total = asyncio.run(end_to_end(body, name, args.repeat))
+        print(f"{name:<8} {step * 1e3:>11.2f}ms/MB {total * 1e3:>9.2f}ms/MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Measure the per-request cost of the metrics middleware.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_metrics_overhead --requests 20000
+
+Drives a trivial route through raw ASGI calls (no HTTP client or socket in
+the way) with and without MetricsMiddleware and reports the difference.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("SERVICENOW_INSTANCE", "http://bench.invalid")
+os.environ.setdefault("SERVICENOW_USERNAME", "bench")
+os.environ.setdefault("SERVICENOW_PASSWORD", "bench")
+
+from fastapi import FastAPI
+
+from mcp_server import MetricsMiddleware
+
+def build_app(with_metrics: bool):
+    bench_app = FastAPI()
+
+    @bench_app.get("/ping/{item}")
+    async def ping(item: str):
+        return {"item": item}
+
+    return MetricsMiddleware(bench_app) if with_metrics else bench_app
+
+async def drive(asgi_app, count: int) -> float:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": "/ping/1", "raw_path": b"/ping/1", "query_string": b"", "headers": [], "server": ("bench", 80)}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(count):
+        await asgi_app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    plain, instrumented = build_app(False), build_app(True)
+    asyncio.run(drive(plain, 1000))  # warm up
+    asyncio.run(drive(instrumented, 1000))
+    baseline = asyncio.run(drive(plain, args.requests))
+    with_metrics = asyncio.run(drive(instrumented, args.requests))
+    print(f"without metrics: {baseline * 1e6:8.2f}us/request")
+    print(f"with metrics:    {with_metrics * 1e6:8.2f}us/request")
+    print(f"overhead:        {(with_metrics - baseline) * 1e6:8.2f}us/request ({(with_metrics / baseline - 1) * 100:.1f}%)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Benchmark the /prompt router over a generated corpus of sample prompts.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_prompt_router --prompts 5000
+
+Reports routing accuracy and time per prompt, then rebuilds the router with
+many synthetic extra tools to show that routing cost stays flat as tools are
+added, unlike a linear scan over per-tool rules.
+"""
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("SERVICENOW_INSTANCE", "http://bench.invalid")
+os.environ.setdefault("SERVICENOW_USERNAME", "bench")
+os.environ.setdefault("SERVICENOW_PASSWORD", "bench")
+
+import mcp_server
+from mcp_server import PromptRouter, TableTool
+
+SYS_ID = "6816f79cc0a8016401c5a33be04be441"
+
+# (template, expected tool); {n} is a number suffix, {sys_id} a sys_id
+TEMPLATES = [
+    ("Get the short description for incident INC{n}", "get_incident_short_description"),
+    ("what is the short description of INC{n}", "get_incident_short_description"),
+    ("show me the details of incident INC{n}", "get_incident"),
+    ("INC{n}", "get_incident"),
+    ("list recent incidents", "list_incidents"),
+    ("show the last 20 incidents", "list_incidents"),
+    ("list users", "list_users"),
+    ("show users", "list_users"),
+    ("details for user abel.tuter", "get_user"),
+    ("get user {sys_id}", "get_user"),
+    ("Describe the 'incident' table", "get_table_description"),
+    ("schema for table cmdb_ci", "get_table_schema"),
+    ("which fields are on sys_user", "get_table_schema"),
+    ("list tables", "list_tables"),
+    ("show knowledge articles", "list_knowledge_articles"),
+    ("get knowledge article {sys_id}", "get_knowledge_article"),
+    ("list groups", "list_groups"),
+    ("show group {sys_id}", "get_group"),
+    ("list catalog items", "list_catalog_items"),
+    ("catalog item {sys_id}", "get_catalog_item"),
+    ("show request REQ{n}", "list_requests"),
+    ("RITM{n}", "list_requested_items"),
+    ("show change CHG{n}", "list_change_requests"),
+    ("list open change requests", "list_change_requests"),
+    ("get task TASK{n}", "list_tasks"),
+    ("show problem PRB{n}", "list_problems"),
+    ("list assets", "list_assets"),
+    ("show me CIs", "list_cmdb_items"),
+    ("configuration item {sys_id}", "get_cmdb_item"),
+    ("show audit history", "list_audit_records"),
+    ("recent system logs", "list_system_logs"),
+    ("test authentication", "test_auth"),
+    ("get table schema for incident", "get_table_schema"),
+    ("show the schema for table problem", "get_table_schema"),
+    ("what columns does the task table have", "get_table_schema"),
+    ("list recent problems", "list_problems"),
+    ("count incidents per assignment_group", "aggregate_records"),
+    ("how many open P1 incidents per assignment group", "aggregate_records"),
+    ("stats for problems grouped by priority", "aggregate_records"),
+    ("total changes by risk", "aggregate_records"),
+    ("expand incident {sys_id}", "expand_record"),
+    ("show the graph of related records for problem {sys_id}", "expand_record"),
+    ("what is linked to change_request {sys_id}", "expand_record"),
+]
+
+def corpus(size: int, seed: int = 7):
+    rng = random.Random(seed)
+    for _ in range(size):
+        template, tool = rng.choice(TEMPLATES)
+        yield template.format(n=f"{rng.randrange(10 ** 7):07d}", sys_id=SYS_ID), tool
+
+def synthetic_tools(count: int):
+    return [
+        TableTool(table=f"u_custom_{i}", list_tool=f"list_custom_{i}", list_path=f"/custom-{i}s",
+                  list_summary=f"List custom {i}", list_description=f"List widget{i} gadget{i} records",
+                  detail_tool=f"get_custom_{i}", detail_path=f"/custom-{i}/{{record_id}}",
+                  detail_summary=f"Get custom {i}", detail_description=f"Get details for a widget{i} gadget{i} record")
+        for i in range(count)
+    ]
+
+def synthetic_resources(tools):
+    resources = []
+    for tool in tools:
+        resources.append({"name": tool.list_tool, "description": tool.list_description, "path": tool.list_path, "method": "GET", "parameters": []})
+        resources.append({"name": tool.detail_tool, "description": tool.detail_description, "path": tool.detail_path, "method": "GET", "parameters": []})
+    return resources
+
+def linear_scan(rules, prompt: str):
+    """Baseline: check every tool's keywords against the prompt, as an if-chain would."""
+    lowered = prompt.lower()
+    best, best_hits = None, 0
+    for name, keywords in rules:
+        hits = sum(1 for keyword in keywords if keyword in lowered)
+        if hits > best_hits:
+            best, best_hits = name, hits
+    return best
+
+def time_per_prompt(route, prompts) -> float:
+    start = time.perf_counter()
+    for prompt in prompts:
+        route(prompt)
+    return (time.perf_counter() - start) / len(prompts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prompts", type=int, default=5000)
+    args = parser.parse_args()
+
+    samples = list(corpus(args.prompts))
+    router = mcp_server.get_prompt_router()
+    correct = sum(1 for prompt, tool in samples if (router.route(prompt) or {}).get("tool") == tool)
+    prompts = [prompt for prompt, _ in samples]
+    print(f"corpus: {len(samples)} prompts, {len(router.tools)} tools, accuracy {correct / len(samples) * 100:.1f}%")
+    print(f"router: {time_per_prompt(router.route, prompts) * 1e6:.1f}us/prompt")
+
+    base_resources = list(mcp_server.MCP_RESOURCES)
+    print(f"{'extra tools':>12} {'indexed router':>16} {'linear scan':>14}")
+    for extra in (0, 100, 1000, 5000):
+        tools = synthetic_tools(extra)
+        scaled = PromptRouter(base_resources + synthetic_resources(tools), mcp_server.TABLE_TOOLS + tools)
+        rules = [(resource["name"], resource["description"].lower().split()) for resource in base_resources + synthetic_resources(tools)]
+        indexed = time_per_prompt(scaled.route, prompts[:1000])
+        linear = time_per_prompt(lambda prompt: linear_scan(rules, prompt), prompts[:200])
+        print(f"{extra * 2:>12} {indexed * 1e6:>14.1f}us {linear * 1e6:>12.1f}us")
+
+if __name__ == "__main__":
+    main()
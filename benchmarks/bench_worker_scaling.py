@@ -0,0 +1,107 @@
+"""Measure how throughput scales with worker processes, per cache backend.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_worker_scaling --workers 1,2,4 --backends memory,redis
+    python -m benchmarks.bench_worker_scaling --redis-url redis://localhost:6379/15
+
+Each (backend, worker count) pair is one ``benchmarks.load_test`` run with
+the same seeded workload, launched through ``gunicorn.conf.py`` (or
+``uvicorn --workers`` with ``--launcher uvicorn``). Without ``--redis-url``
+the redis backend talks to fakeredis's TCP server in a child process, a
+stand-in that is much slower than a real Redis, so compare upstream calls
+rather than latency for that backend. The table shows throughput, latency, the upstream
+calls the stub saw and the RSS summed over all workers. Speedup is relative to
+the smallest worker count of the same backend. Worker counts above the number
+of cores cannot speed anything up, so run this on a machine with at least as
+many cores as the largest count.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks import load_test
+from benchmarks.servicenow_stub import free_port
+
+class FakeRedisProcess:
+    """fakeredis's TCP server in a child process, for when no real Redis is at hand."""
+
+    def __init__(self):
+        self.port = free_port()
+        self.url = f"redis://127.0.0.1:{self.port}/0"
+        self.process: Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> "FakeRedisProcess":
+        code = f"import fakeredis; fakeredis.TcpFakeServer(('127.0.0.1', {self.port})).serve_forever()"
+        self.process = subprocess.Popen([sys.executable, "-c", code])
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError("fakeredis server did not start within 30s")
+
+    def __exit__(self, *exc_info):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+def measure(options: List[str], backend: str, workers: int, redis_url: Optional[str]) -> Dict[str, Any]:
+    env = [f"SERVICENOW_CACHE_BACKEND={backend}"]
+    if backend == "redis":
+        # A fresh prefix per run so one run's entries do not warm the next
+        env += [f"SERVICENOW_CACHE_REDIS_URL={redis_url}", f"SERVICENOW_CACHE_REDIS_PREFIX=bench{os.getpid()}-{workers}:"]
+    args = load_test.make_parser().parse_args([*options, "--workers", str(workers), *(f"--env={item}" for item in env)])
+    return load_test.run(args)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts")
+    parser.add_argument("--backends", default="memory,redis", help="Comma-separated cache backends")
+    parser.add_argument("--redis-url", help="Redis to use for the redis backend (default: a local fakeredis server)")
+    parser.add_argument("--launcher", choices=["uvicorn", "gunicorn"], default="gunicorn")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--save", metavar="PATH", help="Write all reports as JSON")
+    args = parser.parse_args(argv)
+
+    counts = [int(count) for count in args.workers.split(",")]
+    backends = [backend.strip() for backend in args.backends.split(",")]
+    options = ["--requests", str(args.requests), "--concurrency", str(args.concurrency), "--latency-ms", str(args.latency_ms),
+               "--launcher", args.launcher]
+    print(f"{os.cpu_count()} cores, {args.requests} requests at concurrency {args.concurrency}, launcher {args.launcher}")
+    print(f"{'backend':<8} {'workers':>7} {'req/s':>8} {'speedup':>8} {'p50':>9} {'p95':>9} {'upstream':>9} {'rss':>8}")
+    reports: List[Dict[str, Any]] = []
+    for backend in backends:
+        fake = FakeRedisProcess() if backend == "redis" and not args.redis_url else None
+        if fake is not None:
+            fake.__enter__()
+        try:
+            first = None
+            for workers in counts:
+                report = measure(options, backend, workers, args.redis_url or (fake and fake.url))
+                first = first or report
+                reports.append({"backend": backend, "workers": workers, **report})
+                latency = report["latency_ms"]
+                print(f"{backend:<8} {workers:>7} {report['throughput_rps']:>8} {report['throughput_rps'] / first['throughput_rps']:>7.2f}x "
+                      f"{latency['p50']:>7.1f}ms {latency['p95']:>7.1f}ms {report['upstream']['calls']:>9} {report['rss_mb']['peak']:>6}MB")
+        finally:
+            if fake is not None:
+                fake.__exit__()
+    if args.save:
+        with open(args.save, "w") as handle:
+            json.dump(reports, handle, indent=2, sort_keys=True)
+            handle.write("\n")
+        print(f"saved {args.save}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""Load-test the server with a fixed-concurrency agent workload against the local stub.
+
+Run from the repository root::
+
+    python -m benchmarks.load_test --concurrency 16 --requests 2000 --latency-ms 20
+    python -m benchmarks.load_test --save benchmarks/baselines/default.json
+    python -m benchmarks.load_test --check benchmarks/baselines/default.json
+
+The server and the ServiceNow stub (``benchmarks.servicenow_stub``) each run
+in their own process, so neither competes with the load generator for the
+GIL and the reported RSS is the server's alone. A seeded generator builds the request sequence up
+front: a weighted mix of list, detail, schema and prompt calls, with record
+ids drawn from a skewed distribution so a few hot records dominate, as they
+do for agents working a queue. Workers replay it at a fixed concurrency.
+
+The report covers throughput, p50/p95/p99 latency overall and per kind, the
+number of upstream calls (and 429s) the stub saw, and the server's RSS.
+``--save`` writes it as JSON. ``--check`` reruns with the baseline's recorded
+settings (flags given on the command line still win), prints a comparison and
+exits with status 1 when a metric is worse than the baseline by more than
+``--tolerance``, so a CI job can run it as a regression gate.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.servicenow_stub import free_port
+
+# (kind, weight, templates); "{n}" becomes a skewed record index, "{table}" a schema table
+WORKLOAD: List[Tuple[str, float, List[str]]] = [
+    ("list", 0.35, [
+        "/incidents?limit=20",
+        "/incidents?limit=10&query=state=1^priority=2",
+        "/incidents?limit=10&query=priorityIN1,2^ORDERBYDESCnumber",
+        "/tasks?limit=20",
+        "/users?limit=10",
+        "/change-requests?limit=10&query=state=2",
+        "/cmdb-items?limit=25&fields=name,sys_id,state",
+    ]),
+    ("detail", 0.40, [
+        "/incident/INC{n:07d}",
+        "/user/sys_user{n:08d}",
+        "/task/task{n:08d}",
+        "/cmdb-item/cmdb_ci{n:08d}",
+        "/group/sys_user_group{n:08d}",
+        "/incident-short-description/INC{n:07d}",
+    ]),
+    ("schema", 0.10, [
+        "/table-schema/{table}",
+        "/table-description/{table}",
+        "/tables?limit=20",
+    ]),
+    ("prompt", 0.15, [
+        "show me the details of incident INC{n:07d}",
+        "Get the short description for incident INC{n:07d}",
+        "list recent incidents",
+        "schema for table {table}",
+        "list open change requests",
+        "get user sys_user{n:08d}",
+    ]),
+]
+SCHEMA_TABLES = ["incident", "change_request", "cmdb_ci_server", "sys_user", "task"]
+# Options recorded with a report and reused by --check
+CONFIG_OPTIONS = ["requests", "warmup", "concurrency", "workers", "launcher", "latency_ms", "jitter_ms", "dataset_size", "width", "rate_limit", "seed", "env"]
+
+# (metric path, True when higher is better)
+CHECKED_METRICS = [
+    ("throughput_rps", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("upstream.calls", False),
+    ("upstream.throttled", False),
+    ("errors", False),
+    ("rss_mb.peak", False),
+]
+
+def build_requests(count: int, dataset_size: int, seed: int) -> List[Tuple[str, str, str, Optional[dict]]]:
+    """The reproducible request sequence: (kind, method, path, JSON body)."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _, _ in WORKLOAD]
+    weights = [weight for _, weight, _ in WORKLOAD]
+    templates = {kind: options for kind, _, options in WORKLOAD}
+    requests = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        template = rng.choice(templates[kind])
+        # Roughly exponential popularity: the first few dozen records take most of the traffic
+        text = template.format(n=min(int(rng.expovariate(1 / 25)), dataset_size - 1), table=rng.choice(SCHEMA_TABLES))
+        if kind == "prompt":
+            requests.append((kind, "POST", "/prompt", {"prompt": text}))
+        else:
+            requests.append((kind, "GET", text, None))
+    return requests
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(samples),
+        **{name: round(percentile(samples, fraction) * 1000, 3) for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "max": round(max(samples, default=0.0) * 1000, 3),
+    }
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of ``pid`` plus its worker processes via psutil, or of ``pid`` alone from /proc."""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            return sum(p.memory_info().rss for p in [process, *process.children(recursive=True)])
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class ChildProcess:
+    """A uvicorn app in a child process, ready once ``ready_path`` answers 200."""
+
+    def __init__(self, command: List[str], ready_path: str, env: Dict[str, str] = None):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.command = [arg.format(port=self.port) for arg in command]
+        self.ready_path = ready_path
+        self.env = {**os.environ, **(env or {})}
+        self.process: Optional[subprocess.Popen] = None
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def __enter__(self) -> "ChildProcess":
+        self.process = subprocess.Popen(self.command, env=self.env)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.command[2]} exited with status {self.process.returncode}")
+            try:
+                if httpx.get(f"{self.url}{self.ready_path}", timeout=1).status_code == 200:
+                    return self
+            except httpx.TransportError:
+                pass
+            time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError(f"{self.command[2]} did not start within 30s")
+
+    def __exit__(self, *exc_info):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+def stub_process(args: argparse.Namespace) -> ChildProcess:
+    command = [sys.executable, "-m", "benchmarks.servicenow_stub", "--port", "{port}",
+               "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms), "--dataset-size", str(args.dataset_size),
+               "--width", str(args.width), "--rate-limit", str(args.rate_limit), "--seed", str(args.seed)]
+    return ChildProcess(command, "/stub/stats")
+
+def server_process(args: argparse.Namespace, instance: str) -> ChildProcess:
+    if args.launcher == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "mcp_server:app", "--bind", "127.0.0.1:{port}",
+                   "--log-level", "warning", "--workers", str(args.workers)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "mcp_server:app", "--host", "127.0.0.1", "--port", "{port}",
+                   "--log-level", "warning", "--workers", str(args.workers)]
+    env = {
+        "SERVICENOW_INSTANCE": instance, "SERVICENOW_USERNAME": "bench", "SERVICENOW_PASSWORD": "bench",
+        "SERVICENOW_REPLICA_ENABLED": "false",
+        **dict(item.split("=", 1) for item in args.env),
+    }
+    return ChildProcess(command, "/resources", env)
+
+def stub_stats(stub: ChildProcess) -> Dict[str, Any]:
+    return httpx.get(f"{stub.url}/stub/stats").json()
+
+async def drive(url: str, requests: List[Tuple[str, str, str, Optional[dict]]], concurrency: int,
+                pid: int) -> Dict[str, Any]:
+    """Replay ``requests`` with ``concurrency`` workers; return latencies, errors and RSS samples."""
+    latencies: Dict[str, List[float]] = {kind: [] for kind, _, _ in WORKLOAD}
+    errors: Dict[str, int] = {}
+    rss_samples: List[int] = []
+    pending = iter(requests)
+    done = asyncio.Event()
+
+    async def sample_rss():
+        while not done.is_set():
+            rss = rss_bytes(pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            try:
+                await asyncio.wait_for(done.wait(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def worker(client: httpx.AsyncClient):
+        for kind, method, path, body in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                await response.aread()
+                status = response.status_code
+            except httpx.HTTPError as exc:
+                status = type(exc).__name__
+            latencies[kind].append(time.perf_counter() - start)
+            # 404s are expected: the skew reaches past the end of some small tables
+            if not isinstance(status, int) or status >= 500 or status == 429:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        sampler = asyncio.create_task(sample_rss())
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await sampler
+    return {"latencies": latencies, "errors": errors, "elapsed": elapsed, "rss_samples": rss_samples}
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    requests = build_requests(args.warmup + args.requests, args.dataset_size, args.seed)
+    with stub_process(args) as stub, server_process(args, stub.url) as server:
+        start_rss = rss_bytes(server.pid)
+        if args.warmup:
+            asyncio.run(drive(server.url, requests[:args.warmup], args.concurrency, server.pid))
+        before = stub_stats(stub)
+        measured = asyncio.run(drive(server.url, requests[args.warmup:], args.concurrency, server.pid))
+        after = stub_stats(stub)
+        end_rss = rss_bytes(server.pid)
+
+    every = [sample for samples in measured["latencies"].values() for sample in samples]
+    megabytes = lambda value: round(value / 1e6, 1) if value else None
+    return {
+        "config": {name: getattr(args, name) for name in CONFIG_OPTIONS},
+        "requests": len(every),
+        "errors": sum(measured["errors"].values()),
+        "errors_by_status": measured["errors"],
+        "duration_s": round(measured["elapsed"], 3),
+        "throughput_rps": round(len(every) / measured["elapsed"], 1),
+        "latency_ms": latency_summary(every),
+        "by_kind": {kind: latency_summary(samples) for kind, samples in measured["latencies"].items()},
+        "upstream": {
+            "calls": after["calls"] - before["calls"],
+            "throttled": after["throttled"] - before["throttled"],
+            "by_table": {table: count - before["by_table"].get(table, 0) for table, count in sorted(after["by_table"].items())
+                         if count - before["by_table"].get(table, 0)},
+        },
+        "rss_mb": {"start": megabytes(start_rss), "peak": megabytes(max(measured["rss_samples"], default=0)), "end": megabytes(end_rss)},
+    }
+
+def metric(report: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = report
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[Tuple[str, Any, Any, bool]]:
+    """Check each metric against the baseline; a metric regresses when it is worse by more than ``tolerance`` (a fraction).
+
+    Returns (metric, baseline value, current value, ok) rows. Counts that were
+    zero in the baseline (errors, 429s) must stay zero.
+    """
+    rows = []
+    for path, higher_is_better in CHECKED_METRICS:
+        before, after = metric(baseline, path), metric(current, path)
+        if before is None or after is None:
+            rows.append((path, before, after, True))
+            continue
+        if higher_is_better:
+            ok = after >= before * (1 - tolerance)
+        else:
+            ok = after <= before * (1 + tolerance)
+        rows.append((path, before, after, ok))
+    return rows
+
+def print_report(report: Dict[str, Any]):
+    config = report["config"]
+    print(f"{report['requests']} requests at concurrency {config['concurrency']} in {report['duration_s']}s "
+          f"({report['throughput_rps']} req/s), upstream latency {config['latency_ms']}ms, {report['errors']} errors")
+    print(f"{'kind':<8} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for kind, summary in [*report["by_kind"].items(), ("all", report["latency_ms"])]:
+        print(f"{kind:<8} {summary['count']:>6} " + " ".join(f"{summary[name]:>7.2f}ms" for name in ("p50", "p95", "p99", "max")))
+    upstream = report["upstream"]
+    print(f"upstream calls: {upstream['calls']} ({upstream['calls'] / max(report['requests'], 1):.2f} per request), "
+          f"429s: {upstream['throttled']}")
+    print("  " + ", ".join(f"{table}={count}" for table, count in upstream["by_table"].items()))
+    rss = report["rss_mb"]
+    print(f"server RSS (all workers): start {rss['start']}MB, peak {rss['peak']}MB, end {rss['end']}MB")
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="Measured requests")
+    parser.add_argument("--warmup", type=int, default=0, help="Requests sent before measuring starts")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes")
+    parser.add_argument("--launcher", choices=["uvicorn", "gunicorn"], default="uvicorn",
+                        help="Run the server with uvicorn --workers or with gunicorn.conf.py")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Stub latency per upstream call")
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--dataset-size", type=int, default=1000)
+    parser.add_argument("--width", type=int, default=10)
+    parser.add_argument("--rate-limit", type=int, default=0, help="Stub requests per second before 429s (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra server environment, repeatable")
+    parser.add_argument("--save", metavar="PATH", help="Write the report as JSON")
+    parser.add_argument("--check", metavar="PATH", help="Compare against a saved baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed fractional regression per metric")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.check:
+        with open(args.check) as handle:
+            baseline = json.load(handle)
+        # Rerun the baseline's workload; flags given explicitly override it
+        parser.set_defaults(**baseline.get("config", {}))
+        args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+            handle.write("\n")
+        print(f"saved {args.save}")
+    if baseline is None:
+        return 0
+
+    rows = compare(baseline, report, args.tolerance)
+    print(f"\n{'metric':<20} {'baseline':>10} {'current':>10}  status (tolerance {args.tolerance:.0%})")
+    for path, before, after, ok in rows:
+        print(f"{path:<20} {before if before is not None else '-':>10} {after if after is not None else '-':>10}  {'ok' if ok else 'REGRESSED'}")
+    return 0 if all(ok for *_, ok in rows) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
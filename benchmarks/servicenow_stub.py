@@ -0,0 +1,349 @@
+"""Local stand-in for the ServiceNow Table API, used by the benchmarks.
+
+Serves deterministic synthetic records for any table under
+``/api/now/table/{table}``:
+
+* ``sysparm_query`` is evaluated with the server's own encoded-query
+  evaluator, with indexed lookups for plain ``sys_id=``/``number=`` queries
+* ``sysparm_limit``/``sysparm_offset`` page the matches, and responses carry
+  ``X-Total-Count`` and ``Link`` headers like the real instance
+* ``sysparm_fields`` projects columns, including dot-walked names
+* ``sys_db_object`` and ``sys_dictionary`` describe a small task/cmdb
+  hierarchy so the schema tools have something to walk
+* ``/api/now/stats/{table}`` answers the Stats API: ``sysparm_count``,
+  ``sysparm_{avg,min,max,sum}_fields``, ``sysparm_group_by`` and
+  ``sysparm_having`` over the same rows
+
+Latency (a fixed delay plus optional jitter), record width, dataset size and a
+fixed-window rate limit are configurable. Throttled requests get a 429 with
+``Retry-After``, and every response under a rate limit carries
+``X-RateLimit-Limit``/``Remaining``/``Reset``. Counters live on
+``stub.state.stats`` and are served at ``/stub/stats``.
+
+Run one on its own for manual testing::
+
+    python -m benchmarks.servicenow_stub --port 8081 --latency-ms 50 --rate-limit 100
+"""
+import argparse
+import asyncio
+import math
+import operator
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from encoded_query import EncodedQuery, QueryParseError
+
+# Table -> parent table, for sys_db_object; "" marks a base table
+TABLE_HIERARCHY: Dict[str, str] = {
+    "task": "", "incident": "task", "problem": "task", "change_request": "task",
+    "sc_request": "task", "sc_req_item": "task", "sc_task": "task", "incident_task": "task", "problem_task": "task",
+    "cmdb": "", "cmdb_ci": "cmdb", "cmdb_ci_server": "cmdb_ci", "cmdb_ci_linux_server": "cmdb_ci_server",
+    "sys_user": "", "sys_user_group": "", "kb_knowledge": "", "sc_cat_item": "", "alm_asset": "",
+    "sys_audit": "", "syslog": "", "sys_db_object": "", "sys_dictionary": "",
+}
+# Columns each table defines itself; anything else is inherited or comes from make_record
+TABLE_COLUMNS: Dict[str, List[str]] = {
+    "task": ["number", "short_description", "state", "priority", "assigned_to", "assignment_group", "active"],
+    "incident": ["caller_id", "category", "impact", "urgency", "problem_id"],
+    "change_request": ["type", "risk", "start_date", "end_date"],
+    "cmdb": ["name", "sys_class_name"],
+    "cmdb_ci": ["operational_status", "ip_address", "location"],
+    "cmdb_ci_server": ["os", "cpu_count", "ram"],
+    "sys_user": ["user_name", "email", "first_name", "last_name", "active"],
+}
+SUPER_CLASS_DEPTH = 6
+# Unique fields answered from a dict instead of a scan when queried as "field=value"
+INDEXED_FIELDS = ("sys_id", "number")
+AGGREGATE_FUNCTIONS = ("avg", "min", "max", "sum")
+HAVING_OPERATORS = {"=": operator.eq, "!=": operator.ne, ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+def make_record(table: str, index: int, width: int = 0) -> Dict[str, Any]:
+    """Build one synthetic row; the same (table, index) always gives the same row.
+
+    ``width`` adds that many extra ``u_field_NNN`` columns to mimic wide tables
+    such as ``incident`` or ``cmdb_ci``.
+    """
+    record = {
+        "sys_id": f"{table}{index:08d}",
+        "number": f"{table[:3].upper()}{index:07d}",
+        "name": f"{table}_{index}",
+        "short_description": f"Synthetic {table} record {index}",
+        "state": str(index % 7),
+        "priority": str(index % 5 + 1),
+        "sys_updated_on": f"2024-01-01 00:{(index // 60) % 60:02d}:{index % 60:02d}",
+    }
+    for column in range(width):
+        record[f"u_field_{column:03d}"] = f"value {column} for {table} {index}"
+    return record
+
+def table_object(name: str) -> Dict[str, Any]:
+    """sys_db_object row for ``name``, with the dot-walked super_class chain already resolved."""
+    parent = TABLE_HIERARCHY.get(name, "")
+    row: Dict[str, Any] = {
+        "sys_id": f"sys_db_object_{name}",
+        "name": name,
+        "label": name.replace("_", " ").title(),
+        "super_class": {"link": f"/api/now/table/sys_db_object/sys_db_object_{parent}", "value": f"sys_db_object_{parent}"} if parent else "",
+        "super_class_name": parent,
+        "sys_name": name,
+        "description": f"Synthetic {name} table",
+    }
+    ancestor = parent
+    for depth in range(1, SUPER_CLASS_DEPTH + 1):
+        row[".".join(["super_class"] * depth + ["name"])] = ancestor
+        ancestor = TABLE_HIERARCHY.get(ancestor, "")
+    return row
+
+def dictionary_rows(name: str) -> List[Dict[str, Any]]:
+    return [
+        {
+            "sys_id": f"sys_dictionary_{name}_{element}",
+            "name": name,
+            "element": element,
+            "column_label": element.replace("_", " ").title(),
+            "internal_type": "reference" if element.endswith(("_to", "_id", "_group")) else "string",
+            "mandatory": "true" if element == "number" else "false",
+            "max_length": "40",
+            "reference": "",
+        }
+        for element in TABLE_COLUMNS.get(name, [])
+    ]
+
+def project(row: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    return {name: row.get(name, "") for name in fields}
+
+def aggregate(function: str, values: List[Any]) -> Optional[float]:
+    """One Stats API aggregate over the numeric values of a column; None when there are none."""
+    numbers = []
+    for value in values:
+        try:
+            numbers.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    if not numbers:
+        return None
+    if function == "avg":
+        return sum(numbers) / len(numbers)
+    return {"min": min, "max": max, "sum": sum}[function](numbers)
+
+def stats_text(value: Optional[float]) -> str:
+    # The Stats API sends every number as a string, integers without a fraction
+    if value is None:
+        return ""
+    return str(int(value)) if value == int(value) else f"{value:.4f}"
+
+def group_stats(rows: List[Dict[str, Any]], count: bool, fields: Dict[str, List[str]]) -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"count": str(len(rows))} if count else {}
+    for function, names in fields.items():
+        stats[function] = {name: stats_text(aggregate(function, [row.get(name) for row in rows])) for name in names}
+    return stats
+
+def having_matches(rows: List[Dict[str, Any]], having: str) -> bool:
+    """Evaluate ``aggregate^field^operator^value`` (e.g. ``count^priority^>^3``) for one group."""
+    function, field, op, value = having.split("^", 3)
+    actual = len(rows) if function == "count" else aggregate(function, [row.get(field) for row in rows])
+    return actual is not None and HAVING_OPERATORS[op](actual, float(value))
+
+class FixedWindowLimiter:
+    """``limit`` requests per ``window`` seconds, the way instance rate limit rules count."""
+
+    def __init__(self, limit: int, window: float = 1.0):
+        self.limit = limit
+        self.window = window
+        self.window_start = time.time()
+        self.used = 0
+
+    def acquire(self) -> Tuple[bool, Dict[str, str]]:
+        """Count one request; return whether it is allowed and the rate limit headers to send."""
+        now = time.time()
+        if now >= self.window_start + self.window:
+            self.window_start, self.used = now, 0
+        reset = self.window_start + self.window
+        allowed = self.used < self.limit
+        if allowed:
+            self.used += 1
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.limit - self.used),
+            "X-RateLimit-Reset": str(math.ceil(reset)),
+        }
+        if not allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(reset - now)))
+        return allowed, headers
+
+def create_stub_app(latency: float = 0.0, dataset_size: int = 1000, width: int = 0, jitter: float = 0.0,
+                    rate_limit: int = 0, rate_window: float = 1.0, seed: int = 0) -> FastAPI:
+    """Create a Table API stub.
+
+    Each request waits ``latency`` seconds plus a uniform random ``0..jitter``.
+    ``rate_limit`` > 0 allows that many requests per ``rate_window`` seconds and
+    answers the rest with 429. ``dataset_size`` rows exist in every data table.
+    """
+    stub = FastAPI(title="ServiceNow stub")
+    stub.state.stats = {"calls": 0, "throttled": 0, "rows": 0, "by_table": Counter()}
+    limiter = FixedWindowLimiter(rate_limit, rate_window) if rate_limit else None
+    jitter_source = random.Random(seed)
+    tables: Dict[str, List[Dict[str, Any]]] = {}
+    indexes: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+    def table_rows(table: str) -> List[Dict[str, Any]]:
+        rows = tables.get(table)
+        if rows is None:
+            if table == "sys_db_object":
+                rows = [table_object(name) for name in TABLE_HIERARCHY]
+            elif table == "sys_dictionary":
+                rows = [row for name in TABLE_HIERARCHY for row in dictionary_rows(name)]
+            else:
+                rows = [make_record(table, i, width) for i in range(dataset_size)]
+            tables[table] = rows
+            indexes[table] = {
+                field: {row[field]: i for i, row in enumerate(rows) if field in row}
+                for field in INDEXED_FIELDS
+            }
+        return rows
+
+    def matching(table: str, text: str) -> List[Dict[str, Any]]:
+        rows = table_rows(table)
+        if not text:
+            return rows
+        field, _, value = text.partition("=")
+        if field in INDEXED_FIELDS and "^" not in value:
+            position = indexes[table][field].get(value)
+            return [] if position is None else [rows[position]]
+        try:
+            return EncodedQuery.parse(text).apply(rows)
+        except QueryParseError:
+            # The instance ignores conditions it cannot evaluate; so does the stub
+            return rows
+
+    async def admit(table: str) -> Tuple[Optional[JSONResponse], Dict[str, str]]:
+        """Count a call, apply the rate limit and wait out the latency; returns a 429 response when throttled."""
+        stats = stub.state.stats
+        stats["calls"] += 1
+        stats["by_table"][table] += 1
+        headers: Dict[str, str] = {}
+        if limiter is not None:
+            allowed, headers = limiter.acquire()
+            if not allowed:
+                stats["throttled"] += 1
+                error = {"error": {"message": "Too many requests", "detail": "Rate limit exceeded"}}
+                return JSONResponse(error, status_code=429, headers=headers), headers
+        delay = latency + (jitter_source.uniform(0, jitter) if jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        return None, headers
+
+    @stub.get("/api/now/table/{table}")
+    async def table_api(table: str, request: Request):
+        throttled, headers = await admit(table)
+        if throttled is not None:
+            return throttled
+        stats = stub.state.stats
+        params = request.query_params
+        limit = int(params.get("sysparm_limit", 10))
+        offset = int(params.get("sysparm_offset", 0))
+        rows = matching(table, params.get("sysparm_query", ""))
+        total = len(rows)
+        page = rows[offset:offset + limit] if limit else rows[offset:]
+        fields = params.get("sysparm_fields")
+        if fields:
+            wanted = fields.split(",")
+            page = [project(row, wanted) for row in page]
+        stats["rows"] += len(page)
+        headers["X-Total-Count"] = str(total)
+        links = [f'<{request.url.include_query_params(sysparm_offset=0)}>;rel="first"']
+        if limit and offset + limit < total:
+            links.append(f'<{request.url.include_query_params(sysparm_offset=offset + limit)}>;rel="next"')
+        if offset > 0:
+            links.append(f'<{request.url.include_query_params(sysparm_offset=max(0, offset - (limit or offset)))}>;rel="prev"')
+        headers["Link"] = ",".join(links)
+        return JSONResponse({"result": page}, headers=headers)
+
+    @stub.get("/api/now/stats/{table}")
+    async def stats_api(table: str, request: Request):
+        throttled, headers = await admit(table)
+        if throttled is not None:
+            return throttled
+        params = request.query_params
+        rows = matching(table, params.get("sysparm_query", ""))
+        count = params.get("sysparm_count") == "true"
+        fields = {function: params[f"sysparm_{function}_fields"].split(",") for function in AGGREGATE_FUNCTIONS
+                  if params.get(f"sysparm_{function}_fields")}
+        group_by = [name for name in params.get("sysparm_group_by", "").split(",") if name]
+        if not group_by:
+            return JSONResponse({"result": {"stats": group_stats(rows, count, fields)}}, headers=headers)
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for row in rows:
+            groups.setdefault(tuple(str(row.get(name, "")) for name in group_by), []).append(row)
+        having = params.get("sysparm_having")
+        result = [
+            {"stats": group_stats(members, count, fields),
+             "groupby_fields": [{"field": name, "value": value, "display_value": value} for name, value in zip(group_by, key)]}
+            for key, members in sorted(groups.items()) if not having or having_matches(members, having)
+        ]
+        return JSONResponse({"result": result}, headers=headers)
+
+    @stub.get("/stub/stats")
+    async def stub_stats():
+        """Counters for load tests that run the stub in another process."""
+        return stub.state.stats
+
+    return stub
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class StubServer:
+    """Run a stub app under uvicorn on a background thread.
+
+    Usage::
+
+        with StubServer(create_stub_app(latency=0.005)) as server:
+            ...  # talk to server.url
+    """
+
+    def __init__(self, app: FastAPI, port: int = None):
+        self.app = app
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        config = uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="off")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self) -> "StubServer":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.should_exit = True
+        self.thread.join()
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--dataset-size", type=int, default=1000)
+    parser.add_argument("--width", type=int, default=0)
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests allowed per --rate-window seconds (0 = unlimited)")
+    parser.add_argument("--rate-window", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    app = create_stub_app(latency=args.latency_ms / 1000, dataset_size=args.dataset_size, width=args.width,
+                          jitter=args.jitter_ms / 1000, rate_limit=args.rate_limit, rate_window=args.rate_window, seed=args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
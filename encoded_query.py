@@ -0,0 +1,229 @@
+"""Parser and local evaluator for ServiceNow encoded queries.
+
+``EncodedQuery.parse`` turns a ``sysparm_query`` string into a small AST:
+``^NQ`` separated groups, each an AND of clauses, each clause an OR of
+conditions, plus the ``ORDERBY``/``ORDERBYDESC`` fields. ``canonical()``
+renders it back with clauses and ``IN`` lists sorted, so equivalent queries
+produce the same text, and ``apply()`` filters and sorts rows in memory.
+
+Text comparisons and sorts ignore case, the way the instance's collation
+does, and ``<``/``>`` compare numerically when the operand is a number.
+The replica's SQL translation and the subscription matcher use the same
+rules, so every local path agrees with the instance. Missing fields read as
+``""``. Unknown operators, ``javascript:`` values and ``GROUPBY`` raise
+``QueryParseError`` so callers can fall back to the instance.
+"""
+import re
+from dataclasses import dataclass
+from itertools import compress
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+OPERATORS = (
+    "ISNOTEMPTY", "ISEMPTY", "NOT IN", "NOT LIKE", "NOTIN", "NOTLIKE", "IN", "LIKE",
+    "STARTSWITH", "ENDSWITH", "!=", ">=", "<=", "=", ">", "<",
+)
+# Instance-only operators; listed so they are not misread as a supported prefix (INSTANCEOF as IN)
+UNSUPPORTED_OPERATORS = (
+    "INSTANCEOF", "DYNAMIC", "NSAMEAS", "SAMEAS", "NOTON", "ON", "BETWEEN", "DATEPART", "MORETHAN", "LESSTHAN",
+    "RELATIVEGT", "RELATIVELT", "RELATIVEGE", "RELATIVELE", "RELATIVEEE", "ANYTHING", "EMPTYSTRING",
+    "VALCHANGES", "CHANGESFROM", "CHANGESTO", "GT_OR_EQUALS_FIELD", "LT_OR_EQUALS_FIELD", "GT_FIELD", "LT_FIELD",
+)
+OPERATOR_ALIASES = {"NOTIN": "NOT IN", "NOTLIKE": "NOT LIKE"}
+COMPARISON_OPERATORS = {">", "<", ">=", "<="}
+CONDITION_PATTERN = re.compile(
+    r"^([a-z0-9_][a-z0-9_.]*)(" + "|".join(re.escape(op) for op in UNSUPPORTED_OPERATORS + OPERATORS) + r")(.*)$", re.DOTALL
+)
+ESCAPED_CARET = "\x00"
+
+class QueryParseError(ValueError):
+    """The encoded query uses syntax the local evaluator does not support."""
+
+def to_number(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+def is_number(value: str) -> bool:
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+def cell_text(value: Any) -> str:
+    """Raw text of a row value; reference fields come back as {"link", "value"} objects."""
+    if isinstance(value, dict):
+        value = value.get("value")
+    return "" if value is None else str(value)
+
+@dataclass(frozen=True, order=True)
+class Condition:
+    field: str
+    operator: str
+    value: str
+
+    @classmethod
+    def parse(cls, text: str) -> "Condition":
+        match = CONDITION_PATTERN.match(text)
+        if match is None:
+            raise QueryParseError(f"Unsupported condition: {text!r}")
+        field, operator, value = match.groups()
+        if operator in UNSUPPORTED_OPERATORS:
+            raise QueryParseError(f"Unsupported operator {operator}: {text!r}")
+        operator = OPERATOR_ALIASES.get(operator, operator)
+        if operator in ("ISEMPTY", "ISNOTEMPTY") and value:
+            raise QueryParseError(f"Unexpected value after {operator}: {text!r}")
+        if value.lstrip().lower().startswith("javascript:"):
+            raise QueryParseError("Scripted query values are evaluated by the instance")
+        if operator in ("IN", "NOT IN"):
+            value = ",".join(sorted(set(value.split(","))))
+        return cls(field, operator, value)
+
+    def encode(self) -> str:
+        return f"{self.field}{self.operator}{self.value.replace('^', '^^')}"
+
+    def compile(self) -> Tuple[str, Callable[[Any], bool]]:
+        """Return the column kind to test ("text", "folded" or "number") and a test for one cell."""
+        op, value = self.operator, self.value.lower()
+        text = "folded"
+        if op == "=":
+            return text, value.__eq__
+        if op == "!=":
+            return text, value.__ne__
+        if op in ("IN", "NOT IN"):
+            values = frozenset(value.split(","))
+            return text, values.__contains__ if op == "IN" else (lambda cell: cell not in values)
+        if op == "ISEMPTY":
+            return "text", "".__eq__
+        if op == "ISNOTEMPTY":
+            return "text", "".__ne__
+        if op in COMPARISON_OPERATORS:
+            kind, operand = ("number", float(value)) if is_number(value) else (text, value)
+            # Reflected: "cell > operand" is "operand < cell"
+            return kind, {">": operand.__lt__, "<": operand.__gt__, ">=": operand.__le__, "<=": operand.__ge__}[op]
+        if op == "LIKE":
+            return text, lambda cell: value in cell
+        if op == "NOT LIKE":
+            return text, lambda cell: value not in cell
+        if op == "STARTSWITH":
+            return text, lambda cell: cell.startswith(value)
+        return text, lambda cell: cell.endswith(value)
+
+Clause = Tuple[Condition, ...]
+
+class Columns:
+    """Lazily extracted per-field columns of a row list, shared by every condition in a query."""
+
+    def __init__(self, rows: Sequence[Dict[str, Any]]):
+        self.rows = rows
+        self.cache: Dict[Tuple[str, str], list] = {}
+
+    def get(self, field: str, kind: str) -> list:
+        column = self.cache.get((field, kind))
+        if column is None:
+            if kind == "text":
+                column = [cell_text(row.get(field)) for row in self.rows]
+            elif kind == "folded":
+                column = [cell.lower() for cell in self.get(field, "text")]
+            else:
+                column = list(map(to_number, self.get(field, "text")))
+            self.cache[(field, kind)] = column
+        return column
+
+def sort_key(cell: str) -> Tuple[float, str]:
+    return to_number(cell), cell
+
+@dataclass(frozen=True)
+class EncodedQuery:
+    groups: Tuple[Tuple[Clause, ...], ...]
+    order_by: Tuple[Tuple[str, bool], ...] = ()
+
+    @classmethod
+    def parse(cls, text: str) -> "EncodedQuery":
+        groups: List[List[List[Condition]]] = [[]]
+        order_by: List[Tuple[str, bool]] = []
+        for part in text.replace("^^", ESCAPED_CARET).split("^"):
+            part = part.replace(ESCAPED_CARET, "^")
+            if part in ("", "EQ"):
+                continue
+            if part.startswith("GROUPBY"):
+                raise QueryParseError("GROUPBY is not supported locally")
+            if part.startswith("ORDERBYDESC"):
+                order_by.append((part[len("ORDERBYDESC"):], True))
+            elif part.startswith("ORDERBY"):
+                order_by.append((part[len("ORDERBY"):], False))
+            elif part.startswith("NQ"):
+                groups.append([[Condition.parse(part[2:])]])
+            elif part.startswith("OR"):
+                if not groups[-1]:
+                    raise QueryParseError(f"^OR without a preceding condition: {part!r}")
+                groups[-1][-1].append(Condition.parse(part[2:]))
+            else:
+                groups[-1].append([Condition.parse(part)])
+        for field, _ in order_by:
+            if not CONDITION_PATTERN.match(f"{field}ISEMPTY"):
+                raise QueryParseError(f"Unsupported ORDERBY field: {field!r}")
+        seen = set()
+        unique_order = tuple(item for item in order_by if not (item[0] in seen or seen.add(item[0])))
+        normalized = {
+            tuple(sorted({tuple(sorted(set(clause))) for clause in group}))
+            for group in groups if group
+        }
+        return cls(tuple(sorted(normalized)), unique_order)
+
+    def canonical(self) -> str:
+        """Encoded query text that is identical for equivalent queries."""
+        parts = ["^NQ".join("^".join("^OR".join(c.encode() for c in clause) for clause in group) for group in self.groups)]
+        parts.extend(f"ORDERBY{'DESC' if desc else ''}{field}" for field, desc in self.order_by)
+        return "^".join(part for part in parts if part)
+
+    @property
+    def fields(self) -> FrozenSet[str]:
+        """Every field the query filters or sorts on."""
+        names = {c.field for group in self.groups for clause in group for c in clause}
+        return frozenset(names | {field for field, _ in self.order_by})
+
+    def select(self, rows: Sequence[Dict[str, Any]]) -> List[int]:
+        """Indexes of matching rows in query order.
+
+        Conditions run column at a time: each AND clause narrows a selection
+        vector of row indexes, so later clauses only look at surviving rows.
+        """
+        columns = Columns(rows)
+        everything = range(len(rows))
+        matched: Optional[set] = None
+        selection: Sequence[int] = everything
+        for group in self.groups or ((),):
+            selection = everything
+            for clause in group:
+                tests = [(columns.get(c.field, kind), test) for c in clause for kind, test in (c.compile(),)]
+                if len(tests) == 1:
+                    column, test = tests[0]
+                    cells = column if selection is everything else map(column.__getitem__, selection)
+                    selection = list(compress(selection, map(test, cells)))
+                else:
+                    selection = [i for i in selection if any(test(column[i]) for column, test in tests)]
+                if not selection:
+                    break
+            if len(self.groups) > 1:
+                matched = (matched or set()) | set(selection)
+        indexes = sorted(matched) if matched is not None else list(selection)
+        for field, descending in reversed(self.order_by):
+            column = columns.get(field, "folded")
+            indexes.sort(key=lambda i: sort_key(column[i]), reverse=descending)
+        return indexes
+
+    def apply(self, rows: Sequence[Dict[str, Any]], limit: int = None) -> List[Dict[str, Any]]:
+        """Filter and sort ``rows`` the way the instance would, keeping at most ``limit``."""
+        indexes = self.select(rows)
+        if limit:
+            indexes = indexes[:limit]
+        return [rows[i] for i in indexes]
+
+def canonical_query(text: str) -> str:
+    """Canonical form of ``text``, or ``text`` unchanged when it cannot be parsed."""
+    try:
+        return EncodedQuery.parse(text).canonical()
+    except QueryParseError:
+        return text
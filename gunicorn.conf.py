@@ -0,0 +1,32 @@
+"""Gunicorn settings for running the server on several worker processes.
+
+    pip install gunicorn uvicorn-worker
+    gunicorn -c gunicorn.conf.py mcp_server:app
+
+One uvicorn worker per core by default (SERVICENOW_WORKERS overrides it),
+listening on SERVICENOW_BIND. Each worker has its own event loop, upstream
+connection pools and rate limiters, so set SERVICENOW_RATE_LIMIT to the
+instance's budget divided by the number of workers, and share the response
+cache with SERVICENOW_CACHE_BACKEND=redis so workers do not each warm their
+own copy.
+"""
+import importlib.util
+import multiprocessing
+import os
+
+bind = os.getenv("SERVICENOW_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("SERVICENOW_WORKERS", "0")) or multiprocessing.cpu_count()
+# uvicorn.workers still works but is deprecated in favour of the uvicorn-worker package
+worker_class = "uvicorn_worker.UvicornWorker" if importlib.util.find_spec("uvicorn_worker") else "uvicorn.workers.UvicornWorker"
+keepalive = int(os.getenv("SERVICENOW_KEEPALIVE", "5"))
+graceful_timeout = 30
+# Subscriptions (GET /subscribe) hold a connection open; the async worker still heartbeats
+timeout = 60
+
+def when_ready(server):
+    if workers < 2:
+        return
+    if os.getenv("SERVICENOW_CACHE_BACKEND", "memory").strip().lower() == "memory":
+        server.log.warning("%d workers with SERVICENOW_CACHE_BACKEND=memory: each keeps its own response cache", workers)
+    if os.getenv("SERVICENOW_REPLICA_ENABLED", "").strip().lower() in ("1", "true", "yes", "on"):
+        server.log.warning("%d workers with SERVICENOW_REPLICA_ENABLED: every worker syncs the replica", workers)
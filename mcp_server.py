@@ -1,8 +1,34 @@
 import os
-from fastapi import FastAPI, HTTPException, Request
+import re
+import asyncio
+import bisect
+import hashlib
+import json
+import random
+import time
+import zlib
+import gzip
+import importlib.util
+import inspect
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, Request, Depends, Query, Path
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from pydantic.fields import FieldInfo
 from dotenv import load_dotenv
 import httpx
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator, Union, Annotated, get_args, get_origin
+from urllib.parse import parse_qsl, urlencode
+
+from encoded_query import EncodedQuery, QueryParseError, canonical_query, cell_text
+from replica import IDENTIFIER_PATTERN, ReplicaStore, query_sql, reconcile_table, sync_table
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,22 +37,1723 @@ SERVICENOW_INSTANCE = os.getenv("SERVICENOW_INSTANCE")
 SERVICENOW_USERNAME = os.getenv("SERVICENOW_USERNAME")
 SERVICENOW_PASSWORD = os.getenv("SERVICENOW_PASSWORD")
 
-if not all([SERVICENOW_INSTANCE, SERVICENOW_USERNAME, SERVICENOW_PASSWORD]):
-    raise RuntimeError("Please set SERVICENOW_INSTANCE, SERVICENOW_USERNAME, and SERVICENOW_PASSWORD in your .env file.")
+# Several named instances behind one server: SERVICENOW_INSTANCES="dev,test,prod" plus
+# SERVICENOW_<NAME>_INSTANCE, _USERNAME, _PASSWORD (and optionally _RATE_LIMIT) for each.
+# Credentials fall back to SERVICENOW_USERNAME/PASSWORD. Without the list, the three
+# variables above form a single instance named "default".
+SERVICENOW_INSTANCE_NAMES = [n.strip() for n in os.getenv("SERVICENOW_INSTANCES", "").split(",") if n.strip()]
+SERVICENOW_DEFAULT_INSTANCE = os.getenv("SERVICENOW_DEFAULT_INSTANCE") or (SERVICENOW_INSTANCE_NAMES[0] if SERVICENOW_INSTANCE_NAMES else "default")
+INSTANCE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]*$")
+
+def instance_variable(name: str, setting: str) -> str:
+    """Environment variable of a per-instance setting, e.g. SERVICENOW_PROD_EU_INSTANCE for "prod-eu"."""
+    return f"SERVICENOW_{re.sub(r'[^A-Za-z0-9]', '_', name).upper()}_{setting}"
+
+def load_instance_settings() -> Dict[str, Dict[str, Optional[str]]]:
+    """URL, credentials and rate limit override of every configured instance, by name."""
+    if not SERVICENOW_INSTANCE_NAMES:
+        if not all([SERVICENOW_INSTANCE, SERVICENOW_USERNAME, SERVICENOW_PASSWORD]):
+            raise RuntimeError("Please set SERVICENOW_INSTANCE, SERVICENOW_USERNAME, and SERVICENOW_PASSWORD in your .env file.")
+        return {"default": {"url": SERVICENOW_INSTANCE, "username": SERVICENOW_USERNAME, "password": SERVICENOW_PASSWORD, "rate_limit": None}}
+    settings, missing = {}, []
+    for name in SERVICENOW_INSTANCE_NAMES:
+        if not INSTANCE_NAME_PATTERN.match(name):
+            raise RuntimeError(f"Invalid instance name in SERVICENOW_INSTANCES: {name!r}")
+        settings[name] = {
+            "url": os.getenv(instance_variable(name, "INSTANCE")),
+            "username": os.getenv(instance_variable(name, "USERNAME")) or SERVICENOW_USERNAME,
+            "password": os.getenv(instance_variable(name, "PASSWORD")) or SERVICENOW_PASSWORD,
+            "rate_limit": os.getenv(instance_variable(name, "RATE_LIMIT")),
+        }
+        missing += [instance_variable(name, setting) for key, setting in (("url", "INSTANCE"), ("username", "USERNAME"), ("password", "PASSWORD"))
+                    if not settings[name][key]]
+    if missing:
+        raise RuntimeError(f"Please set {', '.join(missing)} for the instances in SERVICENOW_INSTANCES.")
+    if SERVICENOW_DEFAULT_INSTANCE not in settings:
+        raise RuntimeError(f"SERVICENOW_DEFAULT_INSTANCE {SERVICENOW_DEFAULT_INSTANCE!r} is not listed in SERVICENOW_INSTANCES.")
+    return settings
+
+SERVICENOW_INSTANCE_SETTINGS = load_instance_settings()
+
+def env_bool(name: str, default: bool = False) -> bool:
+    """Read a boolean flag from the environment ("1", "true", "yes", "on")."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Upstream connection pool settings
+SERVICENOW_HTTP2 = env_bool("SERVICENOW_HTTP2")
+SERVICENOW_MAX_CONNECTIONS = int(os.getenv("SERVICENOW_MAX_CONNECTIONS", "100"))
+SERVICENOW_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("SERVICENOW_MAX_KEEPALIVE_CONNECTIONS", "20"))
+SERVICENOW_KEEPALIVE_EXPIRY = float(os.getenv("SERVICENOW_KEEPALIVE_EXPIRY", "30"))
+SERVICENOW_TIMEOUT = float(os.getenv("SERVICENOW_TIMEOUT", "30"))
+SERVICENOW_CONNECT_TIMEOUT = float(os.getenv("SERVICENOW_CONNECT_TIMEOUT", "10"))
+SERVICENOW_POOL_TIMEOUT = float(os.getenv("SERVICENOW_POOL_TIMEOUT", "10"))
+
+# Prometheus-style metrics and the timing middleware that feeds them
+SERVICENOW_METRICS_ENABLED = env_bool("SERVICENOW_METRICS_ENABLED", True)
+
+# Client-side rate limiting (requests/second) and retries
+SERVICENOW_RATE_LIMIT_ENABLED = env_bool("SERVICENOW_RATE_LIMIT_ENABLED", True)
+SERVICENOW_RATE_LIMIT = float(os.getenv("SERVICENOW_RATE_LIMIT", "50"))
+SERVICENOW_RATE_LIMIT_MIN = float(os.getenv("SERVICENOW_RATE_LIMIT_MIN", "1"))
+SERVICENOW_RATE_LIMIT_MAX = float(os.getenv("SERVICENOW_RATE_LIMIT_MAX", "200"))
+SERVICENOW_RATE_LIMIT_BURST = float(os.getenv("SERVICENOW_RATE_LIMIT_BURST", "50"))
+SERVICENOW_RETRY_ATTEMPTS = int(os.getenv("SERVICENOW_RETRY_ATTEMPTS", "3"))
+SERVICENOW_RETRY_BASE_DELAY = float(os.getenv("SERVICENOW_RETRY_BASE_DELAY", "0.2"))
+SERVICENOW_RETRY_MAX_DELAY = float(os.getenv("SERVICENOW_RETRY_MAX_DELAY", "10"))
+SERVICENOW_RETRY_BUDGET_RATIO = float(os.getenv("SERVICENOW_RETRY_BUDGET_RATIO", "0.2"))
+
+# Response cache settings
+SERVICENOW_CACHE_ENABLED = env_bool("SERVICENOW_CACHE_ENABLED", True)
+SERVICENOW_CACHE_MAX_ENTRIES = int(os.getenv("SERVICENOW_CACHE_MAX_ENTRIES", "2048"))
+SERVICENOW_CACHE_MAX_BYTES = int(os.getenv("SERVICENOW_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SERVICENOW_CACHE_DEFAULT_TTL = float(os.getenv("SERVICENOW_CACHE_DEFAULT_TTL", "30"))
+# Where cached responses live: "memory" (each process its own) or "redis" (shared by every worker)
+SERVICENOW_CACHE_BACKEND = os.getenv("SERVICENOW_CACHE_BACKEND", "memory").strip().lower()
+SERVICENOW_CACHE_REDIS_URL = os.getenv("SERVICENOW_CACHE_REDIS_URL", "redis://localhost:6379/0")
+SERVICENOW_CACHE_REDIS_PREFIX = os.getenv("SERVICENOW_CACHE_REDIS_PREFIX", "servicenow:")
+SERVICENOW_CACHE_NEAR_TTL = float(os.getenv("SERVICENOW_CACHE_NEAR_TTL", "2"))
+SERVICENOW_CACHE_STALE_TTL = float(os.getenv("SERVICENOW_CACHE_STALE_TTL", "300"))
+
+# Share one upstream call between identical concurrent requests
+SERVICENOW_COALESCE_REQUESTS = env_bool("SERVICENOW_COALESCE_REQUESTS", True)
+
+# Streaming (NDJSON) list settings
+SERVICENOW_STREAM_PAGE_SIZE = int(os.getenv("SERVICENOW_STREAM_PAGE_SIZE", "1000"))
+SERVICENOW_STREAM_PREFETCH_PAGES = int(os.getenv("SERVICENOW_STREAM_PREFETCH_PAGES", "4"))
+
+# Local SQLite read replica of hot tables
+SERVICENOW_REPLICA_ENABLED = env_bool("SERVICENOW_REPLICA_ENABLED")
+SERVICENOW_REPLICA_PATH = os.getenv("SERVICENOW_REPLICA_PATH", "servicenow_replica.db")
+SERVICENOW_REPLICA_TABLES = [t.strip() for t in os.getenv("SERVICENOW_REPLICA_TABLES", "incident,task,sys_user,cmdb_ci").split(",") if t.strip()]
+SERVICENOW_REPLICA_SYNC_INTERVAL = float(os.getenv("SERVICENOW_REPLICA_SYNC_INTERVAL", "60"))
+SERVICENOW_REPLICA_MAX_STALENESS = float(os.getenv("SERVICENOW_REPLICA_MAX_STALENESS", "120"))
+SERVICENOW_REPLICA_PAGE_SIZE = int(os.getenv("SERVICENOW_REPLICA_PAGE_SIZE", "1000"))
+SERVICENOW_REPLICA_RECONCILE_INTERVAL = float(os.getenv("SERVICENOW_REPLICA_RECONCILE_INTERVAL", "300"))
+
+# JSON handling: orjson when installed, and optionally pass list bodies through undecoded
+SERVICENOW_ORJSON_ENABLED = env_bool("SERVICENOW_ORJSON_ENABLED", True)
+SERVICENOW_RAW_PASSTHROUGH = env_bool("SERVICENOW_RAW_PASSTHROUGH")
+
+# Response compression and ETags toward clients
+SERVICENOW_COMPRESSION_ENABLED = env_bool("SERVICENOW_COMPRESSION_ENABLED", True)
+SERVICENOW_COMPRESSION_MIN_SIZE = int(os.getenv("SERVICENOW_COMPRESSION_MIN_SIZE", "1024"))
+SERVICENOW_COMPRESSION_ENCODINGS = [e.strip() for e in os.getenv("SERVICENOW_COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if e.strip()]
+SERVICENOW_ETAGS_ENABLED = env_bool("SERVICENOW_ETAGS_ENABLED", True)
+
+# Change subscriptions (GET /subscribe)
+SERVICENOW_SUBSCRIBE_POLL_INTERVAL = float(os.getenv("SERVICENOW_SUBSCRIBE_POLL_INTERVAL", "5"))
+SERVICENOW_SUBSCRIBE_PAGE_SIZE = int(os.getenv("SERVICENOW_SUBSCRIBE_PAGE_SIZE", "500"))
+SERVICENOW_SUBSCRIBE_QUEUE_SIZE = int(os.getenv("SERVICENOW_SUBSCRIBE_QUEUE_SIZE", "100"))
+SERVICENOW_SUBSCRIBE_HEARTBEAT = float(os.getenv("SERVICENOW_SUBSCRIBE_HEARTBEAT", "15"))
+
+# Batch tool execution settings
+SERVICENOW_BATCH_CONCURRENCY = int(os.getenv("SERVICENOW_BATCH_CONCURRENCY", "10"))
+SERVICENOW_BATCH_MAX_CALLS = int(os.getenv("SERVICENOW_BATCH_MAX_CALLS", "200"))
+
+# Record graph expansion (GET /expand/{table}/{sys_id})
+SERVICENOW_EXPAND_MAX_DEPTH = int(os.getenv("SERVICENOW_EXPAND_MAX_DEPTH", "3"))
+SERVICENOW_EXPAND_MAX_NODES = int(os.getenv("SERVICENOW_EXPAND_MAX_NODES", "200"))
+SERVICENOW_EXPAND_RELATED_LIMIT = int(os.getenv("SERVICENOW_EXPAND_RELATED_LIMIT", "50"))
+
+# Aggregates (GET /aggregate/{table}) through the Stats API; short-lived in the cache
+SERVICENOW_AGGREGATE_CACHE_TTL = float(os.getenv("SERVICENOW_AGGREGATE_CACHE_TTL", "10"))
+
+# Per-call instance routing and startup health checks
+SERVICENOW_INSTANCE_HEADER = os.getenv("SERVICENOW_INSTANCE_HEADER", "X-ServiceNow-Instance")
+SERVICENOW_INSTANCE_PARAM = os.getenv("SERVICENOW_INSTANCE_PARAM", "instance")
+SERVICENOW_HEALTH_CHECK_ON_STARTUP = env_bool("SERVICENOW_HEALTH_CHECK_ON_STARTUP", True)
+SERVICENOW_HEALTH_CHECK_TIMEOUT = float(os.getenv("SERVICENOW_HEALTH_CHECK_TIMEOUT", "5"))
+
+# --- Table tool registry ---
+
+@dataclass(frozen=True)
+class TableTool:
+    """A ServiceNow table exposed as a list tool and, optionally, a detail tool.
+
+    Routes and /resources metadata are generated from these specs; ``cache_ttl``
+    is the table's response cache policy in seconds (0 disables caching).
+    """
+    table: str
+    list_tool: str
+    list_path: str
+    list_summary: str
+    list_description: str
+    detail_tool: Optional[str] = None
+    detail_path: Optional[str] = None
+    detail_summary: Optional[str] = None
+    detail_description: Optional[str] = None
+    lookup_key: str = "sys_id"
+    lookup_description: str = "Record sys_id"
+    not_found: str = "Record not found."
+    default_limit: int = 10
+    default_fields: Optional[str] = None
+    cache_ttl: Optional[float] = None
+
+    @property
+    def detail_param(self) -> str:
+        return self.detail_path.rsplit("{", 1)[1].rstrip("}")
+
+TABLE_TOOLS = [
+    TableTool(
+        table="incident", list_tool="list_incidents", list_path="/incidents", list_summary="List incidents",
+        list_description="List recent incidents (with optional query and limit)",
+        detail_tool="get_incident", detail_path="/incident/{incident_number}", detail_summary="Get incident details",
+        detail_description="Get details for a specific incident by number",
+        lookup_key="number", lookup_description="Incident number", not_found="Incident not found.", cache_ttl=5,
+    ),
+    TableTool(
+        table="sys_user", list_tool="list_users", list_path="/users", list_summary="List users",
+        list_description="List users (with optional query and limit)", cache_ttl=300,
+    ),
+    TableTool(
+        table="sys_db_object", list_tool="list_tables", list_path="/tables", list_summary="List available tables",
+        list_description="List available tables in ServiceNow", default_limit=20, cache_ttl=3600,
+    ),
+    TableTool(
+        table="kb_knowledge", list_tool="list_knowledge_articles", list_path="/knowledge-articles", list_summary="List knowledge articles",
+        list_description="List knowledge base articles",
+        detail_tool="get_knowledge_article", detail_path="/knowledge-article/{article_id}", detail_summary="Get knowledge article details",
+        detail_description="Get details for a specific knowledge article",
+        lookup_description="Knowledge article sys_id", not_found="Knowledge article not found.", cache_ttl=300,
+    ),
+    TableTool(
+        table="sys_user_group", list_tool="list_groups", list_path="/groups", list_summary="List groups",
+        list_description="List user groups",
+        detail_tool="get_group", detail_path="/group/{group_id}", detail_summary="Get group details",
+        detail_description="Get details for a specific group",
+        lookup_description="Group sys_id", not_found="Group not found.", cache_ttl=900,
+    ),
+    TableTool(
+        table="sc_cat_item", list_tool="list_catalog_items", list_path="/catalog-items", list_summary="List catalog items",
+        list_description="List service catalog items",
+        detail_tool="get_catalog_item", detail_path="/catalog-item/{item_id}", detail_summary="Get catalog item details",
+        detail_description="Get details for a specific catalog item",
+        lookup_description="Catalog item sys_id", not_found="Catalog item not found.", cache_ttl=900,
+    ),
+    TableTool(
+        table="sc_request", list_tool="list_requests", list_path="/requests", list_summary="List requests",
+        list_description="List service requests",
+        detail_tool="get_request", detail_path="/request/{request_id}", detail_summary="Get request details",
+        detail_description="Get details for a specific service request",
+        lookup_description="Request sys_id", not_found="Request not found.", cache_ttl=5,
+    ),
+    TableTool(
+        table="sc_req_item", list_tool="list_requested_items", list_path="/requested-items", list_summary="List requested items (RITMs)",
+        list_description="List requested items (RITMs)",
+        detail_tool="get_requested_item", detail_path="/requested-item/{ritm_id}", detail_summary="Get requested item details",
+        detail_description="Get details for a specific requested item",
+        lookup_description="Requested item sys_id", not_found="Requested item not found.", cache_ttl=5,
+    ),
+    TableTool(
+        table="change_request", list_tool="list_change_requests", list_path="/change-requests", list_summary="List change requests",
+        list_description="List change requests",
+        detail_tool="get_change_request", detail_path="/change-request/{change_id}", detail_summary="Get change request details",
+        detail_description="Get details for a specific change request",
+        lookup_description="Change request sys_id", not_found="Change request not found.", cache_ttl=5,
+    ),
+    TableTool(
+        table="task", list_tool="list_tasks", list_path="/tasks", list_summary="List tasks",
+        list_description="List tasks",
+        detail_tool="get_task", detail_path="/task/{task_id}", detail_summary="Get task details",
+        detail_description="Get details for a specific task",
+        lookup_description="Task sys_id", not_found="Task not found.", cache_ttl=5,
+    ),
+    TableTool(
+        table="problem", list_tool="list_problems", list_path="/problems", list_summary="List problems",
+        list_description="List problem records",
+        detail_tool="get_problem", detail_path="/problem/{problem_id}", detail_summary="Get problem details",
+        detail_description="Get details for a specific problem record",
+        lookup_description="Problem sys_id", not_found="Problem not found.", cache_ttl=5,
+    ),
+    TableTool(
+        table="alm_asset", list_tool="list_assets", list_path="/assets", list_summary="List assets",
+        list_description="List assets",
+        detail_tool="get_asset", detail_path="/asset/{asset_id}", detail_summary="Get asset details",
+        detail_description="Get details for a specific asset",
+        lookup_description="Asset sys_id", not_found="Asset not found.", cache_ttl=120,
+    ),
+    TableTool(
+        table="cmdb_ci", list_tool="list_cmdb_items", list_path="/cmdb-items", list_summary="List configuration items (CIs)",
+        list_description="List configuration items (CIs) from the CMDB",
+        detail_tool="get_cmdb_item", detail_path="/cmdb-item/{ci_id}", detail_summary="Get configuration item details",
+        detail_description="Get details for a specific configuration item",
+        lookup_description="Configuration item sys_id", not_found="Configuration item not found.", cache_ttl=120,
+    ),
+    TableTool(
+        table="sys_audit", list_tool="list_audit_records", list_path="/audit-records", list_summary="List audit records",
+        list_description="List audit records", cache_ttl=0,
+    ),
+    TableTool(
+        table="syslog", list_tool="list_system_logs", list_path="/system-logs", list_summary="List system logs",
+        list_description="List system logs", cache_ttl=0,
+    ),
+]
+
+# Seconds to keep responses for each table; 0 means never cache. Tables without
+# a tool of their own are listed here, the rest come from TABLE_TOOLS.
+CACHE_TTL_BY_TABLE: Dict[str, float] = {
+    "sys_dictionary": 3600,
+    **{tool.table: tool.cache_ttl for tool in TABLE_TOOLS if tool.cache_ttl is not None},
+}
+
+def parse_table_ttls(value: str) -> Dict[str, float]:
+    """Parse "table=seconds,table=seconds" overrides from SERVICENOW_CACHE_TTLS."""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        table, _, seconds = item.partition("=")
+        ttls[table.strip()] = float(seconds)
+    return ttls
+
+CACHE_TTL_BY_TABLE.update(parse_table_ttls(os.getenv("SERVICENOW_CACHE_TTLS", "")))
+
+# --- Shared upstream HTTP client ---
+
+def create_http_client(username: str, password: str) -> httpx.AsyncClient:
+    """Build the pooled client used for every call to one ServiceNow instance."""
+    if SERVICENOW_HTTP2 and importlib.util.find_spec("h2") is None:
+        raise RuntimeError("SERVICENOW_HTTP2 is enabled but the 'h2' package is not installed (pip install 'httpx[http2]').")
+    limits = httpx.Limits(
+        max_connections=SERVICENOW_MAX_CONNECTIONS,
+        max_keepalive_connections=SERVICENOW_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=SERVICENOW_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(SERVICENOW_TIMEOUT, connect=SERVICENOW_CONNECT_TIMEOUT, pool=SERVICENOW_POOL_TIMEOUT)
+    return httpx.AsyncClient(
+        auth=(username, password),
+        headers={"Accept": "application/json"},
+        http2=SERVICENOW_HTTP2,
+        limits=limits,
+        timeout=timeout,
+    )
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the pooled client of the instance the current call is routed to, creating it on first use."""
+    return get_instance().get_client()
+
+async def close_http_clients():
+    for instance in servicenow_instances.values():
+        await instance.close()
+
+def get_pool_stats(instance: "ServiceNowInstance" = None) -> Dict[str, Any]:
+    """Summarize request counters and the state of one instance's pooled upstream connections."""
+    instance = instance or get_instance()
+    stats: Dict[str, Any] = {
+        "instance": instance.name,
+        **instance.pool_counters,
+        "http2": SERVICENOW_HTTP2,
+        "max_connections": SERVICENOW_MAX_CONNECTIONS,
+        "max_keepalive_connections": SERVICENOW_MAX_KEEPALIVE_CONNECTIONS,
+        "keepalive_expiry": SERVICENOW_KEEPALIVE_EXPIRY,
+        "connections": {"total": 0, "idle": 0, "active": 0, "http2": 0},
+        "coalescing": {**coalesce_counters, "pending": len(inflight_requests)},
+    }
+    # httpx does not expose pool state publicly, so peek at the httpcore pool when it is there
+    pool = getattr(getattr(instance.client, "_transport", None), "_pool", None)
+    for connection in getattr(pool, "connections", []):
+        stats["connections"]["total"] += 1
+        if connection.is_idle():
+            stats["connections"]["idle"] += 1
+        else:
+            stats["connections"]["active"] += 1
+        if "HTTP/2" in connection.info():
+            stats["connections"]["http2"] += 1
+    return stats
+
+# --- Metrics ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+def format_labels(labelnames: Tuple[str, ...], labels: Tuple) -> str:
+    if not labelnames:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labelnames, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, format_labels(self.labelnames, labels), value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return lines
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, labels: Tuple = (), value: float = 0):
+        self.values[labels] = value
+
+class Histogram(Counter):
+    """Fixed-bucket histogram; bucket counts are kept per bucket and made cumulative on render."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        self.series: Dict[Tuple, List] = {}
+
+    def observe(self, labels: Tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", format_labels((*self.labelnames, "le"), (*labels, bound)), cumulative
+            yield f"{self.name}_sum", format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", format_labels(self.labelnames, labels), count
+
+TOOL_REQUESTS = Counter("mcp_tool_requests_total", "Tool requests handled, by tool and HTTP status.", ("tool", "status"))
+TOOL_LATENCY = Histogram("mcp_tool_request_duration_seconds", "Tool request latency in seconds.", ("tool",))
+TOOL_RESPONSE_BYTES = Histogram("mcp_tool_response_bytes", "Tool response body size in bytes.", ("tool",), SIZE_BUCKETS)
+# Unlabelled: the route, and so the tool, is only known once the request has been routed
+TOOL_IN_FLIGHT = Gauge("mcp_tool_requests_in_flight", "Tool requests currently being handled, across all tools.")
+UPSTREAM_REQUESTS = Counter("servicenow_upstream_requests_total", "ServiceNow calls, by instance, table and HTTP status (\"error\" for transport failures).", ("instance", "table", "status"))
+UPSTREAM_LATENCY = Histogram("servicenow_upstream_duration_seconds", "ServiceNow call latency in seconds, including retries.", ("instance", "table"))
+UPSTREAM_RESPONSE_BYTES = Histogram("servicenow_upstream_response_bytes", "ServiceNow response body size in bytes.", ("instance", "table"), SIZE_BUCKETS)
+SUBSCRIBERS = Gauge("mcp_subscribers", "Open /subscribe streams, by table.", ("table",))
+SUBSCRIPTION_POLLS = Counter("mcp_subscription_polls_total", "Shared subscription polls, by table and outcome.", ("table", "outcome"))
+SUBSCRIPTION_POLL_LATENCY = Histogram("mcp_subscription_poll_duration_seconds", "Time spent fetching changes per subscription poll.", ("table",))
+SUBSCRIPTION_POLL_ROWS = Counter("mcp_subscription_poll_rows_total", "Changed rows fetched by subscription polls.", ("table",))
+SUBSCRIPTION_EVENTS = Counter("mcp_subscription_events_total", "Change events queued for subscribers.", ("table",))
+SUBSCRIPTION_OVERFLOWS = Counter("mcp_subscription_overflows_total", "Subscribers disconnected for falling behind.", ("table",))
+METRICS = [TOOL_REQUESTS, TOOL_LATENCY, TOOL_RESPONSE_BYTES, TOOL_IN_FLIGHT, UPSTREAM_REQUESTS, UPSTREAM_LATENCY, UPSTREAM_RESPONSE_BYTES,
+           SUBSCRIBERS, SUBSCRIPTION_POLLS, SUBSCRIPTION_POLL_LATENCY, SUBSCRIPTION_POLL_ROWS, SUBSCRIPTION_EVENTS, SUBSCRIPTION_OVERFLOWS]
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording per-tool counts, latency, response size and in-flight requests.
+
+    The tool label is the name of the matched FastAPI route, so label
+    cardinality stays bounded whatever the path parameters are.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        response = {"status": 500, "bytes": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        TOOL_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            TOOL_IN_FLIGHT.inc(amount=-1)
+            route = scope.get("route")
+            tool = (getattr(route, "name", None) or "unmatched",)
+            TOOL_REQUESTS.inc((tool[0], str(response["status"])))
+            TOOL_LATENCY.observe(tool, time.perf_counter() - start)
+            TOOL_RESPONSE_BYTES.observe(tool, response["bytes"])
+
+def render_metrics() -> str:
+    """Render all metrics plus point-in-time gauges for the cache and each instance's pool, rate limiter and health."""
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    snapshots: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {"servicenow_cache": [("", cache_backend.stats())]}
+    for name, instance in servicenow_instances.items():
+        labels = format_labels(("instance",), (name,))
+        snapshots.setdefault("servicenow_pool", []).append((labels, get_pool_stats(instance)))
+        snapshots.setdefault("servicenow_rate_limiter", []).append((labels, instance.rate_limiter.stats()))
+        if "ok" in instance.health:
+            snapshots.setdefault("servicenow_instance", []).append((labels, {"up": int(instance.health["ok"])}))
+    for prefix, samples in snapshots.items():
+        # The text format wants every sample of a metric right after its TYPE line
+        gauges: Dict[str, List[str]] = {}
+        for labels, stats in samples:
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges.setdefault(key, []).append(f"{prefix}_{key}{labels} {value}")
+        for key, samples_text in gauges.items():
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.extend(samples_text)
+    return "\n".join(lines) + "\n"
+
+# --- JSON encoding ---
+
+USE_ORJSON = SERVICENOW_ORJSON_ENABLED and importlib.util.find_spec("orjson") is not None
+if USE_ORJSON:
+    import orjson
+
+def json_loads(data: bytes) -> Any:
+    return orjson.loads(data) if USE_ORJSON else json.loads(data)
+
+def json_dumps(value: Any) -> bytes:
+    return orjson.dumps(value) if USE_ORJSON else json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    """Default response class, rendered with json_dumps (orjson when available)."""
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+RESULT_PREFIX = b'{"result":'
+
+def slice_result(body: bytes) -> bytes:
+    """Cut the ``result`` array out of a Table API body without decoding it.
+
+    A successful Table API call always answers ``{"result":[...]}``, so only the
+    envelope is checked; a body framed any other way is decoded and re-encoded.
+    """
+    body = body.strip()
+    if body.startswith(RESULT_PREFIX) and body.endswith(b"}"):
+        result = body[len(RESULT_PREFIX):-1].strip()
+        if result.startswith(b"[") and result.endswith(b"]"):
+            return result
+    return json_dumps(json_loads(body)["result"])
+
+# --- Compression and conditional requests ---
+
+if importlib.util.find_spec("brotli") is not None:
+    import brotli
+if importlib.util.find_spec("zstandard") is not None:
+    import zstandard
+
+ENCODING_MODULES = {"gzip": "zlib", "br": "brotli", "zstd": "zstandard"}
+COMPRESSION_LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+ETAG_ENCODING_SUFFIX = re.compile(r'-(?:gzip|br|zstd)"$')
+
+# Encodings we can produce, in server preference order
+AVAILABLE_ENCODINGS = [
+    encoding for encoding in SERVICENOW_COMPRESSION_ENCODINGS
+    if encoding in ENCODING_MODULES and importlib.util.find_spec(ENCODING_MODULES[encoding]) is not None
+]
+
+# If-None-Match of the current GET, so handlers can answer 304 before serializing anything
+request_if_none_match: ContextVar[Optional[str]] = ContextVar("request_if_none_match", default=None)
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick our most preferred encoding that the client accepts with a non-zero q-value."""
+    if not accept_encoding:
+        return None
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in AVAILABLE_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(encoding: str, body: bytes) -> bytes:
+    level = COMPRESSION_LEVELS[encoding]
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+class StreamEncoder:
+    """Incremental compressor that flushes after every chunk so streamed lines reach the client promptly."""
+
+    def __init__(self, encoding: str):
+        level = COMPRESSION_LEVELS[encoding]
+        if encoding == "gzip":
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self.compress = lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+        elif encoding == "br":
+            compressor = brotli.Compressor(quality=level)
+            self.compress = lambda data: compressor.process(data) + compressor.flush()
+            self.finish = compressor.finish
+        else:
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.compress = lambda data: compressor.compress(data) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            self.finish = compressor.flush
+
+def body_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison, ignoring the per-encoding suffix we add to compressed representations."""
+    if not if_none_match:
+        return False
+    etag = ETAG_ENCODING_SUFFIX.sub('"', etag)
+    candidates = [ETAG_ENCODING_SUFFIX.sub('"', tag.strip().removeprefix("W/")) for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def record_etag(table: str, record: Dict[str, Any], projection: Dict[str, Any]) -> Optional[str]:
+    """ETag for a detail record from its version fields, or None if the projection left them out."""
+    sys_id, updated, mod_count = (cell_text(record.get(f)) for f in ("sys_id", "sys_updated_on", "sys_mod_count"))
+    if not (sys_id and updated and mod_count):
+        return None
+    version = repr((table, sys_id, updated, mod_count, sorted(projection.items()))).encode()
+    return f'"r-{hashlib.blake2b(version, digest_size=16).hexdigest()}"'
+
+def record_response(table: str, record: Dict[str, Any], projection: Dict[str, Any]):
+    """Return a detail record with its version ETag, or a bare 304 when the client already has it."""
+    etag = record_etag(table, record, projection) if SERVICENOW_ETAGS_ENABLED else None
+    if etag is None:
+        return record
+    if etag_matches(request_if_none_match.get(), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return FastJSONResponse(record, headers={"ETag": etag})
+
+class ConditionalCompressionMiddleware:
+    """Pure ASGI middleware adding ETags, answering If-None-Match with 304 and compressing responses.
+
+    Complete bodies get a content hash ETag (unless the handler set one) and
+    are compressed once they reach SERVICENOW_COMPRESSION_MIN_SIZE. Streamed
+    bodies are compressed chunk by chunk and carry no ETag.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        is_get = scope["method"] == "GET"
+        if_none_match = request_headers.get("if-none-match") if is_get else None
+        encoding = negotiate_encoding(request_headers.get("accept-encoding")) if SERVICENOW_COMPRESSION_ENABLED else None
+        state: Dict[str, Any] = {"start": None, "encoder": None}
+
+        def compressible(headers: MutableHeaders) -> bool:
+            content_type = headers.get("content-type", "")
+            return "content-encoding" not in headers and any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+        async def send_complete(start, body: bytes):
+            headers = MutableHeaders(raw=list(start["headers"]))
+            status = start["status"]
+            if status == 200 and is_get:
+                etag = headers.get("etag")
+                if etag is None and SERVICENOW_ETAGS_ENABLED:
+                    etag = headers["ETag"] = body_etag(body)
+                if etag is not None and etag_matches(if_none_match, etag):
+                    headers = MutableHeaders(raw=[(k, v) for k, v in headers.raw if k.lower() in (b"etag", b"cache-control", b"vary")])
+                    await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+            if SERVICENOW_COMPRESSION_ENABLED and status not in (204, 304) and compressible(headers):
+                headers.add_vary_header("Accept-Encoding")
+                if encoding is not None and len(body) >= SERVICENOW_COMPRESSION_MIN_SIZE:
+                    body = compress_body(encoding, body)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    if "etag" in headers and headers["etag"].endswith('"'):
+                        headers["ETag"] = f'{headers["etag"][:-1]}-{encoding}"'
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": body})
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            start, state["start"] = state["start"], None
+            if start is not None:
+                if not more_body:
+                    await send_complete(start, body)
+                    return
+                headers = MutableHeaders(raw=list(start["headers"]))
+                if encoding is not None and compressible(headers):
+                    state["encoder"] = StreamEncoder(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                await send({**start, "headers": headers.raw})
+            encoder = state["encoder"]
+            if encoder is not None:
+                body = encoder.compress(body) + (b"" if more_body else encoder.finish())
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        token = request_if_none_match.set(if_none_match)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_if_none_match.reset(token)
+
+# --- Instance routing ---
+
+# The instance serving the current call; None outside a request means the default instance
+current_instance: ContextVar[Optional["ServiceNowInstance"]] = ContextVar("current_instance", default=None)
+
+def get_instance() -> "ServiceNowInstance":
+    return current_instance.get() or servicenow_instances[SERVICENOW_DEFAULT_INSTANCE]
+
+class InstanceRoutingMiddleware:
+    """Pure ASGI middleware routing each call to the instance named by the instance parameter or header.
+
+    The query parameter wins over the header; calls naming neither go to
+    SERVICENOW_DEFAULT_INSTANCE, and unknown names get a 400.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        name = params.get(SERVICENOW_INSTANCE_PARAM) or Headers(scope=scope).get(SERVICENOW_INSTANCE_HEADER)
+        if not name:
+            await self.app(scope, receive, send)
+            return
+        instance = servicenow_instances.get(name)
+        if instance is None:
+            detail = f"Unknown ServiceNow instance: {name}. Configured: {', '.join(servicenow_instances)}."
+            await JSONResponse({"detail": detail}, status_code=400)(scope, receive, send)
+            return
+        token = current_instance.set(instance)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_instance.reset(token)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for instance in servicenow_instances.values():
+        instance.get_client()
+    get_prompt_router()
+    await cache_backend.start()
+    if SERVICENOW_HEALTH_CHECK_ON_STARTUP:
+        await check_instances()
+    if SERVICENOW_REPLICA_ENABLED:
+        start_replica()
+    try:
+        yield
+    finally:
+        await stop_pollers()
+        await stop_replica()
+        await close_http_clients()
+        await cache_backend.close()
+
+app = FastAPI(title="ServiceNow MCP Server", lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(InstanceRoutingMiddleware)
+# Added before the metrics middleware so it sits inside it, which then counts compressed bytes
+if SERVICENOW_COMPRESSION_ENABLED or SERVICENOW_ETAGS_ENABLED:
+    app.add_middleware(ConditionalCompressionMiddleware)
+if SERVICENOW_METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# --- Response cache ---
+
+# Table and Stats API endpoints; both are cached and invalidated under their table
+TABLE_ENDPOINT_PATTERN = re.compile(r"^/api/now/(?:table|stats)/([^/?]+)")
+STATS_API_PATH = "/api/now/stats/"
+
+def table_from_endpoint(endpoint: str) -> Optional[str]:
+    match = TABLE_ENDPOINT_PATTERN.match(endpoint)
+    return match.group(1) if match else None
 
-app = FastAPI(title="ServiceNow MCP Server")
+def cache_ttl(table: Optional[str], endpoint: str = "") -> float:
+    if not SERVICENOW_CACHE_ENABLED:
+        return 0
+    if endpoint.startswith(STATS_API_PATH):
+        return SERVICENOW_AGGREGATE_CACHE_TTL
+    return CACHE_TTL_BY_TABLE.get(table, SERVICENOW_CACHE_DEFAULT_TTL)
+
+def cache_key(endpoint: str, params: dict = None) -> str:
+    """Normalize an endpoint plus params so equivalent requests share a key, namespaced by the current instance."""
+    path, _, query = endpoint.partition("?")
+    items = parse_qsl(query, keep_blank_values=True)
+    items.extend((str(k), str(v)) for k, v in (params or {}).items() if v is not None)
+    items = [(k, canonical_query(v)) if k == "sysparm_query" else (k, v) for k, v in items]
+    return f"{get_instance().cache_namespace}{path}?{urlencode(sorted(items))}"
+
+class ResponseCache:
+    """In-process TTL cache with LRU eviction bounded by entry count and byte size.
+
+    Entries stored with upstream validators (ETag / Last-Modified) outlive
+    their TTL until evicted, so they can be revalidated with a conditional GET.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Tuple[float, Optional[str], int, Any, Optional[Dict[str, str]]]]" = OrderedDict()
+        self.bytes = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0, "revalidations": 0}
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        expires_at, _, _, value, validators = entry
+        if expires_at <= time.monotonic():
+            if not validators:
+                self._remove(key)
+            self.counters["expirations"] += 1
+            self.counters["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return value
+
+    def set(self, key: str, table: Optional[str], value: Any, size: int, ttl: float, validators: Dict[str, str] = None):
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + ttl, table, size, value, validators or None)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.counters["evictions"] += 1
+
+    def invalidate(self, table: str = None, namespace: str = "") -> int:
+        """Drop every entry for ``table`` (or everything when no table is given) under a key namespace."""
+        keys = [key for key, entry in self.entries.items() if (table is None or entry[1] == table) and key.startswith(namespace)]
+        for key in keys:
+            self._remove(key)
+        self.counters["invalidations"] += len(keys)
+        return len(keys)
+
+    def stale(self, key: str) -> Optional[Tuple[Any, Dict[str, str]]]:
+        """Value and upstream validators of an entry, expired or not, for a conditional refetch."""
+        entry = self.entries.get(key)
+        if entry is None or not entry[4]:
+            return None
+        return entry[3], entry[4]
+
+    def refresh(self, key: str, ttl: float):
+        """Start a new TTL for an entry the upstream confirmed unchanged (304)."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries[key] = (time.monotonic() + ttl, *entry[1:])
+            self.entries.move_to_end(key)
+            self.counters["revalidations"] += 1
+
+    def _remove(self, key: str):
+        size = self.entries.pop(key)[2]
+        self.bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+response_cache = ResponseCache(SERVICENOW_CACHE_MAX_ENTRIES, SERVICENOW_CACHE_MAX_BYTES)
+
+class CacheBackend(ABC):
+    """Where servicenow_get keeps responses; async so an out-of-process store fits behind the same calls."""
+
+    name = "base"
+
+    async def start(self):
+        """Called from the lifespan hook before the first request."""
+
+    async def close(self):
+        """Called on shutdown."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        """The live value for ``key``, or None when it is missing or expired."""
+
+    @abstractmethod
+    async def set(self, key: str, table: Optional[str], value: Any, size: int, ttl: float, validators: Dict[str, str] = None):
+        """Store ``value`` for ``ttl`` seconds, tagged with its table and upstream validators."""
+
+    @abstractmethod
+    async def stale(self, key: str) -> Optional[Tuple[Any, Dict[str, str]]]:
+        """An expired value and its validators, kept for conditional revalidation."""
+
+    @abstractmethod
+    async def refresh(self, key: str, ttl: float):
+        """Restart an entry's TTL after the instance answered ``304 Not Modified``."""
+
+    @abstractmethod
+    async def invalidate(self, table: str = None, namespace: str = "") -> int:
+        """Drop one table's entries (or all) within an instance namespace; returns how many went."""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Counters for /admin/cache-stats."""
+
+class MemoryCacheBackend(CacheBackend):
+    """A ResponseCache in this process; with several workers each one keeps its own."""
+
+    name = "memory"
+
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+
+    async def get(self, key: str) -> Any:
+        return self.cache.get(key)
+
+    async def set(self, key: str, table: Optional[str], value: Any, size: int, ttl: float, validators: Dict[str, str] = None):
+        self.cache.set(key, table, value, size, ttl, validators)
+
+    async def stale(self, key: str) -> Optional[Tuple[Any, Dict[str, str]]]:
+        return self.cache.stale(key)
+
+    async def refresh(self, key: str, ttl: float):
+        self.cache.refresh(key, ttl)
+
+    async def invalidate(self, table: str = None, namespace: str = "") -> int:
+        return self.cache.invalidate(table, namespace)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, **self.cache.stats()}
+
+class RedisCacheBackend(CacheBackend):
+    """Response cache shared by every worker through Redis, or anything speaking its protocol.
+
+    A value is stored as one line of JSON (table, fresh-until time, upstream
+    validators, whether the body is raw) followed by the body: the JSON of a
+    decoded result or the bytes of a raw one. Entries with validators are kept
+    ``stale_ttl`` seconds past their freshness so they can still be
+    revalidated. A set per table indexes its keys for invalidation.
+
+    ``near`` is an optional in-process ResponseCache in front of Redis that
+    keeps hot entries for at most ``near_ttl`` seconds (never past their
+    freshness), saving a round trip per hit. Invalidations are published on a
+    channel so every worker drops its near copies; a worker that misses a
+    message while reconnecting serves them for ``near_ttl`` at most. Redis
+    errors count as cache misses instead of failing the call.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, prefix: str = "servicenow:", near: Optional[ResponseCache] = None, near_ttl: float = 0.0,
+                 stale_ttl: float = 300.0):
+        from redis.exceptions import RedisError
+        self.client = client
+        self.prefix = prefix
+        self.channel = f"{prefix}#invalidate"
+        self.near = near if near_ttl > 0 else None
+        self.near_ttl = near_ttl
+        self.stale_ttl = stale_ttl
+        self.errors = (RedisError, OSError, asyncio.TimeoutError)
+        # Lets a worker skip its own invalidation messages
+        self.origin = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self.listener: Optional["asyncio.Task"] = None
+        self.counters = {"hits": 0, "near_hits": 0, "misses": 0, "expirations": 0, "invalidations": 0, "revalidations": 0,
+                         "remote_invalidations": 0, "errors": 0}
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisCacheBackend":
+        if importlib.util.find_spec("redis") is None:
+            raise RuntimeError("SERVICENOW_CACHE_BACKEND is redis but the 'redis' package is not installed (pip install redis).")
+        import redis.asyncio
+        return cls(redis.asyncio.from_url(url), **kwargs)
+
+    def index_key(self, table: str) -> str:
+        # "#" cannot start an instance name, so index keys never collide with cached responses
+        return f"{self.prefix}#table:{table}"
+
+    @staticmethod
+    def frame(header: Dict[str, Any], body: bytes) -> bytes:
+        return json_dumps(header) + b"\n" + body
+
+    @staticmethod
+    def unframe(payload: bytes) -> Tuple[Dict[str, Any], bytes]:
+        header, _, body = payload.partition(b"\n")
+        return json_loads(header), body
+
+    @staticmethod
+    def body_value(header: Dict[str, Any], body: bytes) -> Any:
+        return body if header["raw"] else json_loads(body)
+
+    async def call(self, awaitable, default: Any = None) -> Any:
+        try:
+            return await awaitable
+        except self.errors:
+            self.counters["errors"] += 1
+            return default
+
+    async def start(self):
+        if self.near is not None and self.listener is None:
+            self.listener = asyncio.create_task(self.listen())
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+        await self.client.aclose()
+
+    async def listen(self):
+        """Apply other workers' invalidations to the near cache, resubscribing after connection errors."""
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    event = json_loads(message["data"])
+                    if event["origin"] != self.origin:
+                        self.near.invalidate(event["table"], event["namespace"])
+                        self.counters["remote_invalidations"] += 1
+            except self.errors:
+                self.counters["errors"] += 1
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(1)
+
+    def remember(self, key: str, table: Optional[str], value: Any, size: int, fresh_for: float):
+        if self.near is not None:
+            self.near.set(key, table, value, size, min(self.near_ttl, fresh_for))
+
+    async def get(self, key: str) -> Any:
+        if self.near is not None:
+            value = self.near.get(key)
+            if value is not None:
+                self.counters["hits"] += 1
+                self.counters["near_hits"] += 1
+                return value
+        payload = await self.call(self.client.get(self.prefix + key))
+        if payload is None:
+            self.counters["misses"] += 1
+            return None
+        header, body = self.unframe(payload)
+        fresh_for = header["fresh_until"] - time.time()
+        if fresh_for <= 0:
+            self.counters["expirations"] += 1
+            self.counters["misses"] += 1
+            return None
+        value = self.body_value(header, body)
+        self.counters["hits"] += 1
+        self.remember(key, header["table"], value, len(payload), fresh_for)
+        return value
+
+    async def set(self, key: str, table: Optional[str], value: Any, size: int, ttl: float, validators: Dict[str, str] = None):
+        raw = isinstance(value, (bytes, bytearray))
+        header = {"table": table, "fresh_until": time.time() + ttl, "validators": validators or None, "raw": raw}
+        payload = self.frame(header, bytes(value) if raw else json_dumps(value))
+        lifetime = ttl + (self.stale_ttl if validators else 0)
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.set(self.prefix + key, payload, px=max(1, int(lifetime * 1000)))
+        if table:
+            # The index outlives any key it lists: same lifetime as an entry with validators
+            pipeline.sadd(self.index_key(table), key)
+            pipeline.pexpire(self.index_key(table), max(1, int((ttl + self.stale_ttl) * 1000)))
+        await self.call(pipeline.execute())
+        self.remember(key, table, value, len(payload), ttl)
+
+    async def stale(self, key: str) -> Optional[Tuple[Any, Dict[str, str]]]:
+        payload = await self.call(self.client.get(self.prefix + key))
+        if payload is None:
+            return None
+        header, body = self.unframe(payload)
+        if not header["validators"]:
+            return None
+        return self.body_value(header, body), header["validators"]
+
+    async def refresh(self, key: str, ttl: float):
+        payload = await self.call(self.client.get(self.prefix + key))
+        if payload is None:
+            return
+        header, body = self.unframe(payload)
+        header["fresh_until"] = time.time() + ttl
+        lifetime = ttl + (self.stale_ttl if header["validators"] else 0)
+        await self.call(self.client.set(self.prefix + key, self.frame(header, body), px=max(1, int(lifetime * 1000))))
+        self.counters["revalidations"] += 1
+
+    async def invalidate(self, table: str = None, namespace: str = "") -> int:
+        """Delete the shared entries for ``table`` (or all of them) under a namespace and tell every worker."""
+        if self.near is not None:
+            self.near.invalidate(table, namespace)
+        try:
+            if table is None:
+                found = [key.decode() async for key in self.client.scan_iter(match=f"{self.prefix}{namespace}*", count=1000)]
+                keys = [key[len(self.prefix):] for key in found if not key.startswith(f"{self.prefix}#")]
+            else:
+                keys = [member.decode() for member in await self.client.smembers(self.index_key(table))]
+                keys = [key for key in keys if key.startswith(namespace)]
+            deleted = 0
+            if keys:
+                pipeline = self.client.pipeline(transaction=False)
+                pipeline.delete(*(self.prefix + key for key in keys))
+                if table is not None:
+                    pipeline.srem(self.index_key(table), *keys)
+                deleted = (await pipeline.execute())[0]
+            await self.client.publish(self.channel, json_dumps({"origin": self.origin, "table": table, "namespace": namespace}))
+        except self.errors:
+            self.counters["errors"] += 1
+            return 0
+        self.counters["invalidations"] += deleted
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {"backend": self.name, **self.counters}
+        if self.near is not None:
+            stats["near"] = self.near.stats()
+        return stats
+
+def create_cache_backend() -> CacheBackend:
+    if SERVICENOW_CACHE_BACKEND == "memory":
+        return MemoryCacheBackend(response_cache)
+    if SERVICENOW_CACHE_BACKEND == "redis":
+        return RedisCacheBackend.from_url(SERVICENOW_CACHE_REDIS_URL, prefix=SERVICENOW_CACHE_REDIS_PREFIX, near=response_cache,
+                                          near_ttl=SERVICENOW_CACHE_NEAR_TTL, stale_ttl=SERVICENOW_CACHE_STALE_TTL)
+    raise RuntimeError(f"Unknown SERVICENOW_CACHE_BACKEND: {SERVICENOW_CACHE_BACKEND} (expected memory or redis).")
+
+cache_backend = create_cache_backend()
+
+# --- Rate limiting and retries ---
+
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate follows ServiceNow's throttling signals.
+
+    A 429 halves the rate and pauses the bucket for Retry-After; successful
+    responses raise it again by roughly ``increase`` requests/second per second
+    (additive increase, multiplicative decrease). X-RateLimit-Remaining/Reset
+    headers cap the rate at what the instance says is left in the window.
+    """
+
+    def __init__(self, rate: float, min_rate: float, max_rate: float, burst: float, increase: float = 1.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.counters = {"acquired": 0, "throttled": 0, "waited_seconds": 0.0}
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.counters["acquired"] += 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+            self.counters["waited_seconds"] += time.monotonic() - started
+
+    def on_throttled(self, retry_after: Optional[float]):
+        self.counters["throttled"] += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def on_response(self, headers: httpx.Headers):
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        remaining, reset = headers.get("X-RateLimit-Remaining"), headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining, seconds_left = float(remaining), float(reset) - time.time()
+        except ValueError:
+            return
+        if seconds_left <= 0:
+            return
+        if remaining <= 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds_left)
+        self.rate = max(self.min_rate, min(self.rate, remaining / seconds_left))
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "rate": round(self.rate, 3), "tokens": round(self.tokens, 3), "queue_depth": self.waiting,
+                "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 3)}
+
+class RetryBudget:
+    """Allow retries for at most ``ratio`` of requests so retries cannot amplify an outage."""
+
+    def __init__(self, ratio: float, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.counters = {"retries": 0, "exhausted": 0}
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            self.counters["exhausted"] += 1
+            return False
+        self.tokens -= 1
+        self.counters["retries"] += 1
+        return True
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    delay = random.uniform(0, min(SERVICENOW_RETRY_MAX_DELAY, SERVICENOW_RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+# --- ServiceNow instances ---
+
+class ServiceNowInstance:
+    """One upstream instance with its own pooled client, rate limiter, retry budget and cache namespace."""
+
+    def __init__(self, name: str, url: str, username: str, password: str, rate_limit: float = SERVICENOW_RATE_LIMIT):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.cache_namespace = f"{name}:"
+        self.client: Optional[httpx.AsyncClient] = None
+        self.rate_limiter = AdaptiveRateLimiter(rate_limit, SERVICENOW_RATE_LIMIT_MIN, SERVICENOW_RATE_LIMIT_MAX, SERVICENOW_RATE_LIMIT_BURST)
+        self.retry_budget = RetryBudget(SERVICENOW_RETRY_BUDGET_RATIO)
+        self.pool_counters = {"clients_created": 0, "requests": 0, "in_flight": 0}
+        self.health: Dict[str, Any] = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Return the instance's client, creating it on first use (e.g. when the lifespan hook did not run)."""
+        if self.client is None or self.client.is_closed:
+            self.client = create_http_client(self.username, self.password)
+            self.pool_counters["clients_created"] += 1
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def check_health(self) -> Dict[str, Any]:
+        """Fetch one sys_user row directly (no rate limiter or retries) and record whether it worked."""
+        start = time.perf_counter()
+        try:
+            response = await self.get_client().get(
+                f"{self.url}/api/now/table/sys_user", params={"sysparm_limit": 1, "sysparm_fields": "sys_id"},
+                timeout=SERVICENOW_HEALTH_CHECK_TIMEOUT,
+            )
+            health: Dict[str, Any] = {"ok": response.status_code == 200, "status_code": response.status_code}
+        except httpx.HTTPError as e:
+            health = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.health = {**health, "latency_ms": round((time.perf_counter() - start) * 1000, 1), "checked_at": time.time()}
+        return self.health
+
+    def describe(self) -> Dict[str, Any]:
+        return {"url": self.url, "default": self.name == SERVICENOW_DEFAULT_INSTANCE, "health": self.health,
+                "rate": round(self.rate_limiter.rate, 3)}
+
+servicenow_instances: Dict[str, ServiceNowInstance] = {
+    name: ServiceNowInstance(name, settings["url"], settings["username"], settings["password"],
+                             float(settings["rate_limit"] or SERVICENOW_RATE_LIMIT))
+    for name, settings in SERVICENOW_INSTANCE_SETTINGS.items()
+}
+
+async def check_instances() -> Dict[str, Dict[str, Any]]:
+    """Health-check every instance concurrently."""
+    results = await asyncio.gather(*(instance.check_health() for instance in servicenow_instances.values()))
+    return dict(zip(servicenow_instances, results))
+
+async def get_with_retries(instance: ServiceNowInstance, url: str, params: Optional[dict], headers: Optional[dict] = None) -> httpx.Response:
+    """GET with client-side rate limiting and jittered retries for throttling and transient failures."""
+    client, rate_limiter, retry_budget = instance.get_client(), instance.rate_limiter, instance.retry_budget
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        if SERVICENOW_RATE_LIMIT_ENABLED:
+            await rate_limiter.acquire()
+        retry_after = None
+        try:
+            response = await client.get(url, params=params, headers=headers)
+        except httpx.TransportError:
+            if attempt + 1 >= SERVICENOW_RETRY_ATTEMPTS or not retry_budget.withdraw():
+                raise
+        else:
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                rate_limiter.on_throttled(retry_after)
+            elif response.status_code < 500:
+                rate_limiter.on_response(response.headers)
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            if attempt + 1 >= SERVICENOW_RETRY_ATTEMPTS or not retry_budget.withdraw():
+                return response
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+        attempt += 1
+
+# --- Single-flight request coalescing ---
+
+inflight_requests: Dict[str, "asyncio.Task"] = {}
+coalesce_counters = {"upstream_calls": 0, "coalesced": 0}
+
+def _forget_inflight(key: str, task: "asyncio.Task"):
+    if inflight_requests.get(key) is task:
+        del inflight_requests[key]
+    # Mark the error as retrieved even if every waiter was cancelled
+    if not task.cancelled():
+        task.exception()
 
 # Helper function to make authenticated requests to ServiceNow
-async def servicenow_get(endpoint: str, params: dict = None):
-    url = f"{SERVICENOW_INSTANCE}{endpoint}"
-    auth = (SERVICENOW_USERNAME, SERVICENOW_PASSWORD)
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, auth=auth, params=params)
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
-        return response.json()
-
-@app.get("/test-auth", summary="Test ServiceNow authentication")
+async def servicenow_get(endpoint: str, params: dict = None, use_cache: bool = True, raw: bool = False):
+    """GET a Table API resource; ``raw`` returns the ``result`` array as undecoded JSON bytes."""
+    table = table_from_endpoint(endpoint)
+    ttl = cache_ttl(table, endpoint) if use_cache else 0
+    key = cache_key(endpoint, params) + ("#raw" if raw else "")
+    if ttl > 0:
+        cached = await cache_backend.get(key)
+        if cached is not None:
+            return cached
+    if not SERVICENOW_COALESCE_REQUESTS:
+        coalesce_counters["upstream_calls"] += 1
+        return await fetch_servicenow(endpoint, params, key, table, ttl, raw)
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_servicenow(endpoint, params, key, table, ttl, raw))
+        inflight_requests[key] = task
+        task.add_done_callback(lambda done: _forget_inflight(key, done))
+        coalesce_counters["upstream_calls"] += 1
+    else:
+        coalesce_counters["coalesced"] += 1
+    # Shield the shared fetch so one cancelled waiter does not cancel it for the others
+    return await asyncio.shield(task)
+
+async def fetch_servicenow(endpoint: str, params: Optional[dict], key: str, table: Optional[str], ttl: float, raw: bool = False):
+    """Perform the upstream GET and populate the cache on success."""
+    instance = get_instance()
+    url = f"{instance.url}{endpoint}"
+    stale = await cache_backend.stale(key) if ttl > 0 else None
+    headers = None
+    if stale is not None:
+        validators = stale[1]
+        headers = {name: value for name, value in (("If-None-Match", validators.get("etag")), ("If-Modified-Since", validators.get("last-modified"))) if value}
+    pool_counters = instance.pool_counters
+    pool_counters["requests"] += 1
+    pool_counters["in_flight"] += 1
+    start = time.perf_counter()
+    labels = (instance.name, table or "other")
+    try:
+        response = await get_with_retries(instance, url, params, headers)
+    except httpx.TransportError:
+        if SERVICENOW_METRICS_ENABLED:
+            UPSTREAM_REQUESTS.inc((*labels, "error"))
+        raise
+    finally:
+        pool_counters["in_flight"] -= 1
+    if SERVICENOW_METRICS_ENABLED:
+        UPSTREAM_REQUESTS.inc((*labels, str(response.status_code)))
+        UPSTREAM_LATENCY.observe(labels, time.perf_counter() - start)
+        UPSTREAM_RESPONSE_BYTES.observe(labels, len(response.content))
+    if response.status_code == 304 and stale is not None:
+        await cache_backend.refresh(key, ttl)
+        return stale[0]
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    data = slice_result(response.content) if raw else json_loads(response.content)
+    if ttl > 0:
+        validators = {name: response.headers[name] for name in ("etag", "last-modified") if name in response.headers}
+        await cache_backend.set(key, table, data, len(response.content), ttl, validators)
+    return data
+
+# --- Local read replica ---
+
+replica_store: Optional[ReplicaStore] = None
+replica_task: Optional["asyncio.Task"] = None
+replica_counters = {"hits": 0, "misses": 0, "syncs": 0, "sync_errors": 0, "deletes": 0}
+replica_reconciled_at: Dict[str, float] = {}
+
+def start_replica():
+    """Open the replica database and start the background sync; resumes from the stored watermarks."""
+    global replica_store, replica_task
+    replica_store = ReplicaStore(SERVICENOW_REPLICA_PATH)
+    replica_task = asyncio.ensure_future(replica_sync_loop())
+
+async def stop_replica():
+    global replica_store, replica_task
+    if replica_task is not None:
+        replica_task.cancel()
+        try:
+            await replica_task
+        except asyncio.CancelledError:
+            pass
+        replica_task = None
+    if replica_store is not None:
+        replica_store.close()
+        replica_store = None
+    replica_reconciled_at.clear()
+
+async def replica_fetch(endpoint: str, params: dict) -> dict:
+    # Sync pages are one-off reads; keep them out of the response cache
+    return await servicenow_get(endpoint, params=params, use_cache=False)
+
+async def sync_replica_table(table: str):
+    await sync_table(replica_store, table, replica_fetch, SERVICENOW_REPLICA_PAGE_SIZE)
+    # Deletions never reach the incremental sync; compare sys_ids every reconcile interval instead
+    reconciled_at = replica_reconciled_at.get(table)
+    if reconciled_at is None or time.monotonic() - reconciled_at >= SERVICENOW_REPLICA_RECONCILE_INTERVAL:
+        replica_counters["deletes"] += await reconcile_table(replica_store, table, replica_fetch, SERVICENOW_REPLICA_PAGE_SIZE)
+        replica_reconciled_at[table] = time.monotonic()
+
+async def sync_replica_tables():
+    results = await asyncio.gather(
+        *(sync_replica_table(table) for table in SERVICENOW_REPLICA_TABLES),
+        return_exceptions=True,
+    )
+    replica_counters["syncs"] += 1
+    replica_counters["sync_errors"] += sum(1 for result in results if isinstance(result, BaseException))
+
+async def replica_sync_loop():
+    while True:
+        await sync_replica_tables()
+        await asyncio.sleep(SERVICENOW_REPLICA_SYNC_INTERVAL)
+
+def replica_ready(table: str) -> bool:
+    # The replica mirrors the default instance only
+    if replica_store is None or table not in SERVICENOW_REPLICA_TABLES or get_instance().name != SERVICENOW_DEFAULT_INSTANCE:
+        return False
+    age = replica_store.age(table)
+    return age is not None and age <= SERVICENOW_REPLICA_MAX_STALENESS
+
+def parse_query(query: Optional[str]) -> Optional[EncodedQuery]:
+    """Parse an encoded query for local evaluation; None when only the instance can run it."""
+    try:
+        return EncodedQuery.parse(query or "")
+    except QueryParseError:
+        return None
+
+def equality_lookup(query: str) -> Optional[Tuple[str, str]]:
+    """``(field, value)`` when ``query`` is a single ``field=value`` condition."""
+    parsed = parse_query(query)
+    if parsed is None or parsed.order_by or len(parsed.groups) != 1 or len(parsed.groups[0]) != 1:
+        return None
+    (condition, *others), = parsed.groups[0]
+    if others or condition.operator != "=" or "." in condition.field:
+        return None
+    return condition.field, condition.value
+
+def project_rows(rows: List[Dict[str, Any]], projection: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Apply sysparm_fields locally; display values and link stripping need the instance, so return None."""
+    if "sysparm_display_value" in projection or "sysparm_exclude_reference_link" in projection:
+        return None
+    fields = projection.get("sysparm_fields")
+    if not fields:
+        return rows
+    names = fields.split(",")
+    if any("." in name for name in names):
+        return None
+    return [{name: row[name] for name in names if name in row} for row in rows]
+
+async def replica_list(table: str, limit: int, query: Optional[str], projection: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Answer a list call from the replica, or return None when it cannot be served locally."""
+    if not replica_ready(table):
+        return None
+    parsed = parse_query(query)
+    if parsed is None or any("." in field for field in parsed.fields) or project_rows([], projection) is None:
+        replica_counters["misses"] += 1
+        return None
+    where, args, order_by = query_sql(parsed)
+    rows = await asyncio.to_thread(replica_store.select, table, where, args, order_by=order_by, limit=limit)
+    replica_counters["hits"] += 1
+    return project_rows(rows, projection)
+
+async def replica_get(table: str, field: str, value: str, projection: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Look one record up in the replica; None means "ask the instance" (not fresh, not projectable or not there)."""
+    if not replica_ready(table) or project_rows([], projection) is None:
+        return None
+    record = await asyncio.to_thread(replica_store.lookup, table, field, value)
+    if record is None:
+        # It may have been created since the last sync
+        replica_counters["misses"] += 1
+        return None
+    replica_counters["hits"] += 1
+    return project_rows([record], projection)[0]
+
+# --- List helpers and NDJSON streaming ---
+
+async def iter_table_pages(table: str, params: dict, limit: int = 0) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Yield pages of ``table`` rows in order, walking ``sysparm_offset``.
+
+    Up to SERVICENOW_STREAM_PREFETCH_PAGES pages are requested concurrently ahead
+    of the consumer; a short page marks the end. ``limit`` caps the total number
+    of rows (0 means no cap).
+    """
+    endpoint = f"/api/now/table/{table}"
+    query = params.get("sysparm_query", "")
+    if "ORDERBY" not in query:
+        # Offset paging is only stable over a deterministic order
+        params = {**params, "sysparm_query": f"{query}^ORDERBYsys_id" if query else "ORDERBYsys_id"}
+    pending = deque()
+    next_offset = 0
+
+    def schedule_page() -> bool:
+        nonlocal next_offset
+        size = SERVICENOW_STREAM_PAGE_SIZE if not limit else min(SERVICENOW_STREAM_PAGE_SIZE, limit - next_offset)
+        if size <= 0:
+            return False
+        page_params = {**params, "sysparm_limit": size, "sysparm_offset": next_offset}
+        # Pages are read once; caching them would only evict hot entries
+        pending.append((size, asyncio.ensure_future(servicenow_get(endpoint, params=page_params, use_cache=False))))
+        next_offset += size
+        return True
+
+    try:
+        while len(pending) < SERVICENOW_STREAM_PREFETCH_PAGES and schedule_page():
+            pass
+        while pending:
+            size, task = pending.popleft()
+            rows = (await task)["result"]
+            if rows:
+                yield rows
+            if len(rows) < size:
+                break
+            schedule_page()
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+async def stream_records(table: str, params: dict, limit: int = 0) -> StreamingResponse:
+    """Stream table rows as NDJSON, one JSON object per line."""
+    pages = iter_table_pages(table, params, limit)
+    # Fetch the first page up front so upstream errors still produce a proper status code
+    try:
+        first_page = await pages.__anext__()
+    except StopAsyncIteration:
+        first_page = []
+
+    async def body():
+        try:
+            yield b"".join(json_dumps(row) + b"\n" for row in first_page)
+            async for rows in pages:
+                yield b"".join(json_dumps(row) + b"\n" for row in rows)
+        finally:
+            await pages.aclose()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def table_projection(
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. number,short_description,state (optional)"),
+    display_value: Optional[str] = Query(None, pattern="^(true|false|all)$", description="Return display values instead of raw values: true, false or all (optional)"),
+    exclude_reference_link: bool = Query(False, description="Omit reference link URLs from reference fields (optional)"),
+) -> Dict[str, Any]:
+    """Projection parameters shared by every list and detail endpoint, mapped to Table API params."""
+    params = {}
+    if fields:
+        params["sysparm_fields"] = fields
+    if display_value:
+        params["sysparm_display_value"] = display_value
+    if exclude_reference_link:
+        params["sysparm_exclude_reference_link"] = "true"
+    return params
+
+def snapshot_key(endpoint: str, projection: Dict[str, Any]) -> str:
+    return cache_key(endpoint, {**projection, "snapshot": "complete"})
+
+async def remember_snapshot(endpoint: str, table: str, rows: List[Dict[str, Any]], projection: Dict[str, Any]):
+    """Cache an unfiltered list that came back shorter than its limit, i.e. the whole table."""
+    ttl = cache_ttl(table)
+    if ttl > 0:
+        await cache_backend.set(snapshot_key(endpoint, projection), table, rows, len(json_dumps(rows)), ttl)
+
+async def cached_snapshot_rows(endpoint: str, query: EncodedQuery, limit: int, projection: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Answer a filtered list from a cached whole-table snapshot with the same projection, if there is one.
+
+    Text comparisons ignore case as they do on the instance; dot-walked fields
+    are not in the rows, so those queries go upstream.
+    """
+    if "sysparm_display_value" in projection or any("." in field for field in query.fields):
+        # Display text would not match the query's raw values
+        return None
+    fields = projection.get("sysparm_fields")
+    if fields and not query.fields <= set(fields.split(",")):
+        return None
+    rows = await cache_backend.get(snapshot_key(endpoint, projection))
+    return None if rows is None else query.apply(rows, limit)
+
+async def list_records(table: str, limit: int, query: Optional[str] = None, stream: bool = False, projection: Dict[str, Any] = None,
+                       use_replica: bool = True):
+    """Shared implementation of the list endpoints; ``stream`` switches to paged NDJSON output."""
+    if use_replica and not stream:
+        rows = await replica_list(table, limit, query, projection or {})
+        if rows is not None:
+            return rows
+    params = dict(projection or {})
+    if query:
+        params["sysparm_query"] = query
+    if stream:
+        return await stream_records(table, params, limit)
+    params["sysparm_limit"] = limit
+    endpoint = f"/api/now/table/{table}"
+    parsed = parse_query(query) if query else None
+    if parsed is not None:
+        rows = await cached_snapshot_rows(endpoint, parsed, limit, projection or {})
+        if rows is not None:
+            return rows
+    if SERVICENOW_RAW_PASSTHROUGH and (query or cache_ttl(table) <= 0):
+        # Nothing here needs the rows as objects (a whole-table snapshot would), so skip decoding
+        body = await servicenow_get(endpoint, params=params, raw=True)
+        return Response(content=body, media_type="application/json")
+    data = await servicenow_get(endpoint, params=params)
+    if not query and len(data["result"]) < limit:
+        await remember_snapshot(endpoint, table, data["result"], projection or {})
+    # Upstream rows are plain JSON already; returning a response skips jsonable_encoder
+    return FastJSONResponse(data["result"])
+
+class SysIdLoader:
+    """Merge concurrent ``sys_id=`` lookups on the same table into one ``sys_idIN`` query.
+
+    Lookups are grouped by instance, table and projection and dispatched
+    together once an event loop pass registers no new ones. With a
+    ``semaphore`` (a batch's concurrency limit), ``get`` gives its slot back
+    while it waits, so callers queued behind the limit join the same query.
+    """
+
+    def __init__(self, semaphore: "asyncio.Semaphore" = None):
+        self.semaphore = semaphore
+        self.pending: Dict[Tuple[str, Tuple], Dict[str, List["asyncio.Future"]]] = {}
+        self.scheduled: Optional[int] = None
+        self.counters = {"lookups": 0, "upstream_queries": 0}
+
+    def load(self, table: str, sys_id: str, projection: Dict[str, Any]) -> "asyncio.Future":
+        group = (get_instance().name, table, tuple(sorted(projection.items())))
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(group, {}).setdefault(sys_id, []).append(future)
+        self.counters["lookups"] += 1
+        if self.scheduled is None:
+            self.schedule()
+        return future
+
+    async def get(self, table: str, sys_id: str, projection: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """``load`` without holding a semaphore slot while the merged query is pending."""
+        future = self.load(table, sys_id, projection)
+        if self.semaphore is None:
+            return await future
+        self.semaphore.release()
+        try:
+            return await future
+        finally:
+            await self.semaphore.acquire()
+
+    def schedule(self):
+        self.scheduled = self.counters["lookups"]
+        asyncio.get_running_loop().call_soon(self.dispatch)
+
+    def dispatch(self):
+        if self.counters["lookups"] != self.scheduled:
+            # Still arriving (e.g. callers let in by a released semaphore slot); wait another pass
+            self.schedule()
+            return
+        self.scheduled = None
+        pending, self.pending = self.pending, {}
+        for (instance, table, projection), waiters in pending.items():
+            asyncio.ensure_future(self.fetch(instance, table, dict(projection), waiters))
+
+    async def fetch(self, instance: str, table: str, projection: Dict[str, Any], waiters: Dict[str, List["asyncio.Future"]]):
+        # Runs as its own task, so routing it here does not leak into the callers
+        current_instance.set(servicenow_instances[instance])
+        params = {**projection, "sysparm_query": f"sys_idIN{','.join(waiters)}", "sysparm_limit": len(waiters)}
+        fields = projection.get("sysparm_fields")
+        if fields and "sys_id" not in fields.split(","):
+            # sys_id is needed to hand rows back to their callers; strip it again below
+            params["sysparm_fields"] = f"{fields},sys_id"
+        self.counters["upstream_queries"] += 1
+        try:
+            data = await servicenow_get(f"/api/now/table/{table}", params=params)
+        except Exception as e:
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        rows = {}
+        for row in data.get("result", []):
+            sys_id = row.get("sys_id")
+            if isinstance(sys_id, dict):  # display_value=all
+                sys_id = sys_id.get("value")
+            if fields and "sys_id" not in fields.split(","):
+                row = {k: v for k, v in row.items() if k != "sys_id"}
+            rows[sys_id] = row
+        for sys_id, futures in waiters.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(rows.get(sys_id))
+
+# Set while a /batch request runs so detail lookups can be merged
+sys_id_loader: ContextVar[Optional[SysIdLoader]] = ContextVar("sys_id_loader", default=None)
+
+async def get_record(table: str, query: str, not_found: str, projection: Dict[str, Any] = None, use_replica: bool = True):
+    """Shared implementation of the detail endpoints: first row matching ``query`` or a 404."""
+    if use_replica:
+        lookup = equality_lookup(query)
+        if lookup is not None:
+            record = await replica_get(table, *lookup, projection or {})
+            if record is not None:
+                return record
+    loader = sys_id_loader.get()
+    if loader is not None and query.startswith("sys_id=") and "^" not in query:
+        record = await loader.get(table, query[len("sys_id="):], projection or {})
+        if record is None:
+            raise HTTPException(status_code=404, detail=not_found)
+        return record
+    params = {"sysparm_query": query, "sysparm_limit": 1, **(projection or {})}
+    data = await servicenow_get(f"/api/now/table/{table}", params=params)
+    if not data.get("result"):
+        raise HTTPException(status_code=404, detail=not_found)
+    return data["result"][0]
+
+@app.get("/test-auth", summary="Test ServiceNow authentication", description="Test ServiceNow authentication and connectivity")
 async def test_auth():
     """Test ServiceNow credentials by calling a simple endpoint."""
     try:
@@ -36,8 +1763,8 @@ async def test_auth():
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Authentication failed: {e}")
 
-@app.get("/table-description/{table_name}", summary="Get ServiceNow table description")
-async def get_table_description(table_name: str):
+@app.get("/table-description/{table_name}", summary="Get ServiceNow table description", description="Get the description and metadata for a ServiceNow table")
+async def get_table_description(table_name: str = Path(..., description="Table name")):
     """Get the description of a ServiceNow table."""
     try:
         data = await servicenow_get(f"/api/now/table/sys_db_object", params={"sysparm_query": f"name={table_name}", "sysparm_fields": "label,super_class_name,sys_name,description"})
@@ -47,8 +1774,8 @@ async def get_table_description(table_name: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/incident-short-description/{incident_number}", summary="Get short description for an incident")
-async def get_incident_short_description(incident_number: str):
+@app.get("/incident-short-description/{incident_number}", summary="Get short description for an incident", description="Get the short description for a specific incident")
+async def get_incident_short_description(incident_number: str = Path(..., description="Incident number")):
     """Get the short description for a given incident number."""
     try:
         params = {
@@ -64,385 +1791,1021 @@ async def get_incident_short_description(incident_number: str):
 
 # --- Extended Read-Only Endpoints ---
 
-@app.get("/incidents", summary="List incidents")
-async def list_incidents(limit: int = 10, query: str = None):
-    """List recent incidents (optionally filter by query)."""
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/incident", params=params)
-    return data["result"]
+REPLICA_PARAMETER_DESCRIPTION = "Serve from the local read replica when it is fresh enough; false always asks the instance (optional)"
 
-@app.get("/incident/{incident_number}", summary="Get incident details")
-async def get_incident(incident_number: str):
-    """Get details for a specific incident by number."""
-    params = {"sysparm_query": f"number={incident_number}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/incident", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Incident not found.")
-    return data["result"][0]
+def with_default_fields(tool: TableTool, projection: Dict[str, Any]) -> Dict[str, Any]:
+    if tool.default_fields and "sysparm_fields" not in projection:
+        return {**projection, "sysparm_fields": tool.default_fields}
+    return projection
 
-@app.get("/users", summary="List users")
-async def list_users(limit: int = 10, query: str = None):
-    """List users (optionally filter by query)."""
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sys_user", params=params)
-    return data["result"]
+def make_list_handler(tool: TableTool):
+    async def handler(
+        limit: Optional[int] = Query(None, description=f"Number of records to return (default {tool.default_limit}); "
+                                                       "in stream mode the total cap (default 0 = no cap)"),
+        query: Optional[str] = Query(None, description="ServiceNow query string (optional)"),
+        stream: bool = Query(False, description="Stream all matching rows as NDJSON, paging upstream"),
+        replica: bool = Query(True, description=REPLICA_PARAMETER_DESCRIPTION),
+        projection: Dict[str, Any] = Depends(table_projection),
+    ):
+        if limit is None:
+            limit = 0 if stream else tool.default_limit
+        return await list_records(tool.table, limit, query, stream, with_default_fields(tool, projection), use_replica=replica)
 
-@app.get("/user/{user_id}", summary="Get user details")
-async def get_user(user_id: str):
+    handler.__name__ = handler.__qualname__ = tool.list_tool
+    handler.__doc__ = tool.list_description
+    return handler
+
+def make_detail_handler(tool: TableTool):
+    async def handler(replica: bool = True, projection: Dict[str, Any] = Depends(table_projection), **path_params):
+        value = path_params[tool.detail_param]
+        projection = with_default_fields(tool, projection)
+        record = await get_record(tool.table, f"{tool.lookup_key}={value}", tool.not_found, projection, use_replica=replica)
+        return record_response(tool.table, record, projection)
+
+    # FastAPI reads parameters from the signature, so give the handler the spec's path parameter
+    handler.__signature__ = inspect.Signature([
+        inspect.Parameter(tool.detail_param, inspect.Parameter.KEYWORD_ONLY, annotation=str,
+                          default=Path(..., description=tool.lookup_description)),
+        inspect.Parameter("replica", inspect.Parameter.KEYWORD_ONLY, annotation=bool,
+                          default=Query(True, description=REPLICA_PARAMETER_DESCRIPTION)),
+        inspect.Parameter("projection", inspect.Parameter.KEYWORD_ONLY, annotation=Dict[str, Any],
+                          default=Depends(table_projection)),
+    ])
+    handler.__name__ = handler.__qualname__ = tool.detail_tool
+    handler.__doc__ = tool.detail_description
+    return handler
+
+def register_table_tools(tools: List[TableTool]):
+    """Add the list and detail routes described by ``tools`` to the app."""
+    for tool in tools:
+        app.get(tool.list_path, summary=tool.list_summary, description=tool.list_description)(make_list_handler(tool))
+        if tool.detail_tool:
+            app.get(tool.detail_path, summary=tool.detail_summary, description=tool.detail_description)(make_detail_handler(tool))
+
+register_table_tools(TABLE_TOOLS)
+
+@app.get("/user/{user_id}", summary="Get user details", description="Get details for a specific user by sys_id or user_name")
+async def get_user(user_id: str = Path(..., description="User sys_id or user_name"),
+                   replica: bool = Query(True, description=REPLICA_PARAMETER_DESCRIPTION),
+                   projection: Dict[str, Any] = Depends(table_projection)):
     """Get details for a specific user by sys_id or user_name."""
-    # Try by sys_id first, then by user_name
-    params = {"sysparm_query": f"sys_id={user_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/sys_user", params=params)
-    if data.get("result"):
-        return data["result"][0]
-    # Try by user_name
-    params = {"sysparm_query": f"user_name={user_id}", "sysparm_limit": 1}
+    if replica:
+        user = await replica_get("sys_user", "sys_id", user_id, projection) or await replica_get("sys_user", "user_name", user_id, projection)
+        if user is not None:
+            return record_response("sys_user", user, projection)
+    # One round-trip for both keys; a sys_id match wins over a user_name match
+    params = {"sysparm_query": f"sys_id={user_id}^ORuser_name={user_id}", "sysparm_limit": 2, **projection}
     data = await servicenow_get("/api/now/table/sys_user", params=params)
     if not data.get("result"):
         raise HTTPException(status_code=404, detail="User not found.")
-    return data["result"][0]
+    user = next((user for user in data["result"] if user.get("sys_id") == user_id), data["result"][0])
+    return record_response("sys_user", user, projection)
 
-@app.get("/tables", summary="List available tables")
-async def list_tables(limit: int = 20, query: str = None):
-    """List available tables in ServiceNow."""
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sys_db_object", params=params)
+# Dot-walked sys_db_object fields giving the names of a table's ancestors in one query
+SUPER_CLASS_FIELDS = [".".join(["super_class"] * depth + ["name"]) for depth in range(1, 7)]
+MAX_TABLE_HIERARCHY_DEPTH = 30
+
+async def dictionary_fields(table_name: str) -> List[Dict[str, Any]]:
+    params = {"sysparm_query": f"name={table_name}", "sysparm_fields": "name,element,column_label,internal_type,mandatory,max_length,reference"}
+    data = await servicenow_get("/api/now/table/sys_dictionary", params=params)
     return data["result"]
 
-@app.get("/table-schema/{table_name}", summary="Get table schema")
-async def get_table_schema(table_name: str):
-    """Get the schema (fields) for a given table."""
-    params = {"sysparm_query": f"name={table_name}", "sysparm_fields": "name,label,super_class_name,description"}
-    data = await servicenow_get("/api/now/table/sys_db_object", params=params)
+async def table_ancestors(row: Dict[str, Any]) -> List[str]:
+    """Read the dot-walked super_class fields of ``row`` and return the ancestor names, nearest first.
+
+    Rows come straight from the response cache, so they are only read, never modified.
+    """
+    ancestors: List[str] = []
+    while True:
+        chain = [row.get(field, "") for field in SUPER_CLASS_FIELDS]
+        for name in chain:
+            if not name or name in ancestors:
+                return ancestors
+            ancestors.append(name)
+        if len(ancestors) >= MAX_TABLE_HIERARCHY_DEPTH:
+            return ancestors
+        # The chain is deeper than one dot-walk reaches; continue from the last ancestor
+        data = await servicenow_get("/api/now/table/sys_db_object", params={"sysparm_query": f"name={ancestors[-1]}", "sysparm_fields": ",".join(SUPER_CLASS_FIELDS)})
+        if not data.get("result"):
+            return ancestors
+        row = data["result"][0]
+
+@app.get("/table-schema/{table_name}", summary="Get table schema", description="Get the schema (fields) for a given table, including inherited fields")
+async def get_table_schema(table_name: str = Path(..., description="Table name")):
+    """Get the schema (fields) for a given table, including fields inherited from parent tables."""
+    params = {"sysparm_query": f"name={table_name}", "sysparm_fields": ",".join(["name", "label", "super_class_name", "description", *SUPER_CLASS_FIELDS])}
+    data, own_fields = await asyncio.gather(
+        servicenow_get("/api/now/table/sys_db_object", params=params),
+        dictionary_fields(table_name),
+    )
     if not data.get("result"):
         raise HTTPException(status_code=404, detail="Table not found.")
-    # Get fields for the table
-    fields_data = await servicenow_get("/api/now/table/sys_dictionary", params={"sysparm_query": f"name={table_name}", "sysparm_fields": "element,column_label,internal_type,mandatory,max_length,reference"})
-    return {"table": data["result"][0], "fields": fields_data["result"]}
-
-# Knowledge Articles
-@app.get("/knowledge-articles", summary="List knowledge articles")
-async def list_knowledge_articles(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/kb_knowledge", params=params)
-    return data["result"]
+    table = dict(data["result"][0])
+    ancestors = await table_ancestors(table)
+    for field in SUPER_CLASS_FIELDS:
+        table.pop(field, None)
+    inherited = await asyncio.gather(*(dictionary_fields(ancestor) for ancestor in ancestors))
+    # Fields defined on the table itself take precedence over inherited ones
+    fields, seen = [], set()
+    for field in [f for group in (own_fields, *inherited) for f in group]:
+        element = field.get("element")
+        if element in seen:
+            continue
+        seen.add(element)
+        fields.append(field)
+    return {"table": table, "hierarchy": [table_name, *ancestors], "fields": fields}
 
-@app.get("/knowledge-article/{article_id}", summary="Get knowledge article details")
-async def get_knowledge_article(article_id: str):
-    params = {"sysparm_query": f"sys_id={article_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/kb_knowledge", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Knowledge article not found.")
-    return data["result"][0]
+# --- Record graph expansion ---
 
-# Groups
-@app.get("/groups", summary="List groups")
-async def list_groups(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sys_user_group", params=params)
-    return data["result"]
+REFERENCE_LINK_PATTERN = re.compile(r"/api/now/table/([A-Za-z0-9_]+)/([0-9A-Za-z]+)$")
+# References that point at nearly every record and add nothing to its context
+EXPAND_SKIP_FIELDS = {"sys_domain"}
+# Child records pulled in alongside a parent: table -> [(child table, child field referencing the parent)]
+EXPAND_RELATED: Dict[str, List[Tuple[str, str]]] = {
+    "incident": [("incident_task", "incident")],
+    "problem": [("incident", "problem_id"), ("problem_task", "problem")],
+    "change_request": [("change_task", "change_request")],
+    "sc_request": [("sc_req_item", "request")],
+    "sc_req_item": [("sc_task", "request_item")],
+}
 
-@app.get("/group/{group_id}", summary="Get group details")
-async def get_group(group_id: str):
-    params = {"sysparm_query": f"sys_id={group_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/sys_user_group", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Group not found.")
-    return data["result"][0]
+def node_key(table: str, sys_id: str) -> str:
+    return f"{table}:{sys_id}"
 
-# Catalog Items
-@app.get("/catalog-items", summary="List catalog items")
-async def list_catalog_items(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sc_cat_item", params=params)
-    return data["result"]
+def record_references(record: Dict[str, Any], follow: Optional[set]) -> List[Tuple[str, str, str]]:
+    """``(field, table, sys_id)`` for each populated reference field; the target table comes from its link."""
+    references = []
+    for field, value in record.items():
+        if not isinstance(value, dict) or field in EXPAND_SKIP_FIELDS or (follow is not None and field not in follow):
+            continue
+        match = REFERENCE_LINK_PATTERN.search(value.get("link") or "")
+        if match and value.get("value"):
+            references.append((field, match.group(1), value["value"]))
+    return references
 
-@app.get("/catalog-item/{item_id}", summary="Get catalog item details")
-async def get_catalog_item(item_id: str):
-    params = {"sysparm_query": f"sys_id={item_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/sc_cat_item", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Catalog item not found.")
-    return data["result"][0]
+def compact_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop empty fields and reduce reference objects to their sys_id; the edges carry the links."""
+    compact = {}
+    for field, value in record.items():
+        if isinstance(value, dict):
+            value = value.get("value")
+        if value not in ("", None):
+            compact[field] = value
+    return compact
 
-# Requests
-@app.get("/requests", summary="List requests")
-async def list_requests(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sc_request", params=params)
-    return data["result"]
+class RecordGraph:
+    """Breadth-first expansion of a record's references, one level at a time.
 
-@app.get("/request/{request_id}", summary="Get request details")
-async def get_request(request_id: str):
-    params = {"sysparm_query": f"sys_id={request_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/sc_request", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Request not found.")
-    return data["result"][0]
+    Each level's forward references go through a SysIdLoader, which merges
+    them into one ``sys_idIN`` query per target table; child records from
+    EXPAND_RELATED are fetched with one ``fieldIN`` query per relation, all
+    concurrently. Records already in the graph are never fetched again.
+    """
 
-# Requested Items
-@app.get("/requested-items", summary="List requested items (RITMs)")
-async def list_requested_items(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sc_req_item", params=params)
-    return data["result"]
+    def __init__(self, follow: Optional[set] = None, related: bool = True):
+        self.follow = follow
+        self.related = related
+        self.loader = SysIdLoader()
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.edges: Dict[Tuple[str, str, str], None] = {}
+        self.missing: List[str] = []
+        self.related_queries = 0
+        self.truncated = False
 
-@app.get("/requested-item/{ritm_id}", summary="Get requested item details")
-async def get_requested_item(ritm_id: str):
-    params = {"sysparm_query": f"sys_id={ritm_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/sc_req_item", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Requested item not found.")
-    return data["result"][0]
+    def add_node(self, table: str, record: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        key = node_key(table, cell_text(record.get("sys_id")))
+        if key in self.nodes:
+            return None
+        if len(self.nodes) >= SERVICENOW_EXPAND_MAX_NODES:
+            self.truncated = True
+            return None
+        self.nodes[key] = compact_record(record)
+        return table, record
 
-# Change Requests
-@app.get("/change-requests", summary="List change requests")
-async def list_change_requests(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/change_request", params=params)
-    return data["result"]
+    async def load(self, table: str, sys_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return await self.loader.load(table, sys_id, {})
+        except HTTPException:
+            # Usually an ACL on the target table; keep the edge and report the node as missing
+            return None
 
-@app.get("/change-request/{change_id}", summary="Get change request details")
-async def get_change_request(change_id: str):
-    params = {"sysparm_query": f"sys_id={change_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/change_request", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Change request not found.")
-    return data["result"][0]
+    async def load_children(self, table: str, field: str, parents: List[str]) -> List[Dict[str, Any]]:
+        """Children of every parent in the level, up to SERVICENOW_EXPAND_RELATED_LIMIT per parent; a full page sets ``truncated``."""
+        self.related_queries += 1
+        # More rows than the node budget could never be added anyway
+        limit = min(SERVICENOW_EXPAND_RELATED_LIMIT * len(parents), SERVICENOW_EXPAND_MAX_NODES)
+        params = {"sysparm_query": f"{field}IN{','.join(parents)}", "sysparm_limit": limit}
+        try:
+            data = await servicenow_get(f"/api/now/table/{table}", params=params)
+        except HTTPException:
+            return []
+        rows = data.get("result", [])
+        if len(rows) >= limit:
+            self.truncated = True
+        return rows
 
-# Tasks
-@app.get("/tasks", summary="List tasks")
-async def list_tasks(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/task", params=params)
-    return data["result"]
+    async def expand(self, table: str, sys_id: str, depth: int):
+        root = await self.loader.load(table, sys_id, {})
+        if root is None:
+            raise HTTPException(status_code=404, detail=f"No {table} record with sys_id {sys_id}.")
+        level = [self.add_node(table, root)]
+        for _ in range(depth):
+            if self.truncated or not level:
+                break
+            wanted: Dict[str, Tuple[str, str]] = {}
+            children: Dict[Tuple[str, str, str], List[str]] = {}
+            for parent_table, record in level:
+                parent = node_key(parent_table, cell_text(record.get("sys_id")))
+                for field, target_table, target_id in record_references(record, self.follow):
+                    target = node_key(target_table, target_id)
+                    self.edges[(parent, field, target)] = None
+                    if target not in self.nodes and target not in self.missing:
+                        wanted[target] = (target_table, target_id)
+                if self.related:
+                    for child_table, field in EXPAND_RELATED.get(parent_table, []):
+                        children.setdefault((parent_table, child_table, field), []).append(cell_text(record.get("sys_id")))
+            loads = [self.load(t, i) for t, i in wanted.values()]
+            child_loads = [self.load_children(t, f, parents) for (_, t, f), parents in children.items()]
+            results = await asyncio.gather(*loads, *child_loads)
+            level = []
+            for (target_table, target_id), record in zip(wanted.values(), results[:len(loads)]):
+                if record is None:
+                    self.missing.append(node_key(target_table, target_id))
+                elif (added := self.add_node(target_table, record)) is not None:
+                    level.append(added)
+            for (parent_table, child_table, field), rows in zip(children, results[len(loads):]):
+                for row in rows:
+                    child = node_key(child_table, cell_text(row.get("sys_id")))
+                    self.edges[(child, field, node_key(parent_table, cell_text(row.get(field))))] = None
+                    if (added := self.add_node(child_table, row)) is not None:
+                        level.append(added)
+        return {
+            "root": node_key(table, sys_id),
+            "nodes": self.nodes,
+            "edges": [
+                {"from": source, "field": field, "to": target}
+                for source, field, target in self.edges
+                # Both ends must be in the graph; children refused by the node cap are not
+                if source in self.nodes and (target in self.nodes or target in self.missing)
+            ],
+            "missing": self.missing,
+            "truncated": self.truncated,
+            "upstream_queries": self.loader.counters["upstream_queries"] + self.related_queries,
+        }
 
-@app.get("/task/{task_id}", summary="Get task details")
-async def get_task(task_id: str):
-    params = {"sysparm_query": f"sys_id={task_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/task", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Task not found.")
-    return data["result"][0]
+@app.get("/expand/{table}/{sys_id}", summary="Expand a record and the records it references into a graph")
+async def expand_record(
+    table: str = Path(..., description="Table of the starting record, e.g. incident"),
+    sys_id: str = Path(..., description="sys_id of the starting record"),
+    depth: int = Query(1, ge=0, le=SERVICENOW_EXPAND_MAX_DEPTH, description="How many reference hops to follow"),
+    follow: Optional[str] = Query(None, description="Comma-separated reference fields to follow; default all (optional)"),
+    related: bool = Query(True, description="Also include child records such as incident tasks (optional)"),
+):
+    """Return the record plus everything reachable through its references as nodes keyed ``table:sys_id`` and edges."""
+    if not IDENTIFIER_PATTERN.match(table):
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {table}")
+    graph = RecordGraph(set(follow.split(",")) if follow else None, related)
+    return await graph.expand(table, sys_id, depth)
 
-# Problems
-@app.get("/problems", summary="List problems")
-async def list_problems(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/problem", params=params)
-    return data["result"]
+# --- Aggregates (Stats API) ---
 
-@app.get("/problem/{problem_id}", summary="Get problem details")
-async def get_problem(problem_id: str):
-    params = {"sysparm_query": f"sys_id={problem_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/problem", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Problem not found.")
-    return data["result"][0]
+AGGREGATE_FUNCTIONS = ("avg", "min", "max", "sum")
+# Comma-separated field names, dot-walking allowed (assignment_group.name)
+FIELD_LIST_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*(?:,[A-Za-z_][A-Za-z0-9_.]*)*$")
+HAVING_PATTERN = re.compile(r"^(?:count|avg|min|max|sum)\^[A-Za-z_][A-Za-z0-9_.]*\^(?:=|!=|>|>=|<|<=)\^-?\d+(?:\.\d+)?$")
 
-# Assets
-@app.get("/assets", summary="List assets")
-async def list_assets(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/alm_asset", params=params)
-    return data["result"]
+def stats_number(value: Any) -> Any:
+    """The Stats API sends numbers as strings; hand them back as numbers when they parse."""
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
 
-@app.get("/asset/{asset_id}", summary="Get asset details")
-async def get_asset(asset_id: str):
-    params = {"sysparm_query": f"sys_id={asset_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/alm_asset", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Asset not found.")
-    return data["result"][0]
+def aggregate_group(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """One Stats API result entry as ``{"group", "labels", "count", "avg", ...}`` with numeric values."""
+    group: Dict[str, Any] = {"group": {}}
+    labels = {}
+    for field in entry.get("groupby_fields", []):
+        group["group"][field["field"]] = field.get("value", "")
+        if field.get("display_value") not in (None, "", field.get("value")):
+            labels[field["field"]] = field["display_value"]
+    if labels:
+        group["labels"] = labels
+    for name, value in entry.get("stats", {}).items():
+        group[name] = {field: stats_number(v) for field, v in value.items()} if isinstance(value, dict) else stats_number(value)
+    return group
+
+@app.get("/aggregate/{table_name}", summary="Count and aggregate records with the Stats API")
+async def aggregate_records(
+    table_name: str = Path(..., description="Table name, e.g. incident"),
+    query: Optional[str] = Query(None, description="Encoded query selecting the records, e.g. active=true^priority=1 (optional)"),
+    count: bool = Query(True, description="Count the records in each group (optional)"),
+    avg_fields: Optional[str] = Query(None, alias="avg", description="Comma-separated fields to average (optional)"),
+    min_fields: Optional[str] = Query(None, alias="min", description="Comma-separated fields to take the minimum of (optional)"),
+    max_fields: Optional[str] = Query(None, alias="max", description="Comma-separated fields to take the maximum of (optional)"),
+    sum_fields: Optional[str] = Query(None, alias="sum", description="Comma-separated fields to sum (optional)"),
+    group_by: Optional[str] = Query(None, description="Comma-separated fields to group by, e.g. assignment_group (optional)"),
+    having: Optional[str] = Query(None, description="Filter groups on an aggregate as aggregate^field^operator^value, e.g. count^sys_id^>^10 (optional)"),
+    display_value: bool = Query(False, description="Also return display values (labels) of the group fields (optional)"),
+):
+    """Count, average, min, max or sum a table's records, optionally per group, in one Stats API call instead of pulling rows.
 
-# Configuration Items (CMDB)
-@app.get("/cmdb-items", summary="List configuration items (CIs)")
-async def list_cmdb_items(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
+    Groups come back ordered by count, largest first, when counting.
+    """
+    if not IDENTIFIER_PATTERN.match(table_name):
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {table_name}")
+    fields = dict(zip(AGGREGATE_FUNCTIONS, (avg_fields, min_fields, max_fields, sum_fields)))
+    for name, value in [*fields.items(), ("group_by", group_by)]:
+        if value and not FIELD_LIST_PATTERN.match(value):
+            raise HTTPException(status_code=400, detail=f"Invalid {name} fields: {value}")
+    if having and not HAVING_PATTERN.match(having):
+        raise HTTPException(status_code=400, detail=f"Invalid having clause: {having}. Expected aggregate^field^operator^value, e.g. count^sys_id^>^10.")
+    if not count and not any(fields.values()):
+        raise HTTPException(status_code=400, detail="Nothing to aggregate: set count or at least one of avg, min, max, sum.")
+    params: Dict[str, Any] = {f"sysparm_{name}_fields": value for name, value in fields.items() if value}
+    if count:
+        params["sysparm_count"] = "true"
     if query:
         params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/cmdb_ci", params=params)
-    return data["result"]
+    if group_by:
+        params["sysparm_group_by"] = group_by
+    if having:
+        params["sysparm_having"] = having
+    if display_value:
+        params["sysparm_display_value"] = "true"
+    data = await servicenow_get(f"{STATS_API_PATH}{table_name}", params=params)
+    result = data.get("result", [])
+    groups = [aggregate_group(entry) for entry in (result if isinstance(result, list) else [result])]
+    if count and group_by:
+        groups.sort(key=lambda group: -group.get("count", 0))
+    return {"table": table_name, "query": query, "group_by": group_by.split(",") if group_by else [], "groups": groups}
 
-@app.get("/cmdb-item/{ci_id}", summary="Get configuration item details")
-async def get_cmdb_item(ci_id: str):
-    params = {"sysparm_query": f"sys_id={ci_id}", "sysparm_limit": 1}
-    data = await servicenow_get("/api/now/table/cmdb_ci", params=params)
-    if not data.get("result"):
-        raise HTTPException(status_code=404, detail="Configuration item not found.")
-    return data["result"][0]
+# --- Batch tool execution ---
 
-# Audit Records
-@app.get("/audit-records", summary="List audit records")
-async def list_audit_records(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/sys_audit", params=params)
-    return data["result"]
+class BatchCall(BaseModel):
+    tool: str = Field(..., description="Tool name as listed by /resources")
+    parameters: Dict[str, Any] = Field(default_factory=dict, description="Path and query parameters for the tool")
+    instance: Optional[str] = Field(None, description="ServiceNow instance for this call; defaults to the one the batch is routed to")
 
-# System Logs
-@app.get("/system-logs", summary="List system logs")
-async def list_system_logs(limit: int = 10, query: str = None):
-    params = {"sysparm_limit": limit}
-    if query:
-        params["sysparm_query"] = query
-    data = await servicenow_get("/api/now/table/syslog", params=params)
-    return data["result"]
+class BatchRequest(BaseModel):
+    calls: List[BatchCall]
 
-# --- MCP /resources and /prompt endpoints ---
+PROJECTION_ARGUMENTS = ("fields", "display_value", "exclude_reference_link")
 
-# Define tool/resource metadata statically for now
-MCP_RESOURCES = [
-    {
-        "name": "test_auth",
-        "description": "Test ServiceNow authentication and connectivity",
-        "path": "/test-auth",
-        "method": "GET",
-        "parameters": []
-    },
-    {
-        "name": "list_incidents",
-        "description": "List recent incidents (with optional query and limit)",
-        "path": "/incidents",
-        "method": "GET",
-        "parameters": [
-            {"name": "limit", "type": "integer", "description": "Number of incidents to return"},
-            {"name": "query", "type": "string", "description": "ServiceNow query string (optional)"}
-        ]
-    },
-    {
-        "name": "get_incident",
-        "description": "Get details for a specific incident by number",
-        "path": "/incident/{incident_number}",
-        "method": "GET",
-        "parameters": [
-            {"name": "incident_number", "type": "string", "description": "Incident number"}
-        ]
-    },
-    {
-        "name": "get_incident_short_description",
-        "description": "Get the short description for a specific incident",
-        "path": "/incident-short-description/{incident_number}",
-        "method": "GET",
-        "parameters": [
-            {"name": "incident_number", "type": "string", "description": "Incident number"}
-        ]
-    },
-    {
-        "name": "list_users",
-        "description": "List users (with optional query and limit)",
-        "path": "/users",
-        "method": "GET",
-        "parameters": [
-            {"name": "limit", "type": "integer", "description": "Number of users to return"},
-            {"name": "query", "type": "string", "description": "ServiceNow query string (optional)"}
-        ]
-    },
-    {
-        "name": "get_user",
-        "description": "Get details for a specific user by sys_id or user_name",
-        "path": "/user/{user_id}",
-        "method": "GET",
-        "parameters": [
-            {"name": "user_id", "type": "string", "description": "User sys_id or user_name"}
-        ]
-    },
-    {
-        "name": "list_tables",
-        "description": "List available tables in ServiceNow",
-        "path": "/tables",
-        "method": "GET",
-        "parameters": [
-            {"name": "limit", "type": "integer", "description": "Number of tables to return"},
-            {"name": "query", "type": "string", "description": "ServiceNow query string (optional)"}
-        ]
-    },
-    {
-        "name": "get_table_description",
-        "description": "Get the description and metadata for a ServiceNow table",
-        "path": "/table-description/{table_name}",
-        "method": "GET",
-        "parameters": [
-            {"name": "table_name", "type": "string", "description": "Table name"}
-        ]
-    },
-    {
-        "name": "get_table_schema",
-        "description": "Get the schema (fields) for a given table",
-        "path": "/table-schema/{table_name}",
-        "method": "GET",
-        "parameters": [
-            {"name": "table_name", "type": "string", "description": "Table name"}
+# Routes that are part of the server's plumbing rather than tools
+NON_TOOL_PATHS = {"/resources", "/metrics", "/prompt", "/subscribe"}
+
+def is_tool_route(route) -> bool:
+    return isinstance(route, APIRoute) and route.path not in NON_TOOL_PATHS and not route.path.startswith("/admin")
+
+def tool_handlers() -> Dict[str, Any]:
+    """Map tool names to the GET handlers that implement them."""
+    return {route.name: route.endpoint for route in app.routes if is_tool_route(route) and "GET" in route.methods}
+
+# (function, parameter name) -> validator built from the annotation and its Query()/Path() constraints
+argument_adapters: Dict[Tuple[Any, str], TypeAdapter] = {}
+
+def validate_argument(function, name: str, param: inspect.Parameter, alias: str, value: Any) -> Any:
+    """Coerce and check one batch argument the way FastAPI would check the query string ("5" -> 5, "false" -> False)."""
+    adapter = argument_adapters.get((function, name))
+    if adapter is None:
+        annotation = Any if param.annotation is inspect.Parameter.empty else param.annotation
+        if isinstance(param.default, FieldInfo):
+            annotation = Annotated[annotation, param.default]
+        # Record ids and query values may arrive as JSON numbers
+        adapter = argument_adapters[(function, name)] = TypeAdapter(annotation, config=ConfigDict(coerce_numbers_to_str=True))
+    try:
+        return adapter.validate_python(value)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid value for {alias}: {e.errors()[0]['msg']}")
+
+def bind_arguments(function, parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """Validated keyword arguments for ``function`` from batch parameters, with FastAPI defaults unwrapped."""
+    kwargs = {}
+    for name, param in inspect.signature(function).parameters.items():
+        if name == "projection":
+            kwargs[name] = table_projection(**bind_arguments(table_projection, parameters))
+            continue
+        # Parameters declared with Query(alias=...) are passed by their alias, as over HTTP
+        alias = getattr(param.default, "alias", None) or name
+        if alias in parameters:
+            kwargs[name] = validate_argument(function, name, param, alias, parameters[alias])
+        elif param.default is inspect.Parameter.empty or (isinstance(param.default, FieldInfo) and param.default.is_required()):
+            raise HTTPException(status_code=422, detail=f"Missing parameter: {alias}")
+        elif isinstance(param.default, FieldInfo):
+            # Query()/Path() defaults only mean something to FastAPI; unwrap the real value
+            kwargs[name] = param.default.default
+    return kwargs
+
+def bind_tool_arguments(handler, parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn batch call parameters into keyword arguments for a tool handler."""
+    accepted = {getattr(param.default, "alias", None) or name for name, param in inspect.signature(handler).parameters.items()}
+    unknown = set(parameters) - accepted - set(PROJECTION_ARGUMENTS)
+    if "stream" in parameters:
+        unknown.add("stream")
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unsupported parameters: {', '.join(sorted(unknown))}")
+    return bind_arguments(handler, parameters)
+
+@app.post("/batch", name="batch", summary="Run many tool calls concurrently", description="Run many tool calls concurrently and return per-call results or errors in order")
+async def run_batch(batch: BatchRequest):
+    """Run several tool calls concurrently and return per-call results or errors in order."""
+    if len(batch.calls) > SERVICENOW_BATCH_MAX_CALLS:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {SERVICENOW_BATCH_MAX_CALLS} calls.")
+    handlers = tool_handlers()
+    semaphore = asyncio.Semaphore(SERVICENOW_BATCH_CONCURRENCY)
+    sys_id_loader.set(SysIdLoader(semaphore))
+
+    async def run_call(call: BatchCall) -> Dict[str, Any]:
+        handler = handlers.get(call.tool)
+        if handler is None:
+            return {"tool": call.tool, "status": 404, "error": f"Unknown tool: {call.tool}"}
+        if call.instance is not None:
+            if call.instance not in servicenow_instances:
+                return {"tool": call.tool, "status": 400, "error": f"Unknown ServiceNow instance: {call.instance}"}
+            # gather() runs each call in its own task, so this only routes this call
+            current_instance.set(servicenow_instances[call.instance])
+        async with semaphore:
+            try:
+                result = await handler(**bind_tool_arguments(handler, call.parameters))
+                if isinstance(result, Response):
+                    result = json_loads(result.body)
+            except HTTPException as e:
+                return {"tool": call.tool, "status": e.status_code, "error": e.detail}
+            except Exception as e:
+                return {"tool": call.tool, "status": 500, "error": str(e)}
+        return {"tool": call.tool, "status": 200, "result": result}
+
+    return {"results": await asyncio.gather(*(run_call(call) for call in batch.calls))}
+
+# --- Change subscriptions (SSE) ---
+
+class Subscriber:
+    """One /subscribe stream: a bounded queue of change events."""
+
+    def __init__(self, key: Tuple[str, Optional[str]]):
+        self.key = key
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=SERVICENOW_SUBSCRIBE_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, event: Dict[str, Any]) -> bool:
+        """Queue an event; a full queue marks the subscriber as overflowed instead of blocking the poller."""
+        if self.overflowed:
+            return False
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            return False
+        return True
+
+class TablePoller:
+    """Polls one table for changed rows and fans them out to every subscription on it.
+
+    Subscriptions are grouped by canonical query and field list, so identical
+    ones share the matching work; all of them share one upstream poll that
+    asks only for rows updated since the watermark. Rows sharing the watermark
+    timestamp are remembered by sys_id and sys_mod_count so they are not sent
+    twice.
+    """
+
+    def __init__(self, table: str, instance: "ServiceNowInstance" = None):
+        self.table = table
+        self.instance = instance or get_instance()
+        self.key = (self.instance.name, table)
+        self.endpoint = f"/api/now/table/{table}"
+        self.groups: Dict[Tuple[str, Optional[str]], Tuple[EncodedQuery, Optional[List[str]], set]] = {}
+        self.watermark: Optional[str] = None
+        self.seen_at_watermark: set = set()
+        self.task: Optional["asyncio.Task"] = None
+
+    def subscribe(self, query: EncodedQuery, fields: Optional[str]) -> Subscriber:
+        key = (query.canonical(), fields)
+        if key not in self.groups:
+            self.groups[key] = (query, fields.split(",") if fields else None, set())
+        subscriber = Subscriber(key)
+        self.groups[key][2].add(subscriber)
+        SUBSCRIBERS.inc((self.table,))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        group = self.groups.get(subscriber.key)
+        if group is None or subscriber not in group[2]:
+            return
+        group[2].discard(subscriber)
+        SUBSCRIBERS.inc((self.table,), -1)
+        if not group[2]:
+            del self.groups[subscriber.key]
+        if not self.groups:
+            self.stop()
+            if table_pollers.get(self.key) is self:
+                del table_pollers[self.key]
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        current_instance.set(self.instance)
+        while True:
+            try:
+                if self.watermark is None:
+                    self.watermark, self.seen_at_watermark = await self.latest_update()
+                else:
+                    await self.poll()
+            except (HTTPException, httpx.HTTPError):
+                SUBSCRIPTION_POLLS.inc((self.table, "error"))
+            await asyncio.sleep(SERVICENOW_SUBSCRIBE_POLL_INTERVAL)
+
+    @staticmethod
+    def version(row: Dict[str, Any]) -> Tuple[str, str]:
+        return cell_text(row.get("sys_id")), cell_text(row.get("sys_mod_count"))
+
+    async def latest_update(self) -> Tuple[str, set]:
+        """Start from the newest existing change so subscribers only see what happens next.
+
+        Polls ask for rows at or after the watermark, so the versions of the rows
+        already sitting at it are returned too, to be skipped by the first poll.
+        """
+        params = {"sysparm_query": "ORDERBYDESCsys_updated_on", "sysparm_fields": "sys_updated_on", "sysparm_limit": 1}
+        rows = (await servicenow_get(self.endpoint, params=params, use_cache=False))["result"]
+        if not rows:
+            return "", set()
+        watermark = cell_text(rows[0].get("sys_updated_on"))
+        rows = await self.fetch_changes(watermark, fields="sys_id,sys_mod_count,sys_updated_on")
+        return watermark, {self.version(row) for row in rows if cell_text(row.get("sys_updated_on")) == watermark}
+
+    async def fetch_changes(self, watermark: Optional[str], fields: str = None) -> List[Dict[str, Any]]:
+        since = f"sys_updated_on>={watermark}^" if watermark else ""
+        rows: List[Dict[str, Any]] = []
+        while True:
+            params = {
+                "sysparm_query": f"{since}ORDERBYsys_updated_on^ORDERBYsys_id",
+                "sysparm_limit": SERVICENOW_SUBSCRIBE_PAGE_SIZE,
+                "sysparm_offset": len(rows),
+            }
+            if fields:
+                params["sysparm_fields"] = fields
+            page = (await servicenow_get(self.endpoint, params=params, use_cache=False))["result"]
+            rows.extend(page)
+            if len(page) < SERVICENOW_SUBSCRIBE_PAGE_SIZE:
+                return rows
+
+    async def poll(self) -> int:
+        """Fetch rows changed since the watermark and queue matches for each group; returns new rows."""
+        start = time.perf_counter()
+        rows = await self.fetch_changes(self.watermark)
+        SUBSCRIPTION_POLL_LATENCY.observe((self.table,), time.perf_counter() - start)
+        SUBSCRIPTION_POLLS.inc((self.table, "ok"))
+        SUBSCRIPTION_POLL_ROWS.inc((self.table,), len(rows))
+        fresh = [
+            row for row in rows
+            if cell_text(row.get("sys_updated_on")) > (self.watermark or "")
+            or self.version(row) not in self.seen_at_watermark
         ]
-    },
-    # ... Add all other endpoints similarly ...
-    # For brevity, not all endpoints are listed here, but you would include all from the README table
-]
+        if not fresh:
+            return 0
+        latest = max(cell_text(row.get("sys_updated_on")) for row in fresh)
+        at_latest = {self.version(row) for row in fresh if cell_text(row.get("sys_updated_on")) == latest}
+        self.seen_at_watermark = (self.seen_at_watermark | at_latest) if latest == self.watermark else at_latest
+        self.watermark = latest
+        for query, fields, subscribers in list(self.groups.values()):
+            matched = query.apply(fresh)
+            if not matched:
+                continue
+            if fields:
+                matched = [{name: row[name] for name in fields if name in row} for row in matched]
+            event = {"table": self.table, "watermark": latest, "records": matched}
+            for subscriber in list(subscribers):
+                lagging = subscriber.overflowed
+                if subscriber.push(event):
+                    SUBSCRIPTION_EVENTS.inc((self.table,))
+                elif not lagging:
+                    SUBSCRIPTION_OVERFLOWS.inc((self.table,))
+        return len(fresh)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "watermark": self.watermark,
+            "subscriptions": len(self.groups),
+            "subscribers": sum(len(group[2]) for group in self.groups.values()),
+            "lagging": sum(1 for group in self.groups.values() for s in group[2] if s.overflowed),
+        }
+
+# Keyed by (instance name, table)
+table_pollers: Dict[Tuple[str, str], TablePoller] = {}
+
+async def stop_pollers():
+    for poller in table_pollers.values():
+        poller.stop()
+    table_pollers.clear()
+
+def sse_event(event: str, data: Any, event_id: str = None) -> bytes:
+    lines = [f"id: {event_id}"] if event_id else []
+    lines += [f"event: {event}", f"data: {json_dumps(data).decode()}"]
+    return ("\n".join(lines) + "\n\n").encode()
+
+async def subscription_events(poller: TablePoller, subscriber: Subscriber) -> AsyncIterator[bytes]:
+    """SSE body: change events, keep-alive comments, and a final ``overflow`` event for slow consumers."""
+    try:
+        yield b": subscribed\n\n"
+        while True:
+            if subscriber.overflowed:
+                yield sse_event("overflow", {"table": poller.table, "detail": "Subscriber fell behind; resubscribe and re-read the table."})
+                return
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), SERVICENOW_SUBSCRIBE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield sse_event("changes", event, event["watermark"])
+    finally:
+        poller.unsubscribe(subscriber)
+
+@app.get("/subscribe", summary="Stream changes to records matching an encoded query (Server-Sent Events)")
+async def subscribe(
+    table: str = Query(..., description="Table to watch, e.g. incident"),
+    query: Optional[str] = Query(None, description="Encoded query the changed records must match (optional)"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to include in each record (optional)"),
+):
+    """Push records of ``table`` that change and match ``query``, as ``changes`` events."""
+    if not IDENTIFIER_PATTERN.match(table):
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {table}")
+    parsed = parse_query(query)
+    if parsed is None or any("." in field for field in parsed.fields):
+        raise HTTPException(status_code=400, detail="Subscriptions support encoded queries on the table's own fields only.")
+    key = (get_instance().name, table)
+    poller = table_pollers.get(key)
+    if poller is None:
+        poller = table_pollers[key] = TablePoller(table)
+    subscriber = poller.subscribe(parsed, fields)
+    return StreamingResponse(
+        subscription_events(poller, subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Admin / operator endpoints ---
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Expose request, upstream, cache and rate limiter metrics in the Prometheus text format."""
+    if not SERVICENOW_METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled.")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/pool-stats", summary="Show upstream connection pool statistics")
+async def get_admin_pool_stats():
+    """Return counters and connection states for the routed instance's pooled ServiceNow client."""
+    return get_pool_stats()
+
+@app.get("/admin/rate-limit-stats", summary="Show upstream rate limiter and retry statistics")
+async def get_admin_rate_limit_stats():
+    """Return the limiter's current rate and queue depth plus retry budget counters."""
+    instance = get_instance()
+    return {"instance": instance.name, "enabled": SERVICENOW_RATE_LIMIT_ENABLED, "rate_limiter": instance.rate_limiter.stats(),
+            "retries": {**instance.retry_budget.counters, "budget": round(instance.retry_budget.tokens, 3)}}
+
+@app.get("/admin/replica-stats", summary="Show local read replica statistics")
+async def get_admin_replica_stats():
+    """Return per-table row counts, watermarks and sync age for the local replica."""
+    tables = await asyncio.to_thread(replica_store.stats) if replica_store is not None else {}
+    return {"enabled": replica_store is not None, "max_staleness": SERVICENOW_REPLICA_MAX_STALENESS, **replica_counters, "tables": tables}
+
+@app.get("/admin/subscription-stats", summary="Show change subscription pollers")
+async def get_admin_subscription_stats():
+    """Return the watermark and subscriber counts of each shared table poller."""
+    name = get_instance().name
+    return {table: poller.stats() for (instance, table), poller in table_pollers.items() if instance == name}
+
+@app.get("/admin/cache-stats", summary="Show response cache statistics")
+async def get_admin_cache_stats():
+    """Return the cache backend's hit/miss/invalidation counters (and size, for the in-memory cache)."""
+    return cache_backend.stats()
+
+@app.post("/admin/cache/invalidate", summary="Invalidate cached ServiceNow responses")
+async def invalidate_cache(table: str = None):
+    """Drop the routed instance's cached responses for one table, or all of them; a shared cache tells every worker."""
+    instance = get_instance()
+    return {"instance": instance.name, "table": table, "invalidated": await cache_backend.invalidate(table, instance.cache_namespace)}
+
+@app.get("/admin/instances", summary="List configured ServiceNow instances and their health")
+async def get_admin_instances(check: bool = Query(False, description="Run the health checks again before answering")):
+    """Return every configured instance with its last health check; ``check`` re-runs them concurrently."""
+    if check:
+        await check_instances()
+    return {"default": SERVICENOW_DEFAULT_INSTANCE, "instances": {name: instance.describe() for name, instance in servicenow_instances.items()}}
+
+# --- MCP /resources and /prompt endpoints ---
+
+JSON_TYPES = {int: "integer", float: "number", bool: "boolean", str: "string", list: "array", dict: "object"}
+
+def json_type(annotation) -> str:
+    if get_origin(annotation) is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        if len(args) == 1:
+            annotation = args[0]
+    return JSON_TYPES.get(get_origin(annotation) or annotation, "string")
+
+def route_parameters(route: APIRoute) -> List[Dict[str, Any]]:
+    """Describe a route's path, query and body parameters, including those from dependencies."""
+    parameters = []
+    dependants = [route.dependant]
+    while dependants:
+        dependant = dependants.pop(0)
+        for field in [*dependant.path_params, *dependant.query_params]:
+            parameters.append({"name": field.alias, "type": json_type(field.field_info.annotation), "description": field.field_info.description or ""})
+        for field in dependant.body_params:
+            model = field.field_info.annotation
+            for name, info in getattr(model, "model_fields", {}).items():
+                parameters.append({"name": name, "type": json_type(info.annotation), "description": info.description or ""})
+        dependants[:0] = dependant.dependencies
+    return parameters
+
+def build_resources() -> List[Dict[str, Any]]:
+    """Generate the /resources metadata from every registered tool route."""
+    resources = []
+    for route in app.routes:
+        if not is_tool_route(route):
+            continue
+        for method in sorted(route.methods):
+            resources.append({
+                "name": route.name,
+                "description": route.description.strip().splitlines()[0] if route.description else route.summary,
+                "path": route.path,
+                "method": method,
+                "parameters": route_parameters(route),
+            })
+    return resources
+
+# Built once on first use (and at startup): the resource list, its JSON body and ETag
+MCP_RESOURCES: List[Dict[str, Any]] = []
+resources_payload: Optional[Tuple[bytes, str]] = None
+
+def get_resources_payload() -> Tuple[bytes, str]:
+    global resources_payload
+    if resources_payload is None:
+        MCP_RESOURCES[:] = build_resources()
+        body = json.dumps({"resources": MCP_RESOURCES}, separators=(",", ":")).encode()
+        resources_payload = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+    return resources_payload
 
 @app.get("/resources", summary="List all available MCP resources/tools")
-async def get_resources():
+async def get_resources(request: Request):
     """Return a list of all available tools/resources with metadata."""
-    return {"resources": MCP_RESOURCES}
+    body, etag = get_resources_payload()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# --- Prompt routing ---
+
+# Words that carry no routing signal on their own
+ROUTER_STOPWORDS = frozenset(
+    "a an the for of by to in on at with and or me my i we our us all get show list find give what which is are was "
+    "were please from optional query limit specific servicenow detail details can you this that it its these those "
+    "there their any some".split()
+)
+LIST_INTENT_WORDS = frozenset("list show all find search recent latest top last first open".split())
+DETAIL_INTENT_WORDS = frozenset("detail details get describe info information about lookup look fetch".split())
+
+# Extra vocabulary per tool; table tools share their list tool's words with the detail tool
+TOOL_SYNONYMS = {
+    "test_auth": "auth authentication credentials connectivity login connection",
+    "get_table_description": "describe metadata",
+    "get_table_schema": "schema fields columns structure",
+    "list_tables": "tables",
+    "list_users": "people",
+    "get_user": "user",
+    "list_groups": "team teams",
+    "list_knowledge_articles": "kb knowledge article",
+    "list_catalog_items": "catalog",
+    "list_requested_items": "ritm",
+    "list_change_requests": "change",
+    "list_problems": "problem",
+    "list_assets": "asset hardware",
+    "list_cmdb_items": "ci cis cmdb configuration",
+    "list_audit_records": "audit history",
+    "list_system_logs": "log syslog",
+    "aggregate_records": "aggregate aggregates count counts many per total totals grouped breakdown statistics stats average avg sum minimum maximum",
+    "expand_record": "expand graph related relationships references referenced linked traverse",
+}
+# Words that name a tool rather than a table, e.g. the "schema" in "get table schema for incident"
+TABLE_TOOL_WORDS = frozenset("schema fields field columns column structure description metadata definition".split())
+
+# Record number prefixes and the table each one belongs to
+NUMBER_PREFIX_TABLES = {
+    "INC": "incident", "CHG": "change_request", "PRB": "problem", "RITM": "sc_req_item",
+    "REQ": "sc_request", "TASK": "task", "SCTASK": "task", "KB": "kb_knowledge",
+}
+# How the path parameters of hand-written tools are filled from extracted entities
+PARAM_ENTITY_KINDS = {
+    "incident_number": ("number", "incident"), "user_id": ("user", None), "table_name": ("table", None),
+    "table": ("table", None), "sys_id": ("sys_id", None),
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+")
+NUMBER_PATTERN = re.compile(r"\b(RITM|SCTASK|TASK|INC|CHG|PRB|REQ|KB)(\d{4,})\b", re.IGNORECASE)
+SYS_ID_PATTERN = re.compile(r"\b[0-9a-f]{32}\b", re.IGNORECASE)
+TABLE_PATTERN = re.compile(r"\btable\s+[\"'`]?([a-z][a-z0-9_]*)|[\"'`]?\b([a-z][a-z0-9_]*)[\"'`]?\s+table\b", re.IGNORECASE)
+USER_PATTERN = re.compile(r"\buser(?:\s*name)?\s+[\"'`]?([\w.@-]+)", re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r"\b(?:top|last|first|latest|recent)\s+(\d{1,5})\b", re.IGNORECASE)
+GROUP_BY_PATTERN = re.compile(r"\b(?:per|by)\s+([a-z][a-z0-9_]*(?:\s+[a-z][a-z0-9_]*)*)", re.IGNORECASE)
+
+def stem(word: str) -> str:
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def extract_entities(prompt: str, table_words: Dict[str, str] = None) -> Dict[str, Any]:
+    """Pull record numbers, sys_ids, table names, user names, a row limit and a grouping out of a prompt.
+
+    ``table_words`` maps words such as "incidents" to the table they name. A
+    known table wins over other candidates: first one next to the word
+    "table", then one mentioned anywhere, then any other word next to "table"
+    and finally the first underscored word.
+    """
+    table_words = table_words or {}
+    entities: Dict[str, Any] = {"numbers": {}}
+    for prefix, digits in NUMBER_PATTERN.findall(prompt):
+        entities["numbers"].setdefault(NUMBER_PREFIX_TABLES[prefix.upper()], f"{prefix.upper()}{digits}")
+    sys_id = SYS_ID_PATTERN.search(prompt)
+    if sys_id:
+        entities["sys_id"] = sys_id.group(0).lower()
+    words = TOKEN_PATTERN.findall(prompt.lower())
+    named = [
+        name for match in TABLE_PATTERN.finditer(prompt) for name in [(match.group(1) or match.group(2)).lower()]
+        if name not in ROUTER_STOPWORDS | DETAIL_INTENT_WORDS | TABLE_TOOL_WORDS
+    ]
+    underscored = [word for word in words if "_" in word and not word.startswith("_")]
+    # (table, named): an identifier such as sys_user names a table, a plain word such as "groups" only mentions it
+    candidates = [(table_words[name], True) for name in named if name in table_words]
+    candidates += [(table_words[stem(word)], "_" in word) for word in words if stem(word) in table_words]
+    candidates += [(name, True) for name in named + underscored]
+    if candidates:
+        entities["table"], entities["table_named"] = candidates[0]
+    group_by = GROUP_BY_PATTERN.search(prompt)
+    if group_by:
+        # "per assignment group" -> assignment_group; stop at the first filler word ("by state and priority")
+        field = []
+        for word in group_by.group(1).lower().split():
+            if word in ROUTER_STOPWORDS:
+                break
+            field.append(word)
+        if field:
+            entities["group_by"] = "_".join(field)
+    user = USER_PATTERN.search(prompt)
+    if user and user.group(1).lower() not in ROUTER_STOPWORDS | DETAIL_INTENT_WORDS | LIST_INTENT_WORDS:
+        entities["user"] = user.group(1)
+    elif "sys_id" in entities:
+        entities["user"] = entities["sys_id"]
+    limit = LIMIT_PATTERN.search(prompt)
+    if limit:
+        entities["limit"] = int(limit.group(1))
+    return entities
+
+class PromptRouter:
+    """Map natural-language prompts to tools.
+
+    Built once from the tool metadata: every tool's description and synonyms are
+    tokenized into an inverted index (token -> [(tool, weight)]), with weights of
+    1/document-frequency so distinctive words count most. Routing a prompt costs
+    one tokenizing pass plus a dictionary lookup per token, whatever the number
+    of tools, followed by scoring of the few candidate tools that matched.
+    """
+
+    def __init__(self, resources: List[Dict[str, Any]], table_tools: List[TableTool]):
+        self.tools: Dict[str, Dict[str, Any]] = {}
+        by_list_tool = {tool.list_tool: tool for tool in table_tools}
+        by_detail_tool = {tool.detail_tool: tool for tool in table_tools if tool.detail_tool}
+        # "incident", "incidents", "change_requests" or "users" name a table; "table" itself does not
+        self.table_words: Dict[str, str] = {}
+        for tool in table_tools:
+            synonyms = TOOL_SYNONYMS.get(tool.list_tool, "").split()
+            for word in (tool.table, stem(tool.list_tool[len("list_"):]), *map(stem, synonyms)):
+                if word != "table":
+                    self.table_words.setdefault(word, tool.table)
+        tool_tokens: Dict[str, set] = {}
+        for resource in resources:
+            if resource["method"] != "GET":
+                continue
+            name = resource["name"]
+            table_tool = by_list_tool.get(name) or by_detail_tool.get(name)
+            words = f"{resource['description']} {TOOL_SYNONYMS.get(name, '')}"
+            if table_tool is not None:
+                prefixes = " ".join(prefix for prefix, table in NUMBER_PREFIX_TABLES.items() if table == table_tool.table)
+                words += f" {TOOL_SYNONYMS.get(table_tool.list_tool, '')} {table_tool.table} {prefixes}"
+            # "recent" in one description must not pull every "list recent ..." prompt to that tool
+            tool_tokens[name] = {stem(token) for token in TOKEN_PATTERN.findall(words.lower())} - ROUTER_STOPWORDS - LIST_INTENT_WORDS
+            path_params = re.findall(r"{(\w+)}", resource["path"])
+            self.tools[name] = {
+                "path": resource["path"],
+                "method": resource["method"],
+                "path_params": {param: self.param_entity_kind(param, by_detail_tool.get(name)) for param in path_params},
+                "query_params": {param["name"] for param in resource.get("parameters", [])} - set(path_params),
+                "list_table": table_tool.table if name in by_list_tool else None,
+            }
+        # Tables whose detail tool is looked up by number; list tools need not filter on those numbers
+        self.number_detail_tables = {tool.table for tool in table_tools if tool.detail_tool and tool.lookup_key == "number"}
+        document_frequency: Dict[str, int] = {}
+        for tokens in tool_tokens.values():
+            for token in tokens:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        self.index: Dict[str, List[Tuple[str, float]]] = {}
+        for name, tokens in tool_tokens.items():
+            self.tools[name]["vocabulary_size"] = len(tokens)
+            for token in tokens:
+                self.index.setdefault(token, []).append((name, 1.0 / document_frequency[token]))
+
+    @staticmethod
+    def param_entity_kind(param: str, table_tool: Optional[TableTool]) -> Tuple[str, Optional[str]]:
+        if table_tool is not None:
+            return ("number", table_tool.table) if table_tool.lookup_key == "number" else ("sys_id", None)
+        return PARAM_ENTITY_KINDS.get(param, ("unknown", None))
+
+    @staticmethod
+    def fill(kind: Tuple[str, Optional[str]], entities: Dict[str, Any]) -> Optional[str]:
+        entity, table = kind
+        if entity == "number":
+            return entities["numbers"].get(table)
+        return entities.get(entity)
+
+    def route(self, prompt: str) -> Optional[Dict[str, Any]]:
+        words = TOKEN_PATTERN.findall(prompt.lower())
+        entities = extract_entities(prompt, self.table_words)
+        # A bare record number (e.g. "RITM0010001") names its table through the prefix
+        tokens = {stem(word) for word in words} | {number.rstrip("0123456789").lower() for number in entities["numbers"].values()}
+        scores: Dict[str, float] = {}
+        matched: Dict[str, int] = {}
+        for token in tokens:
+            for name, weight in self.index.get(token, ()):
+                scores[name] = scores.get(name, 0.0) + weight
+                matched[name] = matched.get(name, 0) + 1
+        if not scores:
+            return None
+        list_intent = not LIST_INTENT_WORDS.isdisjoint(words)
+        detail_intent = not DETAIL_INTENT_WORDS.isdisjoint(words)
+        best = None
+        for name, score in scores.items():
+            tool = self.tools[name]
+            # Between otherwise equal tools, prefer the one whose vocabulary the prompt covers best
+            score += 0.1 * matched[name] / tool["vocabulary_size"]
+            parameters: Dict[str, Any] = {}
+            for param, kind in tool["path_params"].items():
+                value = self.fill(kind, entities)
+                if value is None:
+                    break
+                parameters[param] = value
+            else:
+                # A table that is only mentioned ("list groups") is no evidence for tools taking just a table
+                only_mentioned = set(tool["path_params"].values()) == {("table", None)} and not entities["table_named"]
+                if tool["path_params"] and not only_mentioned:
+                    score += 1.5
+                    score += 0.3 if detail_intent else 0.0
+                elif tool["list_table"] is not None:
+                    number = entities["numbers"].get(tool["list_table"])
+                    if number and tool["list_table"] not in self.number_detail_tables:
+                        parameters["query"] = f"number={number}"
+                        score += 1.0
+                    if "limit" in entities:
+                        parameters["limit"] = entities["limit"]
+                    score += 0.3 if list_intent else 0.0
+                if "group_by" in entities and "group_by" in tool["query_params"]:
+                    parameters["group_by"] = entities["group_by"]
+                if best is None or score > best[0]:
+                    best = (score, name, parameters)
+        if best is None:
+            return None
+        _, name, parameters = best
+        tool = self.tools[name]
+        endpoint = tool["path"]
+        for param in tool["path_params"]:
+            endpoint = endpoint.replace(f"{{{param}}}", str(parameters[param]))
+        return {"tool": name, "endpoint": endpoint, "method": tool["method"], "parameters": parameters}
+
+prompt_router: Optional[PromptRouter] = None
+
+def get_prompt_router() -> PromptRouter:
+    global prompt_router
+    if prompt_router is None:
+        get_resources_payload()
+        prompt_router = PromptRouter(MCP_RESOURCES, TABLE_TOOLS)
+    return prompt_router
 
 @app.post("/prompt", summary="Map a prompt to a tool/resource")
 async def prompt_tool(request: Request):
-    """Accept a prompt and map it to a tool/resource (basic pattern matching)."""
+    """Accept a prompt and map it to a tool/resource using the compiled prompt router."""
     data = await request.json()
-    prompt = data.get("prompt", "").lower()
-    # Simple rule-based mapping
-    if "short description" in prompt and "incident" in prompt:
-        # Extract incident number
-        import re
-        match = re.search(r"inc\d+", prompt, re.IGNORECASE)
-        if match:
-            inc_num = match.group(0).upper()
-            return {
-                "tool": "get_incident_short_description",
-                "endpoint": f"/incident-short-description/{inc_num}",
-                "method": "GET",
-                "parameters": {"incident_number": inc_num}
-            }
-    if "list users" in prompt or "show users" in prompt:
-        return {
-            "tool": "list_users",
-            "endpoint": "/users",
-            "method": "GET",
-            "parameters": {}
-        }
-    if "incident" in prompt and "details" in prompt:
-        match = re.search(r"inc\d+", prompt, re.IGNORECASE)
-        if match:
-            inc_num = match.group(0).upper()
-            return {
-                "tool": "get_incident",
-                "endpoint": f"/incident/{inc_num}",
-                "method": "GET",
-                "parameters": {"incident_number": inc_num}
-            }
-    # Add more rules as needed for other endpoints
-    return {"error": "Could not map prompt to a tool. Please rephrase or use a supported pattern."} 
\ No newline at end of file
+    match = get_prompt_router().route(data.get("prompt", ""))
+    if match is None:
+        return {"error": "Could not map prompt to a tool. Please rephrase or use a supported pattern."}
+    return match
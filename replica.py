@@ -0,0 +1,296 @@
+"""Local SQLite read replica of hot ServiceNow tables.
+
+Rows are stored as JSON documents keyed by ``sys_id``, with expression indexes
+on ``number`` and each table's common filter fields. ``sync_table`` pulls
+changes incrementally using a ``sys_updated_on`` high-water mark that is
+persisted with the data, so a restart resumes where the last sync stopped.
+Deletions never show up in that feed, so ``reconcile_table`` periodically
+compares the full ``sys_id`` list and drops rows the instance no longer has.
+Text comparisons use ``COLLATE NOCASE``, like the instance's collation.
+"""
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from encoded_query import COMPARISON_OPERATORS, Condition, EncodedQuery, is_number
+
+# Fields worth an index per table, on top of sys_id, number and sys_updated_on
+REPLICA_INDEX_FIELDS: Dict[str, List[str]] = {
+    "incident": ["state", "priority", "active", "assigned_to", "assignment_group", "caller_id", "cmdb_ci"],
+    "task": ["state", "priority", "active", "assigned_to", "assignment_group", "sys_class_name"],
+    "sys_user": ["user_name", "email", "active"],
+    "cmdb_ci": ["name", "sys_class_name", "operational_status"],
+}
+
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+Fetch = Callable[[str, dict], Awaitable[dict]]
+
+def check_identifier(name: str) -> str:
+    """Table and field names end up inside SQL text, so only plain identifiers are allowed."""
+    if not IDENTIFIER_PATTERN.match(name):
+        raise ValueError(f"Invalid table or field name: {name!r}")
+    return name
+
+def field_expression(field: str) -> str:
+    """SQL expression for a field's raw value; reference fields are stored as {"link", "value"} objects."""
+    field = check_identifier(field)
+    return f"coalesce(json_extract(data, '$.{field}.value'), json_extract(data, '$.{field}'))"
+
+def column_expression(field: str) -> str:
+    """Like field_expression, but reads the promoted columns directly so their indexes apply."""
+    return field if field in ("sys_id", "number", "sys_updated_on") else field_expression(field)
+
+def like_pattern(text: str, prefix: str = "%", suffix: str = "%") -> str:
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{prefix}{escaped}{suffix}"
+
+def condition_sql(condition: Condition) -> Tuple[str, List[Any]]:
+    """SQL for one condition, matching encoded_query's evaluator (missing fields read as '')."""
+    op, value = condition.operator, condition.value
+    # NOCASE on the left operand, so the NOCASE indexes from ensure_table apply
+    expression = f"{column_expression(condition.field)} COLLATE NOCASE"
+    text = f"coalesce({column_expression(condition.field)}, '') COLLATE NOCASE"
+    if op == "=":
+        return (f"{expression} = ?" if value else f"{text} = ?"), [value]
+    if op == "!=":
+        return f"{text} != ?", [value]
+    if op in ("IN", "NOT IN"):
+        values = value.split(",")
+        return f"{expression if op == 'IN' else text} {op} ({', '.join('?' * len(values))})", values
+    if op in ("ISEMPTY", "ISNOTEMPTY"):
+        return f"{text} {'=' if op == 'ISEMPTY' else '!='} ''", []
+    if op in COMPARISON_OPERATORS:
+        if is_number(value):
+            return f"CAST({text} AS REAL) {op} ?", [float(value)]
+        return f"{text} {op} ?", [value]
+    pattern = {
+        "LIKE": like_pattern(value), "NOT LIKE": like_pattern(value),
+        "STARTSWITH": like_pattern(value, prefix=""), "ENDSWITH": like_pattern(value, suffix=""),
+    }[op]
+    return f"{text} {'NOT LIKE' if op == 'NOT LIKE' else 'LIKE'} ? ESCAPE '\\'", [pattern]
+
+def query_sql(query: EncodedQuery, default_order: str = "sys_updated_on DESC") -> Tuple[str, Tuple, str]:
+    """Translate a parsed encoded query into a ``where`` clause, its arguments and an ``ORDER BY``."""
+    args: List[Any] = []
+    groups = []
+    for group in query.groups:
+        clauses = []
+        for clause in group:
+            terms = []
+            for condition in clause:
+                sql, values = condition_sql(condition)
+                terms.append(sql)
+                args.extend(values)
+            clauses.append(terms[0] if len(terms) == 1 else f"({' OR '.join(terms)})")
+        groups.append(" AND ".join(clauses))
+    where = groups[0] if len(groups) == 1 else " OR ".join(f"({group})" for group in groups)
+    order_terms = []
+    for field, descending in query.order_by:
+        # Numeric text sorts as a number first, like encoded_query.sort_key
+        text, direction = f"coalesce({column_expression(field)}, '')", "DESC" if descending else "ASC"
+        order_terms.append(f"CAST({text} AS REAL) {direction}, {text} COLLATE NOCASE {direction}")
+    return where, tuple(args), ", ".join(order_terms) or default_order
+
+def field_value(row: Dict[str, Any], field: str) -> Any:
+    value = row.get(field)
+    return value.get("value") if isinstance(value, dict) else value
+
+class ReplicaStore:
+    """SQLite-backed store of replicated rows plus per-table sync state."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS replica_state ("
+            "table_name TEXT PRIMARY KEY, high_water TEXT NOT NULL DEFAULT '', "
+            "last_sync REAL NOT NULL DEFAULT 0, rows_synced INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.tables: set = set()
+        self.state: Dict[str, Dict[str, Any]] = {
+            name: {"high_water": high_water, "last_sync": last_sync, "rows_synced": rows_synced}
+            for name, high_water, last_sync, rows_synced in self.connection.execute("SELECT * FROM replica_state")
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def ensure_table(self, table: str):
+        if table in self.tables:
+            return
+        name = check_identifier(table)
+        with self.lock:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "r_{name}" ('
+                "sys_id TEXT PRIMARY KEY, number TEXT, sys_updated_on TEXT NOT NULL DEFAULT '', data TEXT NOT NULL)"
+            )
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS "r_{name}_updated" ON "r_{name}"(sys_updated_on)')
+            # Lookups compare case-insensitively, so the lookup indexes are NOCASE too
+            for field in ["sys_id", "number", *REPLICA_INDEX_FIELDS.get(table, [])]:
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS "r_{name}_{check_identifier(field)}_nocase" '
+                    f'ON "r_{name}"({column_expression(field)} COLLATE NOCASE)'
+                )
+        self.tables.add(table)
+
+    def upsert(self, table: str, rows: List[Dict[str, Any]], high_water: str):
+        """Write a page of rows and advance the table's high-water mark in one transaction."""
+        self.ensure_table(table)
+        records = [
+            (field_value(row, "sys_id"), field_value(row, "number"), field_value(row, "sys_updated_on") or "", json.dumps(row))
+            for row in rows if field_value(row, "sys_id")
+        ]
+        state = self.state.setdefault(table, {"high_water": "", "last_sync": 0.0, "rows_synced": 0})
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    f'INSERT INTO "r_{table}" (sys_id, number, sys_updated_on, data) VALUES (?, ?, ?, ?) '
+                    "ON CONFLICT(sys_id) DO UPDATE SET number=excluded.number, sys_updated_on=excluded.sys_updated_on, data=excluded.data",
+                    records,
+                )
+                self.connection.execute(
+                    "INSERT INTO replica_state (table_name, high_water, rows_synced) VALUES (?, ?, ?) "
+                    "ON CONFLICT(table_name) DO UPDATE SET high_water=excluded.high_water, rows_synced=rows_synced + ?",
+                    (table, high_water, len(records), len(records)),
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        state["high_water"] = high_water
+        state["rows_synced"] += len(records)
+
+    def mark_synced(self, table: str, when: float = None):
+        when = time.time() if when is None else when
+        state = self.state.setdefault(table, {"high_water": "", "last_sync": 0.0, "rows_synced": 0})
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO replica_state (table_name, last_sync) VALUES (?, ?) "
+                "ON CONFLICT(table_name) DO UPDATE SET last_sync=excluded.last_sync",
+                (table, when),
+            )
+        state["last_sync"] = when
+
+    def high_water(self, table: str) -> str:
+        return self.state.get(table, {}).get("high_water", "")
+
+    def age(self, table: str) -> Optional[float]:
+        """Seconds since the table last finished a sync, or None if it never has."""
+        last_sync = self.state.get(table, {}).get("last_sync")
+        return time.time() - last_sync if last_sync else None
+
+    def select(self, table: str, where: str = "", args: Tuple = (), order_by: str = "sys_updated_on DESC",
+               limit: int = None, offset: int = 0) -> List[Dict[str, Any]]:
+        """Return decoded rows matching a SQL ``where`` clause built from field_expression()."""
+        self.ensure_table(table)
+        sql = f'SELECT data FROM "r_{table}"'
+        if where:
+            sql += f" WHERE {where}"
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        if limit:
+            sql += f" LIMIT {int(limit)} OFFSET {int(offset)}"
+        with self.lock:
+            return [json.loads(data) for (data,) in self.connection.execute(sql, args)]
+
+    def lookup(self, table: str, field: str, value: str) -> Optional[Dict[str, Any]]:
+        rows = self.select(table, f"{column_expression(field)} COLLATE NOCASE = ?", (value,), order_by="", limit=1)
+        return rows[0] if rows else None
+
+    def delete_missing(self, table: str, keep: set, high_water: str) -> int:
+        """Delete rows whose sys_id is not in ``keep``; rows written after ``high_water`` are left alone."""
+        self.ensure_table(table)
+        with self.lock:
+            local = self.connection.execute(f'SELECT sys_id FROM "r_{table}" WHERE sys_updated_on <= ?', (high_water,))
+            gone = [(sys_id,) for (sys_id,) in local.fetchall() if sys_id not in keep]
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(f'DELETE FROM "r_{table}" WHERE sys_id = ?', gone)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return len(gone)
+
+    def count(self, table: str) -> int:
+        self.ensure_table(table)
+        with self.lock:
+            return self.connection.execute(f'SELECT count(*) FROM "r_{table}"').fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            table: {**state, "rows": self.count(table), "age_seconds": self.age(table)}
+            for table, state in self.state.items()
+        }
+
+async def sync_table(store: ReplicaStore, table: str, fetch: Fetch, page_size: int = 1000) -> int:
+    """Pull rows changed since the table's high-water mark; return how many were written.
+
+    Pages are walked by keyset on ``sys_updated_on`` rather than by plain offset,
+    so records updated while the sync runs cannot shift other rows past a page
+    boundary. The offset only grows while a whole page shares one timestamp.
+    """
+    endpoint = f"/api/now/table/{check_identifier(table)}"
+    high_water = store.high_water(table)
+    offset = 0
+    written = 0
+    while True:
+        query = f"sys_updated_on>={high_water}^" if high_water else ""
+        params = {
+            "sysparm_query": f"{query}ORDERBYsys_updated_on^ORDERBYsys_id",
+            "sysparm_limit": page_size,
+            "sysparm_offset": offset,
+        }
+        rows = (await fetch(endpoint, params)).get("result", [])
+        if not rows:
+            break
+        last = field_value(rows[-1], "sys_updated_on") or high_water
+        await asyncio.to_thread(store.upsert, table, rows, last)
+        written += len(rows)
+        if last == high_water:
+            offset += len(rows)
+        else:
+            # Restart from the newest timestamp, skipping the rows already read that share it
+            high_water = last
+            offset = sum(1 for row in rows if field_value(row, "sys_updated_on") == last)
+        if len(rows) < page_size:
+            break
+    await asyncio.to_thread(store.mark_synced, table)
+    return written
+
+async def reconcile_table(store: ReplicaStore, table: str, fetch: Fetch, page_size: int = 1000) -> int:
+    """Drop replicated rows whose records were deleted on the instance; return how many went.
+
+    Reads every ``sys_id`` by keyset (``sys_id>last``), so deletions during the
+    pass cannot shift a page boundary and hide a live record. Only rows at or
+    before the high-water mark seen at the start are candidates, so a sync that
+    writes a new record while the pass runs cannot lose it.
+    """
+    endpoint = f"/api/now/table/{check_identifier(table)}"
+    high_water = store.high_water(table)
+    if not high_water:
+        return 0
+    keep = set()
+    last = ""
+    while True:
+        params = {
+            "sysparm_query": f"{f'sys_id>{last}^' if last else ''}ORDERBYsys_id",
+            "sysparm_fields": "sys_id",
+            "sysparm_limit": page_size,
+        }
+        rows = (await fetch(endpoint, params)).get("result", [])
+        keep.update(field_value(row, "sys_id") for row in rows)
+        if len(rows) < page_size:
+            break
+        last = field_value(rows[-1], "sys_id")
+    return await asyncio.to_thread(store.delete_missing, table, keep, high_water)
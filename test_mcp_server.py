@@ -1,8 +1,39 @@
+import asyncio
+import json
+import time
 import pytest
+import pytest_asyncio
+import httpx
 from httpx import AsyncClient
 from fastapi import status
-from mcp_server import app
+import mcp_server
+from mcp_server import (
+    app, AdaptiveRateLimiter, CacheBackend, Histogram, MemoryCacheBackend, ResponseCache, parse_retry_after,
+)
 from unittest.mock import patch, AsyncMock
+from encoded_query import EncodedQuery, QueryParseError
+from replica import ReplicaStore, reconcile_table, sync_table
+from benchmarks.load_test import build_requests, compare
+from benchmarks.servicenow_stub import create_stub_app
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    # Handlers can leave cached lists behind even when servicenow_get is mocked
+    mcp_server.response_cache.invalidate()
+
+@pytest_asyncio.fixture
+async def upstream():
+    """Answer an instance's upstream calls (the default instance unless given) with a handler or transport."""
+    installed = []
+    def install(handler, instance=None):
+        instance = instance or mcp_server.get_instance()
+        transport = handler if isinstance(handler, httpx.AsyncBaseTransport) else httpx.MockTransport(handler)
+        instance.client = httpx.AsyncClient(transport=transport, base_url=instance.url)
+        installed.append(instance)
+        return instance
+    yield install
+    for instance in installed:
+        await instance.close()
 
 # Helper to mock ServiceNow API responses
 def mock_servicenow_get(endpoint, params=None):
@@ -96,4 +127,835 @@ async def test_all_detail_endpoints_not_found(mock_get):
         ]
         for ep in detail_endpoints:
             resp = await ac.get(ep)
-            assert resp.status_code == status.HTTP_404_NOT_FOUND 
\ No newline at end of file
+            assert resp.status_code == status.HTTP_404_NOT_FOUND 
+
+@pytest.mark.asyncio
+async def test_servicenow_get_reuses_shared_client(upstream):
+    seen = []
+    def handler(request):
+        seen.append(request.url.path)
+        return httpx.Response(200, json={"result": [{"sys_id": "user1"}]})
+    upstream(handler)
+    client = mcp_server.get_http_client()
+    for _ in range(3):
+        data = await mcp_server.servicenow_get("/api/now/table/syslog", params={"sysparm_limit": 1})
+        assert data["result"][0]["sys_id"] == "user1"
+    assert mcp_server.get_http_client() is client
+    assert seen == ["/api/now/table/syslog"] * 3
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.get("/admin/pool-stats")
+        assert resp.status_code == status.HTTP_200_OK
+        assert resp.json()["in_flight"] == 0
+
+def test_response_cache_ttl_and_lru_eviction():
+    cache = ResponseCache(max_entries=2, max_bytes=100)
+    cache.set("a", "incident", {"result": "a"}, 10, ttl=60)
+    cache.set("b", "sys_user", {"result": "b"}, 10, ttl=60)
+    assert cache.get("a") == {"result": "a"}
+    cache.set("c", "sys_user", {"result": "c"}, 10, ttl=60)
+    assert cache.get("b") is None  # least recently used
+    cache.set("d", "incident", {"result": "d"}, 95, ttl=60)
+    assert cache.get("a") is None and cache.get("c") is None  # evicted by byte size
+    cache.set("e", "incident", {"result": "e"}, 1, ttl=0)
+    assert cache.get("e") is None
+    assert cache.stats()["evictions"] == 3
+
+def test_cache_backend_requires_every_operation():
+    class GetOnly(CacheBackend):
+        async def get(self, key):
+            return None
+    with pytest.raises(TypeError):
+        GetOnly()
+    assert MemoryCacheBackend(ResponseCache(max_entries=1, max_bytes=100)).stats() is not None
+
+@pytest.mark.asyncio
+async def test_servicenow_get_caches_metadata_tables(upstream):
+    calls = []
+    def handler(request):
+        calls.append(str(request.url))
+        return httpx.Response(200, json={"result": [{"name": "incident"}]})
+    upstream(handler)
+    params = {"sysparm_query": "name=incident", "sysparm_fields": "name,label"}
+    await mcp_server.servicenow_get("/api/now/table/sys_db_object", params=params)
+    await mcp_server.servicenow_get("/api/now/table/sys_db_object", params=dict(reversed(list(params.items()))))
+    assert len(calls) == 1
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.post("/admin/cache/invalidate", params={"table": "sys_db_object"})
+        assert resp.json()["invalidated"] == 1
+    await mcp_server.servicenow_get("/api/now/table/sys_db_object", params=params)
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_servicenow_get_coalesces_identical_inflight_requests(upstream):
+    calls = []
+    async def handler(request):
+        calls.append(str(request.url))
+        await asyncio.sleep(0.05)
+        if "fail" in str(request.url):
+            return httpx.Response(500, text="server error")
+        return httpx.Response(200, json={"result": [{"number": "INC0001"}]})
+    upstream(handler)
+    params = {"sysparm_query": "number=INC0001"}
+    waiters = [asyncio.ensure_future(mcp_server.servicenow_get("/api/now/table/syslog", params=params)) for _ in range(5)]
+    await asyncio.sleep(0.01)
+    waiters[0].cancel()
+    results = await asyncio.gather(*waiters[1:])
+    assert len(calls) == 1
+    assert all(r["result"][0]["number"] == "INC0001" for r in results)
+    errors = await asyncio.gather(
+        *[mcp_server.servicenow_get("/api/now/table/syslog", params={"sysparm_query": "fail"}) for _ in range(3)],
+        return_exceptions=True,
+    )
+    assert len(calls) == 2
+    assert all(getattr(e, "status_code", None) == 500 for e in errors)
+    assert not mcp_server.inflight_requests
+
+@pytest.mark.asyncio
+async def test_list_endpoint_streams_ndjson_pages(monkeypatch):
+    rows = [{"sys_id": f"audit{i:02d}"} for i in range(25)]
+    def paged_servicenow_get(endpoint, params=None, use_cache=True):
+        assert endpoint == "/api/now/table/sys_audit" and not use_cache
+        assert params["sysparm_query"] == "fieldname=state^ORDERBYsys_id"
+        offset = params["sysparm_offset"]
+        return {"result": rows[offset:offset + params["sysparm_limit"]]}
+    monkeypatch.setattr(mcp_server, "SERVICENOW_STREAM_PAGE_SIZE", 10)
+    with patch("mcp_server.servicenow_get", AsyncMock(side_effect=paged_servicenow_get)) as mock_get:
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.get("/audit-records", params={"stream": "true", "query": "fieldname=state"})
+            assert resp.status_code == status.HTTP_200_OK
+            assert resp.headers["content-type"] == "application/x-ndjson"
+            assert [json.loads(line) for line in resp.text.splitlines()] == rows
+            resp = await ac.get("/audit-records", params={"stream": "true", "limit": 15, "query": "fieldname=state"})
+            assert len(resp.text.splitlines()) == 15
+
+@pytest.mark.asyncio
+@patch("mcp_server.servicenow_get", new_callable=lambda: AsyncMock(side_effect=mock_servicenow_get))
+async def test_projection_params_passed_to_table_api(mock_get):
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        projection = {"fields": "number,state", "display_value": "all", "exclude_reference_link": "true"}
+        for ep in ["/incidents", "/incident/INC0001", "/cmdb-item/ci1"]:
+            resp = await ac.get(ep, params=projection)
+            assert resp.status_code == status.HTTP_200_OK
+            params = mock_get.call_args.kwargs["params"]
+            assert params["sysparm_fields"] == "number,state"
+            assert params["sysparm_display_value"] == "all"
+            assert params["sysparm_exclude_reference_link"] == "true"
+        resp = await ac.get("/incidents", params={"display_value": "maybe"})
+        assert resp.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+@pytest.mark.asyncio
+async def test_batch_runs_calls_in_order_and_merges_sys_id_lookups():
+    def batch_servicenow_get(endpoint, params=None):
+        if endpoint == "/api/now/table/cmdb_ci":
+            assert params["sysparm_query"] == "sys_idINci1,ci2,missing"
+            return {"result": [{"sys_id": "ci2", "name": "CI 2"}, {"sys_id": "ci1", "name": "CI 1"}]}
+        return mock_servicenow_get(endpoint, params)
+    with patch("mcp_server.servicenow_get", AsyncMock(side_effect=batch_servicenow_get)) as mock_get:
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.post("/batch", json={"calls": [
+                {"tool": "get_cmdb_item", "parameters": {"ci_id": "ci1"}},
+                {"tool": "get_cmdb_item", "parameters": {"ci_id": "ci2"}},
+                {"tool": "get_cmdb_item", "parameters": {"ci_id": "missing"}},
+                {"tool": "list_users", "parameters": {"limit": 1}},
+                {"tool": "get_incident", "parameters": {}},
+                {"tool": "no_such_tool"},
+            ]})
+            assert resp.status_code == status.HTTP_200_OK
+            results = resp.json()["results"]
+            assert [r["status"] for r in results] == [200, 200, 404, 200, 422, 404]
+            assert results[0]["result"]["name"] == "CI 1"
+            assert results[1]["result"]["name"] == "CI 2"
+            assert results[3]["result"][0]["user_name"] == "testuser"
+            cmdb_calls = [c for c in mock_get.call_args_list if c.args[0] == "/api/now/table/cmdb_ci"]
+            assert len(cmdb_calls) == 1
+
+@pytest.mark.asyncio
+async def test_batch_merges_lookups_beyond_the_concurrency_limit(monkeypatch):
+    monkeypatch.setattr(mcp_server, "SERVICENOW_BATCH_CONCURRENCY", 3)
+
+    async def lookup(endpoint, params=None):
+        ids = params["sysparm_query"][len("sys_idIN"):].split(",")
+        return {"result": [{"sys_id": sys_id, "name": sys_id.upper()} for sys_id in ids]}
+    with patch("mcp_server.servicenow_get", AsyncMock(side_effect=lookup)) as mock_get:
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            calls = [{"tool": "get_cmdb_item", "parameters": {"ci_id": f"ci{i}"}} for i in range(20)]
+            resp = await ac.post("/batch", json={"calls": calls})
+    assert [r["result"]["name"] for r in resp.json()["results"]] == [f"CI{i}" for i in range(20)]
+    assert mock_get.await_count == 1
+
+@pytest.mark.asyncio
+async def test_get_user_uses_single_lookup():
+    users = {"result": [{"sys_id": "other", "user_name": "abc"}, {"sys_id": "abc", "user_name": "someone"}]}
+    with patch("mcp_server.servicenow_get", AsyncMock(return_value=users)) as mock_get:
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.get("/user/abc")
+            assert resp.json()["sys_id"] == "abc"
+            assert mock_get.await_count == 1
+            assert mock_get.call_args.kwargs["params"]["sysparm_query"] == "sys_id=abc^ORuser_name=abc"
+
+@pytest.mark.asyncio
+async def test_table_schema_includes_inherited_fields():
+    def schema_servicenow_get(endpoint, params=None):
+        query = params["sysparm_query"]
+        if endpoint == "/api/now/table/sys_db_object":
+            return {"result": [{"name": "incident", "label": "Incident", "super_class.name": "task", "super_class.super_class.name": ""}]}
+        fields = {
+            "name=incident": [{"name": "incident", "element": "caller_id"}, {"name": "incident", "element": "number"}],
+            "name=task": [{"name": "task", "element": "number"}, {"name": "task", "element": "short_description"}],
+        }
+        return {"result": fields[query]}
+    with patch("mcp_server.servicenow_get", AsyncMock(side_effect=schema_servicenow_get)):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.get("/table-schema/incident")
+            body = resp.json()
+            assert body["hierarchy"] == ["incident", "task"]
+            assert [(f["name"], f["element"]) for f in body["fields"]] == [
+                ("incident", "caller_id"), ("incident", "number"), ("task", "short_description")]
+            assert "super_class.name" not in body["table"]
+
+@pytest.mark.asyncio
+async def test_servicenow_get_retries_throttled_requests(monkeypatch, upstream):
+    monkeypatch.setattr(mcp_server, "SERVICENOW_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(mcp_server.get_instance(), "rate_limiter", mcp_server.AdaptiveRateLimiter(20, 1, 100, 20))
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "0"}, text="throttled"),
+        httpx.Response(503, text="unavailable"),
+        httpx.Response(200, json={"result": [{"sys_id": "log1"}]}),
+    ]
+    upstream(lambda request: responses.pop(0))
+    data = await mcp_server.servicenow_get("/api/now/table/syslog", params={"sysparm_limit": 1})
+    assert data["result"][0]["sys_id"] == "log1"
+    assert not responses
+    stats = mcp_server.get_instance().rate_limiter.stats()
+    assert stats["throttled"] == 1
+    assert stats["rate"] < 20
+
+def test_rate_limiter_follows_rate_limit_headers():
+    limiter = AdaptiveRateLimiter(rate=50, min_rate=1, max_rate=100, burst=10)
+    limiter.on_response(httpx.Headers({"X-RateLimit-Remaining": "20", "X-RateLimit-Reset": str(time.time() + 10)}))
+    assert limiter.rate == pytest.approx(2, rel=0.1)
+    limiter.on_throttled(5)
+    assert limiter.rate == pytest.approx(1, rel=0.1)
+    assert limiter.stats()["paused_for"] > 4
+    assert parse_retry_after("7") == 7
+    assert parse_retry_after("garbage") is None
+
+@pytest.mark.asyncio
+@patch("mcp_server.servicenow_get", new_callable=lambda: AsyncMock(side_effect=mock_servicenow_get))
+async def test_metrics_endpoint_reports_per_tool_counts(mock_get):
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        await ac.get("/incidents")
+        await ac.get("/incident/doesnotexist-but-mocked")
+        resp = await ac.get("/metrics")
+        assert resp.status_code == status.HTTP_200_OK
+        assert resp.headers["content-type"].startswith("text/plain")
+        body = resp.text
+        assert 'mcp_tool_requests_total{tool="list_incidents",status="200"}' in body
+        assert 'mcp_tool_request_duration_seconds_bucket{tool="get_incident",le="+Inf"}' in body
+        assert "# TYPE servicenow_upstream_duration_seconds histogram" in body
+        assert "servicenow_cache_hits" in body
+        assert "\nmcp_tool_requests_in_flight 0\n" in body
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("h", "test", ("table",), buckets=(1, 2))
+    for value in (0.5, 1.5, 1.7, 5):
+        histogram.observe(("incident",), value)
+    lines = histogram.render()
+    assert 'h_bucket{table="incident",le="1"} 1' in lines
+    assert 'h_bucket{table="incident",le="2"} 3' in lines
+    assert 'h_bucket{table="incident",le="+Inf"} 4' in lines
+    assert 'h_count{table="incident"} 4' in lines
+
+@pytest.mark.asyncio
+async def test_resources_cover_every_tool_and_support_etag():
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.get("/resources")
+        assert resp.status_code == status.HTTP_200_OK
+        resources = {r["name"]: r for r in resp.json()["resources"]}
+        for tool in mcp_server.TABLE_TOOLS:
+            assert tool.list_tool in resources
+            assert tool.detail_tool is None or tool.detail_tool in resources
+        assert {"test_auth", "get_user", "get_table_schema", "batch"} <= set(resources)
+        assert "get_admin_pool_stats" not in resources
+        params = {p["name"]: p for p in resources["get_cmdb_item"]["parameters"]}
+        assert params["ci_id"]["type"] == "string"
+        assert params["exclude_reference_link"]["type"] == "boolean"
+        etag = resp.headers["etag"]
+        resp = await ac.get("/resources", headers={"If-None-Match": etag})
+        assert resp.status_code == status.HTTP_304_NOT_MODIFIED
+        assert resp.content == b""
+
+@pytest.mark.asyncio
+async def test_prompt_router_maps_prompts_to_tools():
+    cases = [
+        ("Get the short description for incident INC0008001", "get_incident_short_description", {"incident_number": "INC0008001"}),
+        ("list users", "list_users", {}),
+        ("show me the details of incident inc0000042", "get_incident", {"incident_number": "INC0000042"}),
+        ("Describe the 'incident' table in ServiceNow.", "get_table_description", {"table_name": "incident"}),
+        ("which fields are on cmdb_ci", "get_table_schema", {"table_name": "cmdb_ci"}),
+        ("show change CHG0030001", "list_change_requests", {"query": "number=CHG0030001"}),
+        ("last 5 problems", "list_problems", {"limit": 5}),
+        ("get group 6816f79cc0a8016401c5a33be04be441", "get_group", {"group_id": "6816f79cc0a8016401c5a33be04be441"}),
+        # "schema" and "fields" name the tool, not the table
+        ("get table schema for incident", "get_table_schema", {"table_name": "incident"}),
+        ("show the schema for table incident", "get_table_schema", {"table_name": "incident"}),
+        ("count incidents per assignment_group", "aggregate_records", {"table_name": "incident", "group_by": "assignment_group"}),
+        ("how many open P1 incidents per assignment group", "aggregate_records",
+         {"table_name": "incident", "group_by": "assignment_group"}),
+        ("number of changes per risk", "aggregate_records", {"table_name": "change_request", "group_by": "risk"}),
+        ("list recent problems", "list_problems", {}),
+        ("list groups", "list_groups", {}),
+        ("expand incident 9d385017c611228701d22104cc95c371", "expand_record",
+         {"table": "incident", "sys_id": "9d385017c611228701d22104cc95c371"}),
+        ("what is linked to change_request 9d385017c611228701d22104cc95c371", "expand_record",
+         {"table": "change_request", "sys_id": "9d385017c611228701d22104cc95c371"}),
+    ]
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        for prompt, tool, parameters in cases:
+            resp = await ac.post("/prompt", json={"prompt": prompt})
+            assert resp.json()["tool"] == tool, prompt
+            assert resp.json()["parameters"] == parameters, prompt
+        resp = await ac.post("/prompt", json={"prompt": "what's the weather in paris"})
+        assert "error" in resp.json()
+
+@pytest.mark.asyncio
+async def test_replica_sync_resumes_and_serves_reads(tmp_path, monkeypatch):
+    rows = [
+        {"sys_id": f"id{i}", "number": f"INC{i:07d}", "state": "1" if i % 2 else "2",
+         "sys_updated_on": f"2024-01-01 00:00:{i // 2:02d}"}
+        for i in range(10)
+    ]
+
+    async def fake_fetch(endpoint, params):
+        matching = EncodedQuery.parse(params["sysparm_query"]).apply(rows)
+        offset = params.get("sysparm_offset", 0)
+        return {"result": matching[offset:offset + params["sysparm_limit"]]}
+
+    path = str(tmp_path / "replica.db")
+    store = ReplicaStore(path)
+    await sync_table(store, "incident", fake_fetch, page_size=3)
+    assert store.count("incident") == 10
+    store.close()
+
+    rows.append({"sys_id": "id10", "number": "INC0000010", "state": "1", "sys_updated_on": "2024-01-01 00:01:00"})
+    store = ReplicaStore(path)
+    assert store.high_water("incident") == "2024-01-01 00:00:04"
+    await sync_table(store, "incident", fake_fetch, page_size=3)
+    assert store.count("incident") == 11
+    assert store.high_water("incident") == "2024-01-01 00:01:00"
+
+    # Deleted upstream: only the reconcile pass notices
+    rows[:] = [row for row in rows if row["sys_id"] not in ("id4", "id8")]
+    await sync_table(store, "incident", fake_fetch, page_size=3)
+    assert store.count("incident") == 11
+    assert await reconcile_table(store, "incident", fake_fetch, page_size=3) == 2
+    assert store.count("incident") == 9
+
+    monkeypatch.setattr(mcp_server, "replica_store", store)
+    mock_get = AsyncMock(return_value={"result": [{"sys_id": "upstream"}]})
+    with patch("mcp_server.servicenow_get", mock_get):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.get("/incidents", params={"query": "state=1", "limit": 2, "fields": "number"})
+            assert resp.json() == [{"number": "INC0000010"}, {"number": "INC0000009"}]
+            resp = await ac.get("/incident/INC0000003")
+            assert resp.json()["sys_id"] == "id3"
+            resp = await ac.get("/incidents", params={"query": "number=inc0000003^ORnumberININC0000008,inc0000005"})
+            assert [row["sys_id"] for row in resp.json()] == ["id5", "id3"]
+            assert mock_get.await_count == 0
+            resp = await ac.get("/incidents", params={"query": "caller_id.name=Bob"})
+            assert resp.json() == [{"sys_id": "upstream"}]
+            resp = await ac.get("/incident/INC0000003", params={"replica": "false"})
+            assert resp.json()["sys_id"] == "upstream"
+            assert mock_get.await_count == 2
+    store.close()
+
+@pytest.mark.asyncio
+async def test_snapshot_replica_and_subscription_agree_on_case(tmp_path, monkeypatch):
+    rows = [
+        {"sys_id": "1", "sys_mod_count": "0", "user_name": "Abel.Tuter", "title": "Manager", "email": "abel@example.com"},
+        {"sys_id": "2", "sys_mod_count": "0", "user_name": "beth.anglin", "title": "manager", "email": "Beth@Example.com"},
+        {"sys_id": "3", "sys_mod_count": "0", "user_name": "Carl", "title": "Engineer", "email": "carl@example.com"},
+    ]
+    for row in rows:
+        row["sys_updated_on"] = "2024-01-01 00:00:00"
+    expected = {
+        "user_name=abel.tuter": ["1"],
+        "titleINMANAGER,director^ORDERBYuser_name": ["1", "2"],
+        "title>f^ORDERBYDESCuser_name": ["2", "1"],
+        "email!=BETH@example.com^ORDERBYuser_name": ["1", "3"],
+        "user_nameSTARTSWITHc^ORemailLIKEEXAMPLE.COM^ORDERBYuser_name": ["1", "2", "3"],
+    }
+    ids = lambda result: [row["sys_id"] for row in result]
+
+    endpoint = "/api/now/table/sys_user"
+    await mcp_server.remember_snapshot(endpoint, "sys_user", rows, {})
+    store = ReplicaStore(str(tmp_path / "replica.db"))
+    store.upsert("sys_user", rows, "2024-01-01 00:00:00")
+    store.mark_synced("sys_user")
+    monkeypatch.setattr(mcp_server, "replica_store", store)
+
+    async def fake_get(endpoint, params=None, use_cache=True):
+        return {"result": EncodedQuery.parse(params["sysparm_query"]).apply(rows, params["sysparm_limit"])}
+
+    monkeypatch.setattr(mcp_server, "servicenow_get", fake_get)
+    poller = mcp_server.TablePoller("sys_user")
+    subscribers = {text: poller.subscribe(EncodedQuery.parse(text), None) for text in expected}
+    poller.stop()
+    poller.watermark = ""
+    assert await poller.poll() == 3
+
+    for text, sys_ids in expected.items():
+        query = EncodedQuery.parse(text)
+        assert ids(await mcp_server.cached_snapshot_rows(endpoint, query, 10, {})) == sys_ids, text
+        assert ids(await mcp_server.replica_list("sys_user", 10, text, {})) == sys_ids, text
+        assert ids(subscribers[text].queue.get_nowait()["records"]) == sys_ids, text
+    store.close()
+
+def test_encoded_query_canonical_form_and_evaluation():
+    query = EncodedQuery.parse("active=true^priority=2^ORpriority=1^short_descriptionLIKEdisk^ORDERBYDESCpriority^ORDERBYnumber")
+    same = EncodedQuery.parse("short_descriptionLIKEdisk^priority=1^ORpriority=2^active=true^EQ^ORDERBYDESCpriority^ORDERBYnumber")
+    assert query == same and query.canonical() == same.canonical()
+    assert mcp_server.cache_key("/api/now/table/incident", {"sysparm_query": "a=1^b=2"}) == \
+        mcp_server.cache_key("/api/now/table/incident", {"sysparm_query": "b=2^a=1"})
+    rows = [
+        {"number": "INC3", "active": "true", "priority": "1", "short_description": "Disk full"},
+        {"number": "INC1", "active": "true", "priority": "2", "short_description": "disk slow"},
+        {"number": "INC2", "active": "true", "priority": "2", "short_description": "Disk errors"},
+        {"number": "INC4", "active": "false", "priority": "1", "short_description": "disk"},
+        {"number": "INC5", "active": "true", "priority": "3", "short_description": "disk"},
+    ]
+    assert [r["number"] for r in query.apply(rows)] == ["INC1", "INC2", "INC3"]
+    assert [r["number"] for r in EncodedQuery.parse("priority>=2^NQnumberSTARTSWITHinc4").apply(rows)] == ["INC1", "INC2", "INC4", "INC5"]
+    assert [r["number"] for r in EncodedQuery.parse("priorityNOT IN1,2^ORactive!=true").apply(rows, limit=1)] == ["INC4"]
+    for unsupported in ("stateBETWEEN1@3", "sys_id=javascript:gs.getUserID()", "GROUPBYstate", "ORactive=true"):
+        with pytest.raises(QueryParseError):
+            EncodedQuery.parse(unsupported)
+
+@pytest.mark.asyncio
+async def test_filtered_list_answered_from_cached_table_snapshot():
+    groups = [{"sys_id": f"g{i}", "name": f"Group {i}", "active": "true" if i % 2 else "false"} for i in range(5)]
+    mock_get = AsyncMock(return_value={"result": groups})
+    with patch("mcp_server.servicenow_get", mock_get):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            await ac.get("/groups", params={"limit": 100})
+            resp = await ac.get("/groups", params={"limit": 100, "query": "active=true^ORDERBYDESCname"})
+            assert [g["sys_id"] for g in resp.json()] == ["g3", "g1"]
+            assert mock_get.await_count == 1
+            await ac.get("/groups", params={"limit": 100, "query": "active=true", "fields": "sys_id"})
+            await ac.get("/groups", params={"limit": 100, "query": "nameINSTANCEOFx"})
+            assert mock_get.await_count == 3
+            # The instance compares text case-insensitively, so the snapshot must too
+            resp = await ac.get("/groups", params={"limit": 100, "query": "name=group 4^ORnameINGROUP 2"})
+            assert [g["sys_id"] for g in resp.json()] == ["g2", "g4"]
+            assert mock_get.await_count == 3
+            # Dot-walked fields are not in the snapshot rows
+            await ac.get("/groups", params={"limit": 100, "query": "manager.name=Alice"})
+            assert mock_get.await_count == 4
+
+@pytest.mark.asyncio
+async def test_raw_passthrough_returns_upstream_result_bytes(monkeypatch, upstream):
+    body = b'{"result":[{"sys_id":"log1","message":"caf\\u00e9 \\"quoted\\""},{"sys_id":"log2","message":"ok"}]}'
+    upstream(lambda request: httpx.Response(200, content=body))
+    monkeypatch.setattr(mcp_server, "SERVICENOW_RAW_PASSTHROUGH", True)
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.get("/system-logs")
+        assert resp.content == body[len(b'{"result":'):-1]
+        assert resp.json()[0]["message"] == 'café "quoted"'
+        resp = await ac.post("/batch", json={"calls": [{"tool": "list_system_logs"}]})
+        assert resp.json()["results"][0]["result"][1] == {"sys_id": "log2", "message": "ok"}
+    assert mcp_server.slice_result(b' {"result": [] }\n') == b"[]"
+    assert mcp_server.json_loads(mcp_server.slice_result(b'{ "result" : [1] }')) == [1]
+
+@pytest.mark.asyncio
+async def test_responses_are_compressed_and_revalidated_with_etags():
+    rows = [{"sys_id": f"inc{i}", "short_description": "Printer on fire " * 5} for i in range(50)]
+    with patch("mcp_server.servicenow_get", AsyncMock(return_value={"result": rows})):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.get("/incidents", headers={"Accept-Encoding": "gzip;q=0.5, zstd;q=0"})
+            assert resp.headers["content-encoding"] == "gzip"
+            assert "accept-encoding" in resp.headers["vary"].lower()
+            assert resp.json() == rows
+            etag = resp.headers["etag"]
+            assert etag.endswith('-gzip"')
+            resp = await ac.get("/incidents", headers={"Accept-Encoding": "zstd", "If-None-Match": etag})
+            assert resp.status_code == status.HTTP_304_NOT_MODIFIED
+            assert resp.content == b""
+            resp = await ac.get("/incidents", params={"stream": "true"}, headers={"Accept-Encoding": "gzip"})
+            assert resp.headers["content-encoding"] == "gzip"
+            assert len(resp.text.splitlines()) == 50
+            resp = await ac.get("/incident/INC1", headers={"Accept-Encoding": "gzip"})
+            assert "content-encoding" not in resp.headers
+
+@pytest.mark.asyncio
+async def test_detail_etag_comes_from_record_version():
+    record = {"sys_id": "inc1", "number": "INC1", "sys_updated_on": "2024-05-01 10:00:00", "sys_mod_count": "3"}
+    mock_get = AsyncMock(return_value={"result": [record]})
+    with patch("mcp_server.servicenow_get", mock_get):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            etag = (await ac.get("/incident/INC1")).headers["etag"]
+            assert etag.startswith('"r-')
+            resp = await ac.get("/incident/INC1", headers={"If-None-Match": etag})
+            assert resp.status_code == status.HTTP_304_NOT_MODIFIED
+            record["sys_mod_count"] = "4"
+            resp = await ac.get("/incident/INC1", headers={"If-None-Match": etag})
+            assert resp.status_code == status.HTTP_200_OK
+            assert resp.headers["etag"] != etag
+
+@pytest.mark.asyncio
+async def test_expired_cache_entries_are_revalidated_upstream(upstream):
+    seen = []
+    def handler(request):
+        seen.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304, headers={"ETag": '"v1"'})
+        return httpx.Response(200, json={"result": [{"name": "incident"}]}, headers={"ETag": '"v1"'})
+    upstream(handler)
+    endpoint, params = "/api/now/table/sys_db_object", {"sysparm_query": "name=incident"}
+    first = await mcp_server.servicenow_get(endpoint, params=params)
+    key = mcp_server.cache_key(endpoint, params)
+    expires_at, *rest = mcp_server.response_cache.entries[key]
+    mcp_server.response_cache.entries[key] = (0, *rest)
+    assert await mcp_server.servicenow_get(endpoint, params=params) == first
+    assert seen == [None, '"v1"']
+    assert mcp_server.response_cache.stats()["revalidations"] == 1
+    await mcp_server.servicenow_get(endpoint, params=params)
+    assert len(seen) == 2
+
+@pytest.mark.asyncio
+async def test_subscriptions_share_one_poller_and_receive_deltas(monkeypatch):
+    monkeypatch.setattr(mcp_server, "SERVICENOW_SUBSCRIBE_QUEUE_SIZE", 1)
+    table = [
+        {"sys_id": "a", "sys_mod_count": "0", "priority": "1", "sys_updated_on": "2024-01-01 00:00:00"},
+        {"sys_id": "b", "sys_mod_count": "0", "priority": "3", "sys_updated_on": "2024-01-01 00:00:00"},
+    ]
+    calls = []
+
+    async def fake_get(endpoint, params=None, use_cache=True):
+        calls.append(params["sysparm_query"])
+        rows = EncodedQuery.parse(params["sysparm_query"]).apply(table, params["sysparm_limit"])
+        return {"result": [dict(r) for r in rows]}
+
+    monkeypatch.setattr(mcp_server, "servicenow_get", fake_get)
+    poller = mcp_server.TablePoller("incident")
+    p1 = poller.subscribe(EncodedQuery.parse("priority=1^active!=false"), None)
+    same = poller.subscribe(EncodedQuery.parse("active!=false^priority=1"), "sys_id")
+    other = poller.subscribe(EncodedQuery.parse("priority=3"), None)
+    poller.stop()
+    assert len(poller.groups) == 3
+    # Both existing rows sit at the starting watermark; the first poll must not resend them
+    poller.watermark, poller.seen_at_watermark = await poller.latest_update()
+    assert poller.watermark == "2024-01-01 00:00:00"
+    assert await poller.poll() == 0
+
+    table.append({"sys_id": "c", "sys_mod_count": "0", "priority": "1", "sys_updated_on": "2024-01-01 00:00:00"})
+    table[1].update(sys_mod_count="1", sys_updated_on="2024-01-01 00:00:05")
+    assert await poller.poll() == 2
+    assert [r["sys_id"] for r in p1.queue.get_nowait()["records"]] == ["c"]
+    assert same.queue.get_nowait()["records"] == [{"sys_id": "c"}]
+    assert [r["sys_id"] for r in other.queue.get_nowait()["records"]] == ["b"]
+    assert await poller.poll() == 0
+    assert calls[-1].startswith("sys_updated_on>=2024-01-01 00:00:05^")
+
+    events = mcp_server.subscription_events(poller, p1)
+    assert await events.__anext__() == b": subscribed\n\n"
+    table.append({"sys_id": "d", "sys_mod_count": "0", "priority": "1", "sys_updated_on": "2024-01-01 00:00:09"})
+    await poller.poll()
+    message = (await events.__anext__()).decode()
+    assert message.startswith("id: 2024-01-01 00:00:09\nevent: changes\n")
+    assert json.loads(message.split("data: ", 1)[1])["records"][0]["sys_id"] == "d"
+    # p1 has a one-event queue and is not reading: the second delta overflows it
+    for sys_id, updated in (("e", "2024-01-01 00:00:10"), ("f", "2024-01-01 00:00:11")):
+        table.append({"sys_id": sys_id, "sys_mod_count": "0", "priority": "1", "sys_updated_on": updated})
+        await poller.poll()
+    assert p1.overflowed and not other.overflowed
+    assert (await events.__anext__()).startswith(b"event: overflow")
+    await events.aclose()
+    assert p1.key not in poller.groups
+    assert poller.stats()["subscribers"] == 2
+
+@pytest.mark.asyncio
+async def test_subscribe_rejects_queries_it_cannot_evaluate():
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.get("/subscribe", params={"table": "incident", "query": "caller_id.name=Bob"})
+        assert resp.status_code == status.HTTP_400_BAD_REQUEST
+        resp = await ac.get("/subscribe", params={"table": "incident;drop"})
+        assert resp.status_code == status.HTTP_400_BAD_REQUEST
+
+@pytest.mark.asyncio
+async def test_expand_follows_references_with_one_query_per_table_and_level(monkeypatch):
+    def ref(table, sys_id):
+        return {"link": f"https://x.service-now.com/api/now/table/{table}/{sys_id}", "value": sys_id}
+    records = {
+        "incident": [{"sys_id": "i1", "number": "INC1", "caller_id": ref("sys_user", "u1"), "assignment_group": ref("sys_user_group", "g1"),
+                      "cmdb_ci": ref("cmdb_ci", "c1"), "problem_id": ref("problem", "p1"), "sys_domain": ref("sys_user_group", "global"), "close_notes": ""}],
+        "sys_user": [{"sys_id": "u1", "manager": ref("sys_user", "u2"), "department": ref("cmn_department", "d1")}, {"sys_id": "u2", "name": "Boss"}],
+        "sys_user_group": [{"sys_id": "g1", "manager": ref("sys_user", "u1")}],
+        "cmdb_ci": [{"sys_id": "c1", "name": "db01"}],
+        "problem": [{"sys_id": "p1", "number": "PRB1"}],
+        "incident_task": [{"sys_id": "t1", "incident": ref("incident", "i1"), "assigned_to": ref("sys_user", "u2")}],
+        "cmn_department": [],
+    }
+    queries = []
+
+    async def fake_get(endpoint, params=None):
+        table = mcp_server.table_from_endpoint(endpoint)
+        query = params["sysparm_query"]
+        queries.append((table, query))
+        field, _, values = query.partition("IN")
+        ids = values.split(",")
+        rows = [r for r in records.get(table, []) if mcp_server.cell_text(r.get(field)) in ids]
+        return {"result": rows}
+
+    monkeypatch.setattr(mcp_server, "servicenow_get", fake_get)
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        resp = await ac.get("/expand/incident/i1", params={"depth": 2})
+    graph = resp.json()
+    assert graph["root"] == "incident:i1"
+    assert set(graph["nodes"]) == {"incident:i1", "sys_user:u1", "sys_user:u2", "sys_user_group:g1", "cmdb_ci:c1", "problem:p1", "incident_task:t1"}
+    assert graph["nodes"]["incident:i1"]["caller_id"] == "u1" and "close_notes" not in graph["nodes"]["incident:i1"]
+    assert graph["missing"] == ["cmn_department:d1"]
+    edges = {(e["from"], e["field"], e["to"]) for e in graph["edges"]}
+    assert ("incident_task:t1", "incident", "incident:i1") in edges
+    assert ("sys_user_group:g1", "manager", "sys_user:u1") in edges
+    assert not any(e["field"] == "sys_domain" for e in graph["edges"])
+    # Level 1: one sys_idIN per table plus the incident_task children; level 2: u2 once, the department, and problem children
+    assert [q for q in queries if q[0] == "sys_user"] == [("sys_user", "sys_idINu1"), ("sys_user", "sys_idINu2")]
+    assert graph["upstream_queries"] == len(queries) == 10
+
+@pytest.mark.asyncio
+async def test_servicenow_stub_filters_pages_and_throttles():
+    stub = create_stub_app(dataset_size=50, rate_limit=3, rate_window=60)
+    async with AsyncClient(app=stub, base_url="http://stub") as ac:
+        page = await ac.get("/api/now/table/incident", params={"sysparm_query": "priority=2^ORDERBYDESCnumber", "sysparm_limit": 4, "sysparm_offset": 2})
+        lookup = await ac.get("/api/now/table/sys_db_object", params={"sysparm_query": "name=cmdb_ci_server", "sysparm_fields": "name,super_class.name,super_class.super_class.name"})
+        await ac.get("/api/now/table/incident")
+        throttled = await ac.get("/api/now/table/incident")
+    assert page.headers["X-Total-Count"] == "10"
+    assert [row["number"] for row in page.json()["result"]] == ["INC0000036", "INC0000031", "INC0000026", "INC0000021"]
+    assert 'rel="next"' in page.headers["Link"] and 'rel="prev"' in page.headers["Link"]
+    assert page.headers["X-RateLimit-Remaining"] == "2"
+    assert lookup.json()["result"] == [{"name": "cmdb_ci_server", "super_class.name": "cmdb_ci", "super_class.super_class.name": "cmdb"}]
+    assert throttled.status_code == 429 and int(throttled.headers["Retry-After"]) >= 1
+    assert stub.state.stats["calls"] == 4 and stub.state.stats["throttled"] == 1
+
+def test_load_test_workload_is_reproducible_and_check_flags_regressions():
+    assert build_requests(200, 1000, seed=7) == build_requests(200, 1000, seed=7)
+    assert {kind for kind, *_ in build_requests(200, 1000, seed=7)} == {"list", "detail", "schema", "prompt"}
+    baseline = {"throughput_rps": 100.0, "latency_ms": {"p50": 10.0, "p95": 40.0, "p99": 80.0}, "upstream": {"calls": 200, "throttled": 0}, "errors": 0}
+    current = {"throughput_rps": 90.0, "latency_ms": {"p50": 11.0, "p95": 60.0, "p99": 80.0}, "upstream": {"calls": 200, "throttled": 1}, "errors": 0}
+    failed = {metric for metric, _, _, ok in compare(baseline, current, tolerance=0.2) if not ok}
+    assert failed == {"latency_ms.p95", "upstream.throttled"}
+
+@pytest.mark.asyncio
+async def test_calls_are_routed_per_instance_with_separate_pools_and_caches(monkeypatch, upstream):
+    hosts = []
+    def handler(request):
+        hosts.append(request.url.host)
+        return httpx.Response(200, json={"result": [{"sys_id": request.url.host, "number": "INC1"}]})
+    prod = mcp_server.ServiceNowInstance("prod", "https://prod.example.com", "u", "p")
+    monkeypatch.setitem(mcp_server.servicenow_instances, "prod", prod)
+    default = mcp_server.get_instance()
+    default_host = httpx.URL(default.url).host
+    upstream(handler, default)
+    upstream(handler, prod)
+    default_requests = default.pool_counters["requests"]
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        routed = await ac.get("/incidents", headers={"X-ServiceNow-Instance": "prod"})
+        by_param = await ac.get("/incidents", params={"instance": "prod"})
+        unrouted = await ac.get("/incidents")
+        unknown = await ac.get("/incidents", params={"instance": "staging"})
+        batch = await ac.post("/batch", json={"calls": [{"tool": "list_incidents"}, {"tool": "list_incidents", "instance": "prod"}]})
+        pool = await ac.get("/admin/pool-stats", headers={"X-ServiceNow-Instance": "prod"})
+    assert routed.json()[0]["sys_id"] == by_param.json()[0]["sys_id"] == "prod.example.com"
+    assert unrouted.json()[0]["sys_id"] == default_host
+    assert unknown.status_code == 400 and "staging" in unknown.json()["detail"]
+    assert [r["result"][0]["sys_id"] for r in batch.json()["results"]] == [default_host, "prod.example.com"]
+    # Each instance has its own cache namespace: one upstream call per instance, then hits
+    assert sorted(hosts) == sorted(["prod.example.com", default_host])
+    assert pool.json()["instance"] == "prod" and pool.json()["requests"] == 1
+    assert default.pool_counters["requests"] == default_requests + 1
+
+@pytest.mark.asyncio
+async def test_instances_are_health_checked_concurrently(monkeypatch, upstream):
+    async def slow_ok(request):
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, json={"result": []})
+    async def slow_down(request):
+        await asyncio.sleep(0.2)
+        raise httpx.ConnectError("connection refused", request=request)
+    instances = {
+        "dev": mcp_server.ServiceNowInstance("dev", "https://dev.example.com", "u", "p"),
+        "prod": mcp_server.ServiceNowInstance("prod", "https://prod.example.com", "u", "p"),
+    }
+    upstream(slow_down, instances["dev"])
+    upstream(slow_ok, instances["prod"])
+    monkeypatch.setattr(mcp_server, "servicenow_instances", instances)
+    monkeypatch.setattr(mcp_server, "SERVICENOW_DEFAULT_INSTANCE", "prod")
+    start = time.perf_counter()
+    results = await mcp_server.check_instances()
+    assert time.perf_counter() - start < 0.35
+    assert results["prod"]["ok"] and results["prod"]["status_code"] == 200
+    assert not results["dev"]["ok"] and "ConnectError" in results["dev"]["error"]
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        listing = (await ac.get("/admin/instances")).json()
+        metrics = (await ac.get("/metrics")).text
+    assert listing["default"] == "prod" and listing["instances"]["dev"]["health"]["ok"] is False
+    assert 'servicenow_instance_up{instance="dev"} 0' in metrics and 'servicenow_instance_up{instance="prod"} 1' in metrics
+
+def test_named_instances_are_read_from_the_environment(monkeypatch):
+    monkeypatch.setattr(mcp_server, "SERVICENOW_INSTANCE_NAMES", ["dev", "prod-eu"])
+    monkeypatch.setattr(mcp_server, "SERVICENOW_DEFAULT_INSTANCE", "prod-eu")
+    monkeypatch.setenv("SERVICENOW_DEV_INSTANCE", "https://dev.example.com")
+    monkeypatch.setenv("SERVICENOW_PROD_EU_INSTANCE", "https://eu.example.com")
+    monkeypatch.setenv("SERVICENOW_PROD_EU_USERNAME", "eu-user")
+    monkeypatch.setenv("SERVICENOW_PROD_EU_RATE_LIMIT", "20")
+    settings = mcp_server.load_instance_settings()
+    assert settings["dev"]["username"] == mcp_server.SERVICENOW_USERNAME
+    assert settings["prod-eu"] == {"url": "https://eu.example.com", "username": "eu-user", "password": mcp_server.SERVICENOW_PASSWORD, "rate_limit": "20"}
+    monkeypatch.delenv("SERVICENOW_DEV_INSTANCE")
+    with pytest.raises(RuntimeError, match="SERVICENOW_DEV_INSTANCE"):
+        mcp_server.load_instance_settings()
+
+@pytest.mark.asyncio
+async def test_redis_cache_backend_is_shared_and_invalidates_every_worker():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    workers = [mcp_server.RedisCacheBackend(fakeredis.FakeAsyncRedis(server=server), near=mcp_server.ResponseCache(100, 10**6), near_ttl=30)
+               for _ in range(2)]
+    for worker in workers:
+        await worker.start()
+    try:
+        first, second = workers
+        await first.set("default:/api/now/table/incident?a=1", "incident", {"result": [{"number": "INC1"}]}, 10, ttl=60, validators={"etag": '"v1"'})
+        await first.set("default:/api/now/table/incident?a=1#raw", "incident", b'[{"number":"INC1"}]', 10, ttl=60)
+        assert await second.get("default:/api/now/table/incident?a=1") == {"result": [{"number": "INC1"}]}
+        assert await second.get("default:/api/now/table/incident?a=1#raw") == b'[{"number":"INC1"}]'
+        assert await second.stale("default:/api/now/table/incident?a=1") == ({"result": [{"number": "INC1"}]}, {"etag": '"v1"'})
+        assert second.stats()["hits"] == 2 and second.stats()["near"]["entries"] == 2
+        await asyncio.sleep(0.05)  # let both listeners subscribe
+        assert await first.invalidate("incident", "default:") == 2
+        for _ in range(100):
+            if second.stats()["remote_invalidations"]:
+                break
+            await asyncio.sleep(0.01)
+        assert second.stats()["near"]["entries"] == 0
+        assert await second.get("default:/api/now/table/incident?a=1") is None
+    finally:
+        for worker in workers:
+            await worker.close()
+
+@pytest.mark.asyncio
+async def test_servicenow_get_uses_the_configured_cache_backend(monkeypatch, upstream):
+    fakeredis = pytest.importorskip("fakeredis")
+    backend = mcp_server.RedisCacheBackend(fakeredis.FakeAsyncRedis())
+    monkeypatch.setattr(mcp_server, "cache_backend", backend)
+    calls = []
+    def handler(request):
+        calls.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, json={"result": [{"name": "incident"}]}, headers={"ETag": '"v1"'})
+    upstream(handler)
+    try:
+        endpoint, params = "/api/now/table/sys_db_object", {"sysparm_query": "name=incident"}
+        first = await mcp_server.servicenow_get(endpoint, params=params)
+        assert await mcp_server.servicenow_get(endpoint, params=params) == first
+        assert calls == [None]
+        # Expire the entry in place; the kept validators turn the next call into a conditional GET
+        key = mcp_server.cache_key(endpoint, params)
+        header, body = backend.unframe(await backend.client.get(backend.prefix + key))
+        await backend.client.set(backend.prefix + key, backend.frame({**header, "fresh_until": 0}, body))
+        assert await mcp_server.servicenow_get(endpoint, params=params) == first
+        assert calls == [None, '"v1"'] and backend.stats()["revalidations"] == 1
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.post("/admin/cache/invalidate", params={"table": "sys_db_object"})
+            assert resp.json()["invalidated"] == 1
+            assert (await ac.get("/admin/cache-stats")).json()["backend"] == "redis"
+    finally:
+        await backend.close()
+
+@pytest.mark.asyncio
+async def test_aggregate_uses_one_cached_stats_call(upstream):
+    stub = create_stub_app(dataset_size=20)
+    upstream(httpx.ASGITransport(app=stub))
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        params = {"query": "state!=0", "group_by": "priority", "avg": "state", "having": "count^sys_id^>^3"}
+        resp = await ac.get("/aggregate/incident", params=params)
+        assert resp.status_code == status.HTTP_200_OK
+        assert resp.json()["groups"] == [
+            {"group": {"priority": "2"}, "count": 4, "avg": {"state": 3.25}},
+            {"group": {"priority": "4"}, "count": 4, "avg": {"state": 3.5}},
+        ]
+        again = await ac.get("/aggregate/incident", params=dict(reversed(list(params.items()))))
+        assert again.json() == resp.json()
+        assert stub.state.stats["by_table"]["incident"] == 1
+        total = await ac.get("/aggregate/incident", params={"max": "priority"})
+        assert total.json()["groups"] == [{"group": {}, "count": 20, "max": {"priority": 5}}]
+        batch = await ac.post("/batch", json={"calls": [{"tool": "aggregate_records", "parameters": {"table_name": "incident", "max": "priority"}}]})
+        assert batch.json()["results"][0]["result"] == total.json()
+        assert stub.state.stats["by_table"]["incident"] == 2
+        for bad in ({"having": "count>3"}, {"group_by": "priority;drop"}, {"count": "false"}):
+            assert (await ac.get("/aggregate/incident", params=bad)).status_code == status.HTTP_400_BAD_REQUEST
+        resources = (await ac.get("/resources")).json()["resources"]
+        aggregate = next(r for r in resources if r["name"] == "aggregate_records")
+        assert {"avg", "group_by", "having"} <= {p["name"] for p in aggregate["parameters"]}
+
+@pytest.mark.asyncio
+async def test_table_schema_hierarchy_survives_the_cache(upstream):
+    # u_t0 extends u_t1 ... extends u_t8: deeper than one dot-walk of super_class fields reaches
+    parents = {f"u_t{i}": f"u_t{i + 1}" if i < 8 else "" for i in range(9)}
+    def handler(request):
+        name = request.url.params["sysparm_query"].partition("=")[2]
+        if request.url.path.endswith("/sys_dictionary"):
+            return httpx.Response(200, json={"result": []})
+        row, ancestor = {"name": name}, parents.get(name, "")
+        for field in mcp_server.SUPER_CLASS_FIELDS:
+            row[field] = ancestor
+            ancestor = parents.get(ancestor, "")
+        return httpx.Response(200, json={"result": [row] if name in parents else []})
+    upstream(handler)
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        first = (await ac.get("/table-schema/u_t0")).json()
+        second = (await ac.get("/table-schema/u_t0")).json()
+    assert first["hierarchy"] == second["hierarchy"] == [f"u_t{i}" for i in range(9)]
+    assert "super_class.name" not in second["table"]
+
+@pytest.mark.asyncio
+async def test_batch_arguments_are_validated_like_query_parameters():
+    mock_get = AsyncMock(side_effect=lambda endpoint, params=None, **kwargs: {"result": {"stats": {"max": {"priority": "5"}}}}
+                         if endpoint.startswith("/api/now/stats/") else mock_servicenow_get(endpoint, params))
+    with patch("mcp_server.servicenow_get", mock_get):
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            resp = await ac.post("/batch", json={"calls": [
+                {"tool": "list_users", "parameters": {"limit": "3", "exclude_reference_link": "false", "replica": "false"}},
+                {"tool": "aggregate_records", "parameters": {"table_name": "incident", "count": "false", "max": "priority"}},
+                {"tool": "list_users", "parameters": {"limit": "many"}},
+                {"tool": "list_users", "parameters": {"display_value": "sometimes"}},
+                {"tool": "expand_record", "parameters": {"table": "incident", "sys_id": "abc", "depth": "99"}},
+            ]})
+    results = resp.json()["results"]
+    assert [r["status"] for r in results] == [200, 200, 422, 422, 422]
+    assert "limit" in results[2]["error"] and "depth" in results[4]["error"]
+    list_params, stats_params = (call.kwargs.get("params") or call.args[1] for call in mock_get.call_args_list)
+    assert list_params["sysparm_limit"] == 3 and "sysparm_exclude_reference_link" not in list_params
+    assert stats_params == {"sysparm_max_fields": "priority"}
+
+@pytest.mark.asyncio
+async def test_expand_reports_truncated_children_without_dangling_edges(monkeypatch):
+    tasks = [{"sys_id": f"t{i}", "incident": {"link": "https://x.service-now.com/api/now/table/incident/i1", "value": "i1"}} for i in range(4)]
+
+    async def fake_get(endpoint, params=None):
+        if mcp_server.table_from_endpoint(endpoint) == "incident":
+            return {"result": [{"sys_id": "i1", "number": "INC1"}]}
+        return {"result": tasks[:params["sysparm_limit"]]}
+
+    monkeypatch.setattr(mcp_server, "servicenow_get", fake_get)
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        monkeypatch.setattr(mcp_server, "SERVICENOW_EXPAND_RELATED_LIMIT", 2)
+        limited = (await ac.get("/expand/incident/i1")).json()
+        monkeypatch.setattr(mcp_server, "SERVICENOW_EXPAND_RELATED_LIMIT", 50)
+        monkeypatch.setattr(mcp_server, "SERVICENOW_EXPAND_MAX_NODES", 3)
+        capped = (await ac.get("/expand/incident/i1")).json()
+    assert limited["truncated"] and len(limited["nodes"]) == 3 and len(limited["edges"]) == 2
+    assert capped["truncated"] and len(capped["nodes"]) == 3
+    assert {e["from"] for e in capped["edges"]} == set(capped["nodes"]) - {"incident:i1"}